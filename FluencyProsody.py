@@ -1,35 +1,105 @@
 import pandas as pd
+import numpy as np
 import os
 import math
+import sys
+import functools
 from praatio import textgrid
 
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Optional
 import shutil
 
+import masterdata
+import tgacoustic
+import tgbatch
+import tgcache
+import tgcontours
+import tgedit
+import tgfilled
+import tgjoin
+import tgledger
+import tgmanifest
+import tgmetrics
+import tgnuclei
+import tgpipeline
+import tgreader
+import tgrules
+import tgshard
+import tgstats
+
+# tgdataで使うTier(Tier1のNucleiは使わないので読まない)
+FLUENCY_TIERS = (
+    "Phrases",
+    "DFauto (English)",
+    "Repair",
+    "Japanese",
+    "Intensity",
+    "Pitch",
+)
+# tg_checkで使うTier(番号で参照する)
+CHECK_TIERS = (1, 2, 3, 4, 6)
+
+# tgdataで計算に使うTier(Tier名 -> Tier)
+Tiers = Dict[str, tgreader.TierArrays]
+
+# マスターデータの列の並び順
+ORDERITEM = list(tgmetrics.COLUMNS) + ["duplicate"]
+
+# 計算結果に影響するソースから作るバージョン。変わると前回の結果は使わない
+CODE_VERSION = tgmanifest.code_version(
+    [
+        os.path.abspath(module.__file__)
+        for module in (
+            sys.modules[__name__],
+            tgreader,
+            tgrules,
+            tgjoin,
+            tgedit,
+            tgstats,
+            tgmetrics,
+            # 保存する行(IDの正規化や重複の判定)を決める
+            masterdata,
+        )
+    ]
+)
+
 
 class tgdata:
-    def __init__(self, textgrid_file_path: str):
-        textgrid_file = textgrid.openTextgrid(
-            textgrid_file_path, includeEmptyIntervals=True
-        )
+    def __init__(
+        self,
+        textgrid_file_path: str,
+        document: Optional[tgreader.TextgridArrays] = None,
+    ):
+        # tg_checkで読み込み済みのものがあればそれを使い、ファイルを読み直さない
+        if document is None:
+            document = tgreader.read_textgrid(textgrid_file_path, FLUENCY_TIERS)
+        self.document = document
+        # Tierは名前で1回だけ引き、以降は配列のまま計算する(ファイルに無いTierは含めない)
+        tiers = {name: document[name] for name in FLUENCY_TIERS if name in document}
         self.filename = os.path.basename(textgrid_file_path)
+        # Intensity / Pitch のTierを Praat で作ったか(tgacoustic で作った行はマスターデータに入れない)
+        self.tier_source = tgacoustic.tier_source(self.filename)
+        # ラベルごとの数と長さの合計(Tierが置き換えられるまで使い回す)
+        self.label_stats = tgstats.LabelStatsCache()
 
-        textgrid_file = self.calc_1(textgrid_file)
+        tiers = self.calc_1(tiers)
 
         # - Tier4に”rp”が入っている境界内の、Tier3の”v”を”rp”に置き換える
-        textgrid_file = self.T4rp_T3v2rp(textgrid_file)
+        tiers = self.T4rp_T3v2rp(tiers)
 
         # - Tier2の境界がfpであるTier3のvをfpに変える(Speech rateの計算前に実行する)
-        textgrid_file = self.T2fp_T3v2fp(textgrid_file)
+        tiers = self.T2fp_T3v2fp(tiers)
 
-        textgrid_file = self.calc_2(textgrid_file)
+        tiers = self.calc_2(tiers)
 
         # - Tier4に”rp”が入っている境界と同じ境界をTier2に作り、”rp”を入れる
-        textgrid_file = self.T4rp_T2rp(textgrid_file)
+        tiers = self.T4rp_T2rp(tiers)
 
-        textgrid_file = self.calc_3(textgrid_file)
+        tiers = self.calc_3(tiers)
 
-        self.textgrid_file = textgrid_file
+        self.tiers = tiers
+        # マスターデータに書き出す列だけを、型をそろえて別に持つ
+        self.metrics = tgmetrics.FluencyMetrics(self.__dict__)
 
     def save(
         self,
@@ -38,11 +108,25 @@ class tgdata:
         includeBlankSpaces: bool = True,
     ):
         """Save the Textgrid to the specified output path."""
-        self.textgrid_file.save(
-            output_path, format=format, includeBlankSpaces=includeBlankSpaces
+        # 読んでいないTier(Nuclei)はここで読み、変更したTierと元の順序で合わせる
+        textgrid_file = self.document.to_textgrid(
+            overrides={name: tier.to_praatio() for name, tier in self.tiers.items()}
         )
-
-    def calc_1(self, textgrid_file: textgrid) -> textgrid:
+        # 途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+        # (一時ファイルは通常のファイルと同じ権限で作られるよう、praatioに作らせる)
+        tmp_path = output_path + ".tmp"
+        try:
+            textgrid_file.save(
+                tmp_path, format=format, includeBlankSpaces=includeBlankSpaces
+            )
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            # praatio が一時ファイルを作る前に失敗した場合は、元の例外をそのまま送る
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def calc_1(self, tiers: Tiers) -> Tiers:
         """Phonation Rate (%)
             PhonRat=speakingtot(Tier2: pr)/dur (Tier2: ps+psb+pr+fp)* 100
              Frequency of Silent Pause per minute
@@ -63,10 +147,10 @@ class tgdata:
             FPauseDur=Tier2: Mean duration of “fp”
 
         Args:
-            textgrid_file (textgrid): _description_
+            tiers (Tiers): _description_
 
         Returns:
-            textgrid: _description_
+            Tiers: _description_
         """
 
         self.ID = self.filename[0:3]
@@ -77,37 +161,16 @@ class tgdata:
         # ,'ID','RECN','Date'
 
         # self.nsyll = len(textgrid_file._tierDict['Nuclei'].entries)
-        nsounding = 0
-        npause_ps = 0
-        npause_psb = 0
-        speakingtot = 0
-        silenttot_ps = 0
-        silenttot_psb = 0
-        t2_pr_dur = 0
-        t2_ps_dur = 0
-        t2_psb_dur = 0
-        for interval in textgrid_file._tierDict["Phrases"].entries:
-            if interval.label == "pr":
-                nsounding += 1
-                ts = interval.start
-                te = interval.end
-                speakingtot += te - ts
-                t2_pr_dur += te - ts
-            elif interval.label == "ps":
-                npause_ps += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_ps += te - ts
-                t2_ps_dur += te - ts
-            elif interval.label == "psb":
-                npause_psb += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_psb += te - ts
-                t2_psb_dur += te - ts
-            else:
-                # print('想定外のラベル: Phrases   ' + interval.label)
-                pass
+        t2 = self.label_stats.get(tiers, "Phrases")
+        nsounding = t2.count("pr")
+        npause_ps = t2.count("ps")
+        npause_psb = t2.count("psb")
+        speakingtot = t2.total("pr")
+        silenttot_ps = t2.total("ps")
+        silenttot_psb = t2.total("psb")
+        t2_pr_dur = t2.total("pr")
+        t2_ps_dur = t2.total("ps")
+        t2_psb_dur = t2.total("psb")
 
         self.t2_pr_dur = t2_pr_dur
         self.t2_ps_dur = t2_ps_dur
@@ -124,31 +187,13 @@ class tgdata:
         self.npause_ps = npause_ps
         self.npause_psb = npause_psb
 
-        nrFP = 0
-        ts = 0
-        te = 0
-        tFP = 0.0
-        nrRP = 0
-        tRP = 0.0
-
         # 個数はTier2からとる
-        for start, end, label in textgrid_file._tierDict["Phrases"].entries:
-            if label == "fp":
-                nrFP += 1
-
-            elif label == "rp":
-                nrRP += 1
+        nrFP = t2.count("fp")
+        nrRP = t2.count("rp")
 
         # 時間はTier2からとる
-        for start, end, label in textgrid_file._tierDict["Phrases"].entries:
-            if label == "fp":
-                ts = start
-                te = end
-                tFP += te - ts
-            elif label == "rp":
-                ts = start
-                te = end
-                tRP += te - ts
+        tFP = t2.total("fp")
+        tRP = t2.total("rp")
 
         self.nrFP = nrFP
         self.tFP = tFP
@@ -169,11 +214,12 @@ class tgdata:
         #############################################
 
         # 1 Phonation Rate (%) PhonRat=speakingtot(Tier2: pr)/dur (Tier2: ps+psb+pr+fp)* 100
-        self.PhonRat = format(
+        # 他の列と同じく数値にする(以前は format(..., ".2f") の文字列だった)
+        self.PhonRat = round(
             (self.t2_pr_dur)
             / (self.t2_ps_dur + self.t2_psb_dur + self.t2_pr_dur + self.tFP)
             * 100,
-            ".2f",
+            2,
         )
 
         # SPauseFreq ; １分間に産出されたSilent Pauseの数;
@@ -254,9 +300,9 @@ class tgdata:
         except ZeroDivisionError:
             self.FPauseDur = 0
 
-        return textgrid_file
+        return tiers
 
-    def calc_2(self, textgrid_file: textgrid) -> textgrid:
+    def calc_2(self, tiers: Tiers) -> Tiers:
         """
         Speech rate
         SR = Tier3: v+rp/ dur (Tier2: ps+psb+pr+fp)* 60
@@ -267,77 +313,34 @@ class tgdata:
         (もともとTier3でvだったが、Tier2のfp境界内、Tier4のrp境界内のvは、上の処理14), 15)で、それぞれfp, rpに置き換わっている)。
 
                 Args:
-                    textgrid_file (textgrid): _description_
+                    tiers (Tiers): _description_
 
                 Returns:
-                    textgrid: _description_
+                    Tiers: _description_
         """
 
-        nsyll = len(
-            [
-                x
-                for x in textgrid_file._tierDict["DFauto (English)"].entries
-                if x.label == "v"
-            ]
-        )
+        t3 = self.label_stats.get(tiers, "DFauto (English)")
+        nsyll = t3.count("v")
 
         # self.nsyll = len(textgrid_file._tierDict['Nuclei'].entries)
-        nsounding = 0
-        npause_ps = 0
-        npause_psb = 0
-        speakingtot = 0
-        silenttot_ps = 0
-        silenttot_psb = 0
-        t2_pr_dur = 0
-        t2_ps_dur = 0
-        t2_psb_dur = 0
-        for interval in textgrid_file._tierDict["Phrases"].entries:
-            if interval.label == "pr":
-                nsounding += 1
-                ts = interval.start
-                te = interval.end
-                speakingtot += te - ts
-                t2_pr_dur += te - ts
-            elif interval.label == "ps":
-                npause_ps += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_ps += te - ts
-                t2_ps_dur += te - ts
-            elif interval.label == "psb":
-                npause_psb += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_psb += te - ts
-                t2_psb_dur += te - ts
-            else:
-                # print('想定外のラベル: Phrases   ' + interval.label)
-                pass
-
-        T3nrFP = 0
-        T3nrRP = 0
-        ts = 0
-        te = 0
-        tFP = 0.0
-        tRP = 0.0
-        # 個数はTier3からとる
-        for start, end, label in textgrid_file._tierDict["DFauto (English)"].entries:
-            if label == "fp":
-                T3nrFP += 1
+        t2 = self.label_stats.get(tiers, "Phrases")
+        nsounding = t2.count("pr")
+        npause_ps = t2.count("ps")
+        npause_psb = t2.count("psb")
+        speakingtot = t2.total("pr")
+        silenttot_ps = t2.total("ps")
+        silenttot_psb = t2.total("psb")
+        t2_pr_dur = t2.total("pr")
+        t2_ps_dur = t2.total("ps")
+        t2_psb_dur = t2.total("psb")
 
-            elif label == "rp":
-                T3nrRP += 1
+        # 個数はTier3からとる
+        T3nrFP = t3.count("fp")
+        T3nrRP = t3.count("rp")
 
         # 時間はTier2からとる
-        for start, end, label in textgrid_file._tierDict["Phrases"].entries:
-            if label == "fp":
-                ts = start
-                te = end
-                tFP += te - ts
-            elif label == "rp":
-                ts = start
-                te = end
-                tRP += te - ts
+        tFP = t2.total("fp")
+        tRP = t2.total("rp")
 
         self.T3nrFP = T3nrFP
         self.tFP = tFP
@@ -356,14 +359,13 @@ class tgdata:
         # (もともとTier3でvだったが、Tier2のfp境界内、Tier4のrp境界内のvは、
         # 上の処理14), 15)で、それぞれfp, rpに置き換わっている)。
 
-        count_T3v_in_T2pr = 0
+        # Tier3の各intervalを含むTier2の"pr"の番号
+        tier3 = tiers["DFauto (English)"]
+        pr_index = tgjoin.contained_in(tier3, tiers["Phrases"], ["pr"])
+        is_v = tier3.mask("v")
+        v_pr_index = pr_index[is_v & (pr_index != tgjoin.NOT_CONTAINED)]
 
-        for t3start, t3end, t3label in textgrid_file.tiers[2].entries:
-            if t3label == "v":
-                for t2start, t2end, t2label in textgrid_file.tiers[1].entries:
-                    if t2label == "pr":
-                        if t2start <= t3start and t3end <= t2end:
-                            count_T3v_in_T2pr += 1
+        count_T3v_in_T2pr = len(v_pr_index)
 
         # そこで、MLoRの計算に、次の条件を加えていただけないでしょうか。
         # 「一つのTier2"pr"の範囲内のTier3の記号に一つも"v"がない場合、MLoRの計算の"pr"とカウントしない。」
@@ -371,27 +373,16 @@ class tgdata:
         # 「一つのTier2"pr"の範囲内のTier3の記号に"rp"また"fp"しかない場合、MLoRの計算の"pr"とカウントしない。」
         # と同義となるはずです。
 
-        count_T2pr = 0
-        for t2start, t2end, t2label in textgrid_file.tiers[1].entries:
-            if t2label == "pr":
-                vexist = False
-                for t3start, t3end, t3label in textgrid_file.tiers[2].entries:
-                    if t2start <= t3start and t3end <= t2end and t3label == "v":
-                        vexist = True
-                        break
-
-                if vexist:
-                    count_T2pr += 1
-                    # print(f"t2start:{t2start} t2end:{t2end}")
+        count_T2pr = len(np.unique(v_pr_index))
 
         try:
             self.MLoR = round((count_T3v_in_T2pr) / (count_T2pr), 2)
         except ZeroDivisionError:
             self.MLoR = 0
 
-        return textgrid_file
+        return tiers
 
-    def calc_3(self, textgrid_file: textgrid) -> textgrid:
+    def calc_3(self, tiers: Tiers) -> Tiers:
         """
         Speech rate pruned
         SRP = Tier3 (# of “v”) / dur (Tier2: ps+psb+fp+pr)*60
@@ -403,10 +394,10 @@ class tgdata:
         RpDur = Tier2: summed duration of “rp”/dur (Tier 2: ps+psb+pr+fp+rp)*60
 
                         Args:
-                            textgrid_file (textgrid): _description_
+                            tiers (Tiers): _description_
 
                         Returns:
-                            textgrid: _description_
+                            Tiers: _description_
         """
 
         self.ID = self.filename[0:3]
@@ -416,46 +407,20 @@ class tgdata:
         )
         # ,'ID','RECN','Date'
 
-        self.nsyll = len(
-            [
-                x
-                for x in textgrid_file._tierDict["DFauto (English)"].entries
-                if x.label == "v"
-            ]
-        )
+        t3 = self.label_stats.get(tiers, "DFauto (English)")
+        self.nsyll = t3.count("v")
 
         # self.nsyll = len(textgrid_file._tierDict['Nuclei'].entries)
-        nsounding = 0
-        npause_ps = 0
-        npause_psb = 0
-        speakingtot = 0
-        silenttot_ps = 0
-        silenttot_psb = 0
-        t2_pr_dur = 0
-        t2_ps_dur = 0
-        t2_psb_dur = 0
-        for interval in textgrid_file._tierDict["Phrases"].entries:
-            if interval.label == "pr":
-                nsounding += 1
-                ts = interval.start
-                te = interval.end
-                speakingtot += te - ts
-                t2_pr_dur += te - ts
-            elif interval.label == "ps":
-                npause_ps += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_ps += te - ts
-                t2_ps_dur += te - ts
-            elif interval.label == "psb":
-                npause_psb += 1
-                ts = interval.start
-                te = interval.end
-                silenttot_psb += te - ts
-                t2_psb_dur += te - ts
-            else:
-                # print('想定外のラベル: Phrases   ' + interval.label)
-                pass
+        t2 = self.label_stats.get(tiers, "Phrases")
+        nsounding = t2.count("pr")
+        npause_ps = t2.count("ps")
+        npause_psb = t2.count("psb")
+        speakingtot = t2.total("pr")
+        silenttot_ps = t2.total("ps")
+        silenttot_psb = t2.total("psb")
+        t2_pr_dur = t2.total("pr")
+        t2_ps_dur = t2.total("ps")
+        t2_psb_dur = t2.total("psb")
 
         self.t2_pr_dur = t2_pr_dur
         self.t2_ps_dur = t2_ps_dur
@@ -472,41 +437,17 @@ class tgdata:
         self.npause_ps = npause_ps
         self.npause_psb = npause_psb
 
-        nrFP = 0
-        ts = 0
-        te = 0
-        tFP = 0.0
-        nrRP = 0
-        tRP = 0.0
-        T3nrFP = 0
-        T3nrRP = 0
-
         # 個数はTier2からとる
-        for start, end, label in textgrid_file._tierDict["Phrases"].entries:
-            if label == "fp":
-                nrFP += 1
-
-            elif label == "rp":
-                nrRP += 1
+        nrFP = t2.count("fp")
+        nrRP = t2.count("rp")
 
         # 個数はTier3からとる
-        for start, end, label in textgrid_file._tierDict["DFauto (English)"].entries:
-            if label == "fp":
-                T3nrFP += 1
-
-            elif label == "rp":
-                T3nrRP += 1
+        T3nrFP = t3.count("fp")
+        T3nrRP = t3.count("rp")
 
         # 時間はTier2からとる
-        for start, end, label in textgrid_file._tierDict["Phrases"].entries:
-            if label == "fp":
-                ts = start
-                te = end
-                tFP += te - ts
-            elif label == "rp":
-                ts = start
-                te = end
-                tRP += te - ts
+        tFP = t2.total("fp")
+        tRP = t2.total("rp")
         self.nrFP = nrFP
         self.tFP = tFP
         self.nrRP = nrRP
@@ -552,316 +493,179 @@ class tgdata:
             self.tRP / (t2_psb_dur + t2_ps_dur + t2_pr_dur + tFP + tRP) * 60, 2
         )
 
-        textgrid_file = self.vl_jp_modification(textgrid_file)
+        tiers = self.vl_jp_modification(tiers)
 
-        self.calculate_duration(textgrid_file)
+        self.calculate_duration(tiers)
 
-        return textgrid_file
+        return tiers
 
-    def T2fp_T3v2fp(self, textgrid_file: textgrid) -> textgrid:
+    def T2fp_T3v2fp(self, tiers: Tiers) -> Tiers:
         # - Tier2の境界がfpであるTier3のvをfpに変える(Speech rateの計算前に実行する)
 
-        # - Tier2の境界がfpであるTier3のvをfpに変える(Speech rateの計算前に実行する)
-        for t3start, t3end, t3label in textgrid_file.tiers[2].entries:
-            if t3label == "v":
-                for t2start, t2end, t2label in textgrid_file.tiers[1].entries:
-                    if t2label == "fp":
-                        if t2start <= t3start and t3end <= t2end:
-                            textgrid_file.tiers[2].insertEntry(
-                                (t3start, t3end, "fp"),
-                                collisionMode="replace",
-                                collisionReportingMode="silence",
-                            )
-
-        return textgrid_file
-
-    def T4rp_T3v2rp(self, textgrid_file: textgrid) -> textgrid:
+        tier3 = tiers["DFauto (English)"]
+        fp_index = tgjoin.contained_in(tier3, tiers["Phrases"], ["fp"])
+        is_v = tier3.mask("v")
+        tiers["DFauto (English)"] = tgedit.relabel(
+            tier3, is_v & (fp_index != tgjoin.NOT_CONTAINED), "fp"
+        )
+
+        return tiers
+
+    def T4rp_T3v2rp(self, tiers: Tiers) -> Tiers:
         """Tier4に”rp”が入っている境界内の、Tier3の”v”を”rp”に置き換える
 
         Args:
-            textgrid_file (textgrid): _description_
+            tiers (Tiers): _description_
 
         Returns:
-            textgrid: _description_
+            Tiers: _description_
         """
 
-        for t3start, t3end, t3label in textgrid_file.tiers[2].entries:
-            if t3label == "v":
-                for t4start, t4end, t4label in textgrid_file.tiers[3].entries:
-                    if t4label == "rp":
-                        if t4start <= t3start and t3end <= t4end:
-                            textgrid_file.tiers[2].insertEntry(
-                                (t3start, t3end, "rp"),
-                                collisionMode="replace",
-                                collisionReportingMode="silence",
-                            )
+        tier3 = tiers["DFauto (English)"]
+        rp_index = tgjoin.contained_in(tier3, tiers["Repair"], ["rp"])
+        is_v = tier3.mask("v")
+        tiers["DFauto (English)"] = tgedit.relabel(
+            tier3, is_v & (rp_index != tgjoin.NOT_CONTAINED), "rp"
+        )
 
-        return textgrid_file
+        return tiers
 
-    def T4rp_T2rp(self, textgrid_file: textgrid) -> textgrid:
+    def T4rp_T2rp(self, tiers: Tiers) -> Tiers:
         """- Tier4に”rp”が入っている境界と同じ境界をTier2に作り、”rp”を入れる
 
         Returns:
-            _type_: textgrid
+            _type_: Tiers
         """
 
-        for t4start, t4end, t4label in textgrid_file.tiers[3].entries:
-            if t4label == "rp":
-                # if t4start <= t3start and t3end <= t4end:
-                textgrid_file.tiers[1].insertEntry(
-                    (t4start, t4end, "rp"),
-                    collisionMode="replace",
-                    collisionReportingMode="silence",
-                )
+        repair = tiers["Repair"]
+        phrases = tgedit.splice(tiers["Phrases"], repair.take(repair.mask("rp")))
+
         # 一番簡単な解決法は、処理追加の４番目を行ったあとに、最初と最後の空白を除いた空白に、
         # すべて"pr"を入れる、というものだと思います
-        lastend = 0
-        endindex = len(textgrid_file.tiers[1].entries) - 1
-        for i, item in enumerate(textgrid_file.tiers[1].entries):
-            start = item[0]
-            end = item[1]
-            label = item[2]
-
-            if lastend != 0 and start != lastend:
-                textgrid_file.tiers[1].insertEntry(
-                    (lastend, start, "pr"),
-                    collisionMode="replace",
-                    collisionReportingMode="silence",
-                )
-
-            if i != 0 and i != endindex:
-                if label == "":
-                    textgrid_file.tiers[1].insertEntry(
-                        (start, end, "pr"),
-                        collisionMode="replace",
-                        collisionReportingMode="silence",
-                    )
-            lastend = end
-        return textgrid_file
-
-    def vl_jp_modification(self, tg: textgrid) -> textgrid:
+        phrases = tgedit.fill_blanks(phrases, "pr")
+        tiers["Phrases"] = phrases
+        return tiers
+
+    def vl_jp_modification(self, tiers: Tiers) -> Tiers:
         """
         fluencyの処理の後に行う
         Tier5 jpがある範囲において、Tier3のv:labelをjp:labelに変更する
         長さが500ms以上の母音であれば、Tier3の”v”を”vl”に書き換える
         Args:
-            tg (textgrid): _description_
+            tiers (Tiers): _description_
         """
 
-        # Tier5に"jp"というラベルのついたintervalを検索する
-        jp_intervals = []
-        if "Japanese" in tg._tierDict.keys():
-            for interval in tg._tierDict["Japanese"].entries:
-                if interval.label == "jp":
-                    jp_intervals.append(interval)
+        # Tier3の各intervalを含む、Tier5の"jp"というラベルのついたintervalの番号
+        tier3 = tiers["DFauto (English)"]
+        if "Japanese" in tiers:
+            jp_index = tgjoin.contained_in(tier3, tiers["Japanese"], ["jp"])
+        else:
+            jp_index = np.full(len(tier3), tgjoin.NOT_CONTAINED)
 
         # Tier3に"v"というラベルのついたintervalのラベルを変更する
-        tier3 = tg._tierDict["DFauto (English)"]
-        for interval in tier3.entries:
-            for jp_interval in jp_intervals:
-                if (
-                    interval.start >= jp_interval.start
-                    and interval.end <= jp_interval.end
-                ):
-                    if interval.label == "v":
-                        tier3.insertEntry(
-                            (interval.start, interval.end, "jp"),
-                            collisionMode="replace",
-                            collisionReportingMode="silence",
-                        )
-
-            if interval.label == "v":
-                if (interval.end - interval.start) >= 0.5:
-                    tier3.insertEntry(
-                        (interval.start, interval.end, "vl"),
-                        collisionMode="replace",
-                        collisionReportingMode="silence",
-                    )
-
-        return tg
-
-    def calculate_duration(self, tg: textgrid) -> (float, float):
+        # jpの範囲内でも、500ms以上の母音はvlにする
+        is_v = tier3.mask("v")
+        tier3 = tgedit.relabel(tier3, is_v & (jp_index != tgjoin.NOT_CONTAINED), "jp")
+        tier3 = tgedit.relabel(tier3, is_v & ((tier3.end - tier3.start) >= 0.5), "vl")
+        tiers["DFauto (English)"] = tier3
+
+        return tiers
+
+    def calculate_duration(self, tiers: Tiers) -> (float, float):
         # 「Tier2の"pr"の直後に"fp"また"rp"が来る場合は、その"pr"の最後の"v"を"vf"としない。」
         # 言い換えると、
         # 「"pr"の最後の"v"を"vf"とするのは、そのあとが、"ps", "psb", また最終行のみとする。」
-        total_v_entries = []
-        max_and_min_in_prs = []
-        max_and_min_in_PitRangeAv = []
-        max_and_min_in_IntRangeAv = []
-        undefined = 0
-
-        v_entries = []
-        for l3index, v in enumerate(tg._tierDict["DFauto (English)"].entries):
-            dfeng_entry = v
-            is_v = False
-            is_inPR = False
-
-            # 空白は無視
-            if dfeng_entry.label == "":
-                continue
-
-            # labelがvかvfの場合
-            if dfeng_entry.label in ["v", "vf"]:
-                is_v = True
-
-            for l2index, ph_entry in enumerate(tg._tierDict["Phrases"].entries):
-                is_nextl2_fp = False
-
-                # Tier2 Phrases で　PRの開始と終了を取得する pr_start, pr_end,
-                if ph_entry.label == "pr":
-                    pr_start = ph_entry.start
-                    pr_end = ph_entry.end
-
-                    # l2indexがlen(tg._tierDict["Phrases"].entries)-1ではないとき
-                    if l2index != len(tg._tierDict["Phrases"].entries):
-                        if tg._tierDict["Phrases"].entries[l2index + 1].label == "fp":
-                            is_nextl2_fp = True
-
-                    if pr_start <= dfeng_entry.start and dfeng_entry.end <= pr_end:
-                        is_inPR = True
-                        break
-
-            # Pitch用の計算###########################
-            f0 = tg._tierDict["Pitch"].entries[l3index].label
-
-            # Intensity用の計算########################
-            dB = tg._tierDict["Intensity"].entries[l3index].label
-
-            # f0が--undefined--だった場合、一つ前のPitch_PPD_validを無効にする
-            if f0 == "--undefined--" and l3index != 0:
-                Mel = "--undefined--"
-                v_entries[-1]["Pitch_PPD_valid"] = False
-                undefined += 1
-            else:
-                Mel = 2595 * math.log10(1 + float(f0) / 700)
-
-            dict_entry = {
-                "start": dfeng_entry.start,
-                "end": dfeng_entry.end,
-                "duration": dfeng_entry.end - dfeng_entry.start,
-                "duration_valid": True,
-                "others_valid": True,
-                "is_inPR": is_inPR,
-                "is_lastv_inPR": False,
-                "is_nextl2_fp": is_nextl2_fp,
-                "dB": float(dB),
-                "is_v": is_v,
-                "f0": f0,
-                "Mel": Mel,
-            }
-
-            v_entries.append(dict_entry)
+        # 空白以外のTier3のintervalを1つの母音として、母音ごとの値を配列で持つ
+        tier3 = tiers["DFauto (English)"]
+        l3index = np.flatnonzero(~tier3.mask(""))
+        start = tier3.start[l3index]
+        end = tier3.end[l3index]
+        duration = end - start
+        n = len(l3index)
+        position = np.arange(n)
+
+        # labelがvかvfの場合
+        is_v = tier3.mask("v", "vf")[l3index]
+
+        # 母音を含むTier2の"pr"の番号
+        phrases = tiers["Phrases"]
+        pr_index = tgjoin.contained_in(tier3, phrases, ["pr"])[l3index]
+        is_inPR = pr_index != tgjoin.NOT_CONTAINED
+        # Tier2 prの次がfpかどうか
+        ph_next_fp = np.append(phrases.mask("fp")[1:], False)
+        is_nextl2_fp = is_inPR & ph_next_fp[pr_index]
+
+        # f0が--undefined--だった場合(最初のintervalを除く)はMelをNaNにする
+        undefined, Mel, dB = _duration_values(tiers, l3index, pr_index)
 
         # Tier2 pr 内の最後のTier3vの判定を追加する
-        for l2index, ph_entry in enumerate(tg._tierDict["Phrases"].entries):
-            # Tier2 Phrases で　PRの開始と終了を取得する pr_start, pr_end,
-            if ph_entry.label == "pr":
-                pr_start = ph_entry.start
-                pr_end = ph_entry.end
-                last_index = None
-                for i in range(0, len(v_entries)):
-                    if (
-                        pr_start <= v_entries[i]["start"]
-                        and v_entries[i]["end"] <= pr_end
-                        and v_entries[i]["is_v"]
-                    ):
-                        last_index = i
-
-                if last_index is not None:
-                    v_entries[last_index]["is_lastv_inPR"] = True
-
-        # 絶対値と平均を取得していく
-        for i in range(0, len(v_entries)):
-            # vじゃなかったら計算対象から外す
-            if v_entries[i]["is_v"] == False:
-                v_entries[i]["duration_valid"] = False
-                v_entries[i]["others_valid"] = False
-                if i > 0:
-                    # 前のペアも計算対象から外す
-                    v_entries[i - 1]["duration_valid"] = False
-
-            # Tier2のPR内でなかった場合
-            if v_entries[i]["is_inPR"] == False:
-                # 計算対象から外す
-                v_entries[i]["duration_valid"] = False
-                v_entries[i]["others_valid"] = False
-
-            # PR内の最後のvだった場合、
-            if i > 0 and v_entries[i]["is_lastv_inPR"] == True:
-                # durtion_validをFalseにする
-                v_entries[i]["duration_valid"] = False
-
-                # もし次がfpのpr内の最後のvじゃなかったら
-                if (
-                    i > 0
-                    and v_entries[i]["is_nextl2_fp"] == False
-                    and v_entries[i - 1]["is_inPR"] == True
-                ):
-                    # さらにもう１つ前のduration_validをFalseにする
-                    v_entries[i - 1]["duration_valid"] = False
-
-                    # others_validをFalseにする
-                    v_entries[i]["others_valid"] = False
-
-            if i == len(v_entries) - 1:
-                # 最後の一つ前から最後までの範囲を無効にする
-                v_entries[i - 1]["duration_valid"] = False
-                v_entries[i]["duration_valid"] = False
-
-                # others_validは最後のみ無効にする
-                v_entries[i]["others_valid"] = False
-
-            # 最後のデータではなかった場合
-            else:
-                # 隣り合う母音(Pair)の長さの差（絶対値）
-                v_entries[i]["abs"] = abs(
-                    v_entries[i + 1]["duration"] - v_entries[i]["duration"]
-                )
-                # 隣り合う母音(Pair)の長さの平均
-                v_entries[i]["avg"] = (
-                    v_entries[i + 1]["duration"] + v_entries[i]["duration"]
-                ) / 2
-
-                # absをabgで割ったもの
-                v_entries[i]["abs_divided_by_avg"] = (
-                    v_entries[i]["abs"] / v_entries[i]["avg"]
-                )
-                # 隣り合うMelの長さの差（絶対値）
-                try:
-                    v_entries[i]["abs_Mel"] = abs(
-                        v_entries[i + 1]["Mel"] - v_entries[i]["Mel"]
-                    )
-                except TypeError:
-                    pass
-
-                # 隣り合うdBの差(絶対値)
-                v_entries[i]["abs_dB"] = abs(
-                    float(v_entries[i + 1]["dB"]) - float(v_entries[i]["dB"])
-                )
-
-        for item in v_entries:
-            total_v_entries.append(item)
-
-        # absにNaNがある行を削除
-        df = pd.DataFrame(total_v_entries).dropna(subset=["abs"])
-
-        # print(df)
-        # "duration_valid"がTrueのみのものを抽出する
-        duration_df = df[df["duration_valid"] == True]
+        is_lastv_inPR = np.zeros(n, dtype=bool)
+        candidate = np.flatnonzero(is_v & is_inPR)[::-1]
+        _, last = np.unique(pr_index[candidate], return_index=True)
+        is_lastv_inPR[candidate[last]] = True
+
+        # 計算対象にするかどうか
+        # vじゃないか、Tier2のPR内でなかった場合は計算対象から外す
+        duration_valid = is_v & is_inPR
+        others_valid = is_v & is_inPR
+        # vじゃなかったら前のペアも計算対象から外す
+        duration_valid[:-1] &= is_v[1:]
+        # PR内の最後のvだった場合(最初のintervalは除く)はdurtion_validをFalseにする
+        lastv = is_lastv_inPR & (position > 0)
+        duration_valid &= ~lastv
+        # もし次がfpのpr内の最後のvじゃなかったら、さらにもう１つ前のduration_validと、
+        # others_validをFalseにする
+        prev_inPR = np.zeros(n, dtype=bool)
+        prev_inPR[1:] = is_inPR[:-1]
+        lastv_pair = lastv & ~is_nextl2_fp & prev_inPR
+        duration_valid[:-1] &= ~lastv_pair[1:]
+        others_valid &= ~lastv_pair
+        # 最後の一つ前から最後までの範囲を無効にする。others_validは最後のみ無効にする
+        duration_valid[-2:] = False
+        others_valid[-1:] = False
+
+        # 最後の母音には次の母音とのペアがないので、ペアの値は最後以外の母音について求める
+        if n <= 1:
+            raise ValueError("Tier3の母音が2つ未満")
+        pair = slice(0, n - 1)
+        # 隣り合う母音(Pair)の長さの差（絶対値）
+        abs_duration = np.abs(np.diff(duration))
+        # 隣り合う母音(Pair)の長さの平均
+        avg = (duration[1:] + duration[:-1]) / 2
+        # absをabgで割ったもの
+        abs_divided_by_avg = abs_duration / avg
+        # 隣り合うMelの長さの差（絶対値）。--undefined--を含むペアはNaN
+        abs_Mel = np.abs(np.diff(Mel))
+        has_abs_Mel = ~undefined[:-1] & ~undefined[1:]
+        # 隣り合うdBの差(絶対値)
+        abs_dB = np.abs(np.diff(dB))
+
+        duration_valid = duration_valid[pair]
+        others_valid = others_valid[pair]
 
-        nPVI = duration_df["abs_divided_by_avg"].sum() / len(duration_df) * 100
-        nPVIn = len(duration_df)
+        # "duration_valid"がTrueのみのものを抽出する
+        nPVI = (
+            pd.Series(abs_divided_by_avg[duration_valid]).sum()
+            / np.count_nonzero(duration_valid)
+            * 100
+        )
+        nPVIn = int(np.count_nonzero(duration_valid))
         self.nPVI = nPVI
         self.nPVIn = nPVIn
 
-        # absにNaNがある行を削除
-        df = pd.DataFrame(total_v_entries).dropna(subset=["abs"])
         # "others_valid"がTrueのみのものを抽出する
-        others_df = df[df["others_valid"] == True]
+        # Melに--undefined--が1つでもあると、元の表ではMelの列が文字列と数値の混在(object)になり、
+        # pandasの集計方法が変わるので、それに合わせる
+        mel_dtype = object if undefined.any() else float
+        others_duration = pd.Series(duration[pair][others_valid])
+        others_dB = pd.Series(dB[pair][others_valid])
         # Pitch #########################################################
         # nVarPco : 母音のピッチの標準偏差を平均で割ったものに100をかけたもの。
         # ”vf”, ”fp”, “rp”, “vl”, “jp”, “--undefined—"を除く
-        dfmel = others_df[others_df["Mel"] != "--undefined--"]["Mel"]
+        dfmel = pd.Series(
+            Mel[pair][others_valid & ~undefined[pair]].astype(mel_dtype),
+            dtype=mel_dtype,
+        )
         nVarPco = dfmel.std() / dfmel.mean() * 100
         self.nVarPco = nVarPco
 
@@ -874,72 +678,47 @@ class tgdata:
         self.PitAllAv = PitAllAv
 
         # nVarDco 母音の長さの標準偏差を平均で割ったものに100をかけたもの。
-        nVarDco = others_df["duration"].std() / others_df["duration"].mean() * 100
+        nVarDco = others_duration.std() / others_duration.mean() * 100
         self.nVarDco = nVarDco
         # nVarDcon上記3．で、nVarcoの計算に使われた”v”の数。
-        nVarDcon = len(others_df)
+        nVarDcon = len(others_duration)
         self.nVarDcon = nVarDcon
         # DurAllAv 全ての”v”（”vf”は除く）の長さの平均。
-        DurAllAv = others_df["duration"].mean()
+        DurAllAv = others_duration.mean()
         self.DurAllAv = DurAllAv
 
         # Intensity #####################################################
         # nVarIco : 母音のIntensityの標準偏差を平均で割ったものに100をかけたもの。
         # ”vf”, ”fp”, “rp”, “vl”, “jp”を除く。
-        nVarIco = others_df["dB"].std() / others_df["dB"].mean() * 100
+        nVarIco = others_dB.std() / others_dB.mean() * 100
         self.nVarIco = nVarIco
-        nVarIcon = len(others_df)
+        nVarIcon = len(others_duration)
         self.nVarIcon = nVarIcon
 
-        IntAllAv = others_df["dB"].mean()
+        IntAllAv = others_dB.mean()
         self.IntAllAv = IntAllAv
         #################################################################
 
-        others_df = df[df["others_valid"] == True]
-
-        # Tier2 pr毎に最小値と最大値を保存する
-        for l2index, ph_entry in enumerate(tg._tierDict["Phrases"].entries):
-            if ph_entry.label == "pr":
-                pr_start = ph_entry.start
-                pr_end = ph_entry.end
-                last_index = None
-                df_vent = others_df[
-                    (others_df["start"] >= pr_start) & (others_df["end"] <= pr_end)
-                ]
-                # print(df_vent)
-
-                # pr毎に最小値と最大値を保存する
-                # pr内に有効なvが無い場合は対象としない
-                if len(df_vent):
-                    # df_vent = df_vent[df_vent["is_DurRangeAv_target"] == True]
-
-                    # vが１つしかない場合はターゲットから外す
-                    if len(df_vent) > 1:
-                        max_and_min_in_prs.append(
-                            {
-                                "max": df_vent["duration"].max(),
-                                "min": df_vent["duration"].min(),
-                            }
-                        )
-
-                    df_vent = df_vent[df_vent["Mel"] != "--undefined--"]
-
-                    # vが１つしかない場合はターゲットから外す
-                    if len(df_vent) > 1:
-                        max_and_min_in_PitRangeAv.append(
-                            {"max": df_vent["Mel"].max(), "min": df_vent["Mel"].min()}
-                        )
-
-                    # vが１つしかない場合はターゲットから外す
-                    if len(df_vent) > 1:
-                        max_and_min_in_IntRangeAv.append(
-                            {"max": df_vent["dB"].max(), "min": df_vent["dB"].min()}
-                        )
+        # Tier2 pr毎に最小値と最大値の差を求める
+        # 有効な母音は時間順に並んでいるので、同じprの母音は連続する
+        others_pr = pr_index[pair][others_valid]
+        dur_n, dur_range = tgstats.segment_ranges(
+            others_pr, duration[pair][others_valid]
+        )
+        # --undefined--を除く
+        defined = ~undefined[pair][others_valid]
+        pit_n, pit_range = tgstats.segment_ranges(
+            others_pr[defined], Mel[pair][others_valid][defined]
+        )
+        int_n, int_range = tgstats.segment_ranges(
+            others_pr[defined], dB[pair][others_valid][defined]
+        )
 
+        # pr内に有効なvが無い場合、vが１つしかない場合はターゲットから外す
         # DurRangeAv : Tier2の各”pr”の範囲内にあるTier3の”v”のピッチの最大値と最小値の差を出し、
         # それらを全てのprで平均する。”vf”, ”fp”, “rp”, “vl”, “jp”, “--undefined—"を除く。
 
-        dif_list = [x["max"] - x["min"] for x in max_and_min_in_prs]
+        dif_list = dur_range[dur_n > 1].tolist()
         DurRangeAv = sum(dif_list) / len(dif_list)
 
         self.DurRangeAv = DurRangeAv
@@ -947,38 +726,39 @@ class tgdata:
         # Pitch #####################################################################################################
         # PitRangeAv : Tier2の各”pr”の範囲内にあるTier3の”v”のピッチの最大値と最小値の差を出し、それらを全てのprで平均する。
         # ”vf”, ”fp”, “rp”, “vl”, “jp”, “--undefined—"を除く。
-        dif_list_PitRangeAv = [x["max"] - x["min"] for x in max_and_min_in_PitRangeAv]
+        dif_list_PitRangeAv = pit_range[pit_n > 1].tolist()
         PitRangeAv = sum(dif_list_PitRangeAv) / len(dif_list_PitRangeAv)
         self.PitRangeAv = PitRangeAv
 
         # Intensity #################################################################################################
         # ”vf”, ”fp”, “rp”, “vl”, “jp”,を除く。
-        dif_list_IntRangeAv = [x["max"] - x["min"] for x in max_and_min_in_IntRangeAv]
+        dif_list_IntRangeAv = int_range[int_n > 1].tolist()
         IntRangeAv = sum(dif_list_IntRangeAv) / len(dif_list_IntRangeAv)
         self.IntRangeAv = IntRangeAv
 
         # PPD　隣り合う母音の(Pair)の声の高さ(Pitch:Mel)の差の平均を出し、それをすべてのPairで平均
         # ppd = df["abs_Mel"].dropna().mean()
 
-        # absにNaNがある行を削除
-        df = pd.DataFrame(total_v_entries).dropna(subset=["abs"])
+        # PPDを求める隣り合う母音のペアがない
+        if not has_abs_Mel.any():
+            raise ValueError(
+                "Pitchが両方とも--undefined--でない隣り合う母音のペアがない"
+            )
 
         # "duration_valid"がTrueのみのものを抽出する
-        df_duration = df[df["duration_valid"] == True]
-
-        df_PPD = df_duration["abs_Mel"].dropna()
+        df_PPD = abs_Mel[duration_valid]
+        df_PPD = pd.Series(df_PPD[~np.isnan(df_PPD)])
         ppd = df_PPD.mean()
         self.PPD = ppd
         PPDn = len(df_PPD)
         self.PPDn = PPDn
         # undefinedの数
-        self.Undefined = undefined
+        self.Undefined = int(np.count_nonzero(undefined))
         #############################################################################################################
 
         # "duration_valid"がTrueのみのものを抽出する
-        df_duration = df[df["duration_valid"] == True]
-
-        df_pid = df_duration["abs_dB"].dropna()
+        df_pid = abs_dB[duration_valid]
+        df_pid = pd.Series(df_pid[~np.isnan(df_pid)])
         pid = df_pid.mean()
         self.PID = pid
         pidn = len(df_pid)
@@ -987,29 +767,97 @@ class tgdata:
         return
 
 
+def _mel(f0: str) -> float:
+    return 2595 * math.log10(1 + float(f0) / 700)
+
+
+def _duration_values(
+    tiers: Tiers,
+    l3index: np.ndarray,
+    pr_index: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """calculate_durationで使う、各母音のPitch(Mel)とIntensity(dB)
+
+    計算できない入力は、先に調べて問題を書いた ValueError を送出する
+
+    Returns:
+        (f0が--undefined--かどうか, Mel(--undefined--はNaN), dB)
+    """
+    tier3 = tiers["DFauto (English)"]
+    start = tier3.start[l3index]
+
+    # 最後のTier2が"pr"のとき、その中(またはprの外)の母音には次のTier2がない
+    phrases = tiers["Phrases"]
+    if len(phrases) and phrases.label_at(-1) == "pr":
+        hit = np.flatnonzero(
+            (pr_index == tgjoin.NOT_CONTAINED) | (pr_index == len(phrases) - 1)
+        )
+        if len(hit):
+            raise ValueError(
+                f"Tier2の最後のintervalがprで、{start[hit[0]]}の母音の次のTier2がない"
+            )
+
+    # 母音ごとの (ラベル, 値, 変換できたかどうか)
+    columns = {}
+    for name, number, convert in (("Pitch", 7, _mel), ("Intensity", 6, float)):
+        if name not in tiers:
+            raise ValueError(f"Tier{number}({name})がない")
+        tier = tiers[name]
+        if len(l3index) and l3index[-1] >= len(tier):
+            raise ValueError(f"Tier{number}({name})のintervalがTier3より少ない")
+        values, ok = tier.convert(convert)
+        codes = tier.codes[l3index]
+        columns[name] = (
+            np.asarray(tier.labels, dtype=object)[codes],
+            values[codes],
+            ok[codes],
+        )
+
+    f0, Mel, mel_ok = columns["Pitch"]
+    dB, dB_values, dB_ok = columns["Intensity"]
+
+    # --undefined--の母音は一つ前の母音とのペアも無効にするので、最初の母音は--undefined--にできない
+    undefined = (f0 == "--undefined--") & (l3index != 0)
+    if len(undefined) and undefined[0]:
+        raise ValueError(f"最初の母音({start[0]})のPitchが--undefined--")
+
+    for name, labels, ok in (
+        ("Pitch", f0, mel_ok | undefined),
+        ("Intensity", dB, dB_ok),
+    ):
+        hit = np.flatnonzero(~ok)
+        if len(hit):
+            raise ValueError(
+                f"{name}の値を数値に変換できない: {start[hit[0]]} {labels[hit[0]]!r}"
+            )
+
+    Mel[undefined] = np.nan
+    return undefined, Mel, dB_values
+
+
 def T2_delete_start_end(textgrid_file: textgrid) -> textgrid:
     ### 20230913 無効に ###
     # - Tier2の最初と最後に記号があったら消去する(Phonation Rateの計算前に実行する)
 
     print("この処理は20230913に無効に設定されています")
 
-    # if textgrid_file.tiers[1].entries[0].start == textgrid_file.minTimestamp:
-    #     textgrid_file.tiers[1].insertEntry(
+    # if textgrid_file._tierDict["Phrases"].entries[0].start == textgrid_file.minTimestamp:
+    #     textgrid_file._tierDict["Phrases"].insertEntry(
     #         (
-    #             textgrid_file.tiers[1].entries[0].start,
-    #             textgrid_file.tiers[1].entries[0].end,
+    #             textgrid_file._tierDict["Phrases"].entries[0].start,
+    #             textgrid_file._tierDict["Phrases"].entries[0].end,
     #             "",
     #         ),
     #         collisionMode="replace",
     #         collisionReportingMode="silence",
     #     )
 
-    # t2last = len(textgrid_file.tiers[1].entries) - 1
-    # if textgrid_file.tiers[1].entries[t2last].end == textgrid_file.maxTimestamp:
-    #     textgrid_file.tiers[1].insertEntry(
+    # t2last = len(textgrid_file._tierDict["Phrases"].entries) - 1
+    # if textgrid_file._tierDict["Phrases"].entries[t2last].end == textgrid_file.maxTimestamp:
+    #     textgrid_file._tierDict["Phrases"].insertEntry(
     #         (
-    #             textgrid_file.tiers[1].entries[t2last].start,
-    #             textgrid_file.tiers[1].entries[t2last].end,
+    #             textgrid_file._tierDict["Phrases"].entries[t2last].start,
+    #             textgrid_file._tierDict["Phrases"].entries[t2last].end,
     #             "",
     #         ),
     #         collisionMode="replace",
@@ -1019,7 +867,11 @@ def T2_delete_start_end(textgrid_file: textgrid) -> textgrid:
     # return textgrid_file
 
 
-def tg_check(textgrid_file_path: str) -> Tuple[bool, List[str]]:
+def tg_check(
+    textgrid_file_path: str,
+    textgrid_file: Optional[tgreader.TextgridArrays] = None,
+    timings: Optional[tgrules.RuleTimings] = None,
+) -> Tuple[bool, List[str]]:
     """_summary_
     自動チェック：10項目
     - Tier2:pr, ps, psb, fp以外の記号があることはない。
@@ -1035,6 +887,9 @@ def tg_check(textgrid_file_path: str) -> Tuple[bool, List[str]]:
 
     Args:
         textgrid_file_path (str): textgridファイルのファイルパス
+        textgrid_file (tgreader.TextgridArrays): 読み込み済みのtextgrid。
+            Noneの場合はtextgrid_file_pathから読み込む
+        timings (tgrules.RuleTimings): 指定するとチェック項目ごとの実行時間を記録する
 
     Returns:
         bool: チェックの成否 問題無しでTrue
@@ -1042,321 +897,648 @@ def tg_check(textgrid_file_path: str) -> Tuple[bool, List[str]]:
 
     try:
         result_message = "全てのチェックを通過しました"
-        error_messages = []
 
-        textgrid_file = textgrid.openTextgrid(
-            textgrid_file_path, includeEmptyIntervals=True
-        )
+        # Tier1(Nuclei)はチェックに使わないので読まない
+        if textgrid_file is None:
+            textgrid_file = tgreader.read_textgrid(textgrid_file_path, CHECK_TIERS)
+        else:
+            textgrid_file.load(CHECK_TIERS)
 
         # 20230913　削除ではなくチェックに
         # textgrid_file = T2_delete_start_end(textgrid_file)
-        # チェック：Tier2の最初と最後の境界に記号があることはない。
+        # チェック項目は tgrules.CHECK_RULES に順に並んでいる
+        error_messages = tgrules.run_rules(
+            tgrules.CHECK_RULES, textgrid_file_path, textgrid_file, timings
+        )
 
-        chk_flag = True
+        if error_messages:
+            return False, error_messages
 
-        if (
-            textgrid_file.tiers[1].entries[0].start == textgrid_file.minTimestamp
-            and textgrid_file.tiers[1].entries[0].label != ""
-        ):
-            label = textgrid_file.tiers[1].entries[0].label
-            _ = textgrid_file.tiers[1].entries[0].start
-            error_messages.append(
-                f"{textgrid_file_path} チェックエラー:TTier2の最初と最後の境界に記号があることはない。  "
-                + f" {_} "
-                + label
-            )
+        return True, result_message
+    except Exception as e:
+        return False, e.__str__()
 
-        t2last = len(textgrid_file.tiers[1].entries) - 1
-        if (
-            textgrid_file.tiers[1].entries[t2last].end == textgrid_file.maxTimestamp
-            and textgrid_file.tiers[1].entries[t2last].label != ""
-        ):
-            label = textgrid_file.tiers[1].entries[t2last].label
-            _ = textgrid_file.tiers[1].entries[t2last].start
-            error_messages.append(
-                f"{textgrid_file_path} チェックエラー:Tier2の最初と最後の境界に記号があることはない。  "
-                + f" {_} "
-                + label
+
+def result_row(tgd: tgdata) -> dict:
+    """マスターデータの1行分(duplicate以外)をJSONにできる形で取り出す"""
+    return tgd.metrics.as_row()
+
+
+def open_master_data() -> masterdata.MasterData:
+    """マスターデータのデータベースを開く
+
+    初めて作るときは、既存のExcelのマスターデータを取り込む
+    """
+    store = masterdata.MasterData(
+        masterdata.MASTER_DATA_DB, [key for key in ORDERITEM if key != "duplicate"]
+    )
+    if store.created:
+        if os.path.exists(masterdata.MASTER_DATA_XLSX):
+            store.import_excel(masterdata.MASTER_DATA_XLSX)
+        else:
+            print(f"Error: {masterdata.MASTER_DATA_XLSX} not found.")
+    return store
+
+
+def merge_shards() -> None:
+    """シャードごとの計算結果をマスターデータにまとめる
+
+    すべてのシャードがそろっていない場合は、何も追記せずにエラーを表示する
+    """
+    try:
+        partials = tgshard.collect(tgshard.SHARD_DIR)
+    except tgshard.ShardError as e:
+        for i in e.messages:
+            print(f"Error: {i}")
+        return
+
+    store = open_master_data()
+    try:
+        # 前回の merge で保存した後、シャードのファイルを移す前に止まった分は除く
+        rows, jobs = tgshard.unmerged(partials, store.conn)
+    except tgshard.ShardError as e:
+        for i in e.messages:
+            print(f"Error: {i}")
+        store.close()
+        return
+
+    # 全シャードの行を1回の実行として (ID, RECN) の順に保存する(重複の判定もここで行う)
+    # まとめた行の記録も同じトランザクションで行う
+    rows = master_rows(sorted(rows, key=masterdata.row_key))
+    store.upsert(rows, after=lambda conn: tgshard.record_merged(jobs, conn))
+    store.export_excel(masterdata.MASTER_DATA_XLSX, ORDERITEM)
+    store.close()
+    tgshard.archive(partials)
+    print(f"merged {len(partials)} shards ({len(rows)} rows)")
+
+
+def export_master_data() -> None:
+    """データベースの内容をExcelのマスターデータに書き出す"""
+    store = open_master_data()
+    store.export_excel(masterdata.MASTER_DATA_XLSX, ORDERITEM)
+    store.close()
+
+
+# tgbatch のワーカーごとに1つ作って使い回す
+_contour_cache: Optional[tgcontours.ContourCache] = None
+
+
+def _add_acoustic_tiers(paths: Tuple[str, str, str]) -> str:
+    global _contour_cache
+    if _contour_cache is None:
+        _contour_cache = tgcontours.ContourCache()
+    textgrid_path, wav_path, output_path = paths
+    contours = _contour_cache.contours(
+        wav_path, tgacoustic.CONTOURS_ANALYSIS, tgacoustic.contours
+    )
+    return tgacoustic.add_acoustic_tiers(
+        textgrid_path, wav_path, output_path, contours=contours
+    )
+
+
+def add_acoustic_tiers(wav_dir: str, workers: int = 1) -> None:
+    """./tgfiles のTextGridに、同じ名前のWAVから求めた Intensity と Pitch のTierを加える
+
+    IntentisyPitchAverageTiersAdd.praat と同じパラメータで、Praatを使わずに全ファイルを並列に処理する。
+    値は Praat で作ったTierと完全には一致しない(許容差は tgacoustic を参照)ので、
+    ./tgfiles のファイルは上書きせず、tgacoustic.ACOUSTIC_DIR に <名前>.acoustic.TextGrid として保存する。
+    このファイルを ./tgfiles に置いて処理しても、その行はマスターデータには入れない。
+    音声の解析結果は tgcontours にキャッシュするので、Tier3 の境界を直して実行し直したときは
+    解析はせず、intervalごとの平均を求め直すだけになる
+    """
+    from glob import glob
+
+    os.makedirs(tgacoustic.ACOUSTIC_DIR, exist_ok=True)
+    jobs = []
+    for filename in sorted(glob("./tgfiles/*.TextGrid")):
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        wav_path = os.path.join(wav_dir, stem + ".wav")
+        if not os.path.exists(wav_path):
+            print(f"Error: {wav_path} not found.")
+            continue
+        output_path = os.path.join(
+            tgacoustic.ACOUSTIC_DIR, stem + tgacoustic.ACOUSTIC_SUFFIX
+        )
+        jobs.append((filename, wav_path, output_path))
+
+    results = tgbatch.run_batch(
+        _add_acoustic_tiers,
+        jobs,
+        workers,
+        [os.path.getsize(wav_path) for _, wav_path, _ in jobs],
+    )
+    for (filename, _, _), result in zip(jobs, results):
+        if isinstance(result, tgbatch.Failure):
+            print(f"Error: {filename}: {result.message}")
+        else:
+            print(f"{result}: Intensity, Pitch")
+
+
+def _detect_filled_pauses(wav_path: str, **params) -> str:
+    global _contour_cache
+    if _contour_cache is None:
+        _contour_cache = tgcontours.ContourCache()
+    return tgfilled.detect_file(wav_path, cache=_contour_cache, **params)
+
+
+def _detect_nuclei(wav_path: str, **params) -> str:
+    global _contour_cache
+    if _contour_cache is None:
+        _contour_cache = tgcontours.ContourCache()
+    return tgnuclei.detect_file(wav_path, cache=_contour_cache, **params)
+
+
+def detect_nuclei(
+    wav_dir: str, workers: int = 1, filled_pauses: bool = True, **params
+) -> None:
+    """WAV_DIR のWAVから Nuclei と Phrases のTierを作り、同じ場所に <名前>.auto.TextGrid として保存する
+
+    batchrate.praat の代わりに、Praatを使わずに全ファイルを並列に処理する。
+    filled_pauses なら、batchrate.praat と同じく FilledPauses.praat の DFauto(と空の Repair,
+    Japanese)のTierも作る(tgfilled.detect_file)。どちらの場合も音声の解析結果は tgcontours に
+    キャッシュするので、閾値を変えて実行し直したときは解析をせず、Nuclei と Phrases も同じになる。
+    params は tgfilled.detect_file(filled_pauses でなければ tgnuclei.detect_file)に渡す
+    """
+    from glob import glob
+
+    wav_files = sorted(glob(os.path.join(wav_dir, "*.wav")))
+    detect = _detect_filled_pauses if filled_pauses else _detect_nuclei
+    results = tgbatch.run_batch(
+        functools.partial(detect, **params),
+        wav_files,
+        workers,
+        [os.path.getsize(wav_path) for wav_path in wav_files],
+    )
+    for wav_path, result in zip(wav_files, results):
+        if isinstance(result, tgbatch.Failure):
+            print(f"Error: {wav_path}: {result.message}")
+        else:
+            print(f"{wav_path}: {result}")
+
+
+# tgbatch のワーカーごとに1つ作って使い回す
+_textgrid_cache: Optional[tgcache.TextgridCache] = None
+
+
+def read_textgrid_bytes(filename: str) -> bytes:
+    """ファイルの内容を読む(textgrid_pipeline の読み込みの段)"""
+    with open(filename, "rb") as fd:
+        return fd.read()
+
+
+def compute_textgrid(
+    filename: str, raw: bytes, timed: bool = False, ledger_path: Optional[str] = None
+) -> tuple:
+    """TextGridをチェックして計算する(textgrid_pipeline の計算の段)
+
+    Args:
+        filename (str): ./tgfiles のTextGridのファイルパス
+        raw (bytes): ファイルの内容
+        timed (bool): Trueならチェック項目ごとの実行時間を記録する
+        ledger_path (str): 指定すると tgledger の台帳に処理の段階を記録する
+
+    Returns:
+        tuple: (結果, 保存する tgdata。チェックエラーのときは None)
+            結果は dict: filename, status(tgmanifest.STATUS_OK / STATUS_FAILED),
+            messages(チェックエラー), row(計算結果), destination_path(保存先),
+            timings(チェック項目ごとの実行時間の記録)
+    """
+    global _textgrid_cache
+    if _textgrid_cache is None:
+        # 内容が変わっていないファイルは前回の解析結果を使う
+        _textgrid_cache = tgcache.TextgridCache()
+
+    timings = tgrules.RuleTimings() if timed else None
+    # コピー先のファイルパスを設定
+    destination_path = filename.replace("./tgfiles", "./success")
+    result = {
+        "filename": filename,
+        "status": tgmanifest.STATUS_FAILED,
+        "messages": [],
+        "row": None,
+        "destination_path": destination_path,
+        "timings": [],
+        "ledger_path": ledger_path,
+    }
+    ledger = tgledger.open_ledger(ledger_path) if ledger_path else None
+
+    # ファイルは1回だけ読み込み、チェックと計算で同じものを使う
+    # Tierの構成が違うファイルは、Tierの中身を読む前にヘッダだけで除く
+    try:
+        document = _textgrid_cache.parse(
+            raw,
+            FLUENCY_TIERS,
+            lambda header: tgrules.prescan(filename, header, timings),
+        )
+    except tgrules.StructureError as e:
+        messages = e.messages
+    else:
+        ok, messages = tg_check(filename, document, timings)
+        if ok:
+            messages = []
+    if timings is not None:
+        result["timings"] = timings.records
+
+    if messages:
+        result["messages"] = messages
+        if ledger is not None:
+            ledger.mark(filename, tgledger.FAILED)
+        return result, None
+    if ledger is not None:
+        ledger.mark(filename, tgledger.CHECKED)
+    # tg_L4rp_to_L3rp(filename)
+
+    tgd = tgdata(filename, document)
+    result["row"] = result_row(tgd)
+    if ledger is not None:
+        ledger.mark(filename, tgledger.COMPUTED, result["row"])
+    return result, tgd
+
+
+def save_textgrid(filename: str, computed: tuple) -> dict:
+    """計算に成功したTextGridをsuccessディレクトリに移す(textgrid_pipeline の書き込みの段)
+
+    変更後のTextGridを保存し終わってから元のファイルを消す
+    """
+    result, tgd = computed
+    if tgd is None:
+        return result
+    ledger = (
+        tgledger.open_ledger(result["ledger_path"]) if result["ledger_path"] else None
+    )
+    tgd.save(result["destination_path"])
+    if ledger is not None:
+        ledger.mark(filename, tgledger.PERSISTED)
+    # shutil.copy2(filename, destination_path)
+    # shutil.move(filename, destination_path)
+    os.remove(filename)
+    if ledger is not None:
+        ledger.mark(filename, tgledger.MOVED)
+    result["status"] = tgmanifest.STATUS_OK
+    return result
+
+
+def master_rows(rows: List[dict]) -> List[dict]:
+    """マスターデータに入れる行(Praat で作った Intensity / Pitch のTierから求めた行)
+
+    tgacoustic で作ったTierから求めた行は Praat と値が一致しないので、計算結果のCSVにだけ残す
+    """
+    kept = []
+    for row in rows:
+        if row.get("tier_source") == tgacoustic.TIER_SOURCE_ACOUSTIC:
+            print(
+                f"{row['filename']}: tgacoustic で作ったTierの行なので、マスターデータに入れない"
             )
+        else:
+            kept.append(row)
+    return kept
 
-        # - 全体: Tier6, 7がない。
-        if textgrid_file.tiers.__len__() < 7:
-            error_messages.append(f"{textgrid_file_path} チェックエラー:- 全体: Tier6, 7がない。  ")
-            return False, error_messages
 
-        #  Tier2:pr, ps, psb, fp以外の記号があることはない。
-        for _, __, label in textgrid_file.tiers[1].entries:
-            if label not in ("pr", "ps", "psb", "fp", ""):
-                error_messages.append(
-                    f"{textgrid_file_path} チェックエラー:Tier2:pr, ps, psb, fp以外の記号があることはない  "
-                    + f" {_} "
-                    + label
-                )
-
-        # 4) チェック：Tier2: ２番目の境界内と、最後から２番目の境界内の間に空白の境界内があることはない
-        # （追加しました。新しい境界を作ったさいにprを入れるのを忘れたさいに起きるエラーです）。
-        for i, item in enumerate(textgrid_file.tiers[1].entries):
-            _ = item[0]
-            __ = item[1]
-            label = item[2]
-            if i == 0 or i == (len(textgrid_file.tiers[1].entries) - 1):
-                continue
-            if label == "":
-                error_messages.append(
-                    f"{textgrid_file_path} チェックエラー:Tier2: ２番目の境界内と、最後から２番目の境界内の間に空白の境界内があることはない  "
-                    + f" {_} "
-                    + label
-                )
-
-        # 5) チェック：Tier3: v以外の記号があることはない。
-        # (変更しました。後の処理で、「Tier2の境界がfpであるTier3のvをfpに変える。」
-        # 「Tier4にrpが入っている境界内の、Tier3のvをrpに置き換える。」を行いますので、
-        # この時点では、Tier3の全ての境界内の記号はvとなります。
-        for _, __, label in textgrid_file.tiers[2].entries:
-            if label not in ("v", ""):
-                error_messages.append(
-                    f"{textgrid_file_path} チェックエラー:Tier3:v以外の記号があることはない  "
-                    + f" {_} "
-                    + label
-                )
-
-        # - Tier4:rp以外の記号がある。
-        for _, __, label in textgrid_file.tiers[3].entries:
-            if label not in ("rp", ""):
-                error_messages.append(
-                    f"{textgrid_file_path} チェックエラー:Tier4:rp以外の記号がある。  "
-                    + f" {_} "
-                    + label
-                )
-        # Tier4:rpの境界が、 Tier2、ps, psb, fp内部にあることはありえない。
-        # Tier4:rpの左側の境界が、Tier2、ps, psb, fpの左側の境界と一致することはない（rpはポーズから始まらない）。
-        for t4start, t4end, t4label in textgrid_file.tiers[3].entries:
-            if t4label == "rp":
-                times = [t4start, t4end]
-                for t2start, t2end, t2label in textgrid_file.tiers[1].entries:
-                    if t2label in ("ps", "psb", "fp"):
-                        for time in times:
-                            if t2start < time < t2end:
-                                error_messages.append(
-                                    f"{textgrid_file_path} チェックエラー:Tier4:rpの境界が、 Tier2、ps, psb, fp内部にあることはありえない。  "
-                                    + f" {time} "
-                                    + t2label
-                                )
-                        if t2start == t4start:
-                            error_messages.append(
-                                f"{textgrid_file_path} チェックエラー:Tier4:rpの左側の境界が、Tier2、ps, psb, fpの左側の境界と一致することはない（rpはポーズから始まらない）  "
-                                + f" {t4start} "
-                                + t4label
-                            )
-
-                        if t4end == t2end:
-                            error_messages.append(
-                                f"{textgrid_file_path} チェックエラー:- Tier4:rpの右側の境界が、ps, psb, fpの右側の境界と一致することはない（rpはポーズで終わらない）。  "
-                                + f" {t4end} "
-                                + t4label
-                            )
-        # - Tier5:jp以外の記号がある。
-        for _, __, label in textgrid_file.tiers[4].entries:
-            if label not in ("jp", ""):
-                error_messages.append(
-                    f"{textgrid_file_path} チェックエラー:Tier5:jp以外の記号がある。  "
-                    + f" {_} "
-                    + label
-                )
-
-        # - Tier7:Pitchの値の異常値。。数値に変換できない
-        for _, __, label in textgrid_file.tiers[6].entries:
-            if label != "":
-                try:
-                    float(label)
-
-                except ValueError:
-                    error_messages.append(
-                        f"{textgrid_file_path} チェックエラー:Tier7:Pitchの値の異常値。数値に変換できない  "
-                        + f" {_} "
-                        + label
-                    )
-                    return False, error_messages
-
-        # - Tier7:Pitchの値の異常値。pitchの値がpitchの平均値の２分の１より低い値
-        pitlist = [float(x[2]) for x in textgrid_file.tiers[6].entries if x[2] != ""]
-        avg = sum(pitlist) / len(pitlist)
-
-        for _, __, label in textgrid_file.tiers[6].entries:
-            if label != "":
-                if float(label) < (avg / 2):
-                    error_messages.append(
-                        f"{textgrid_file_path} チェックエラー:Tier7:Pitchの値の異常値。pitchの値がpitchの平均値の２分の１より低い値  "
-                        + f" {_} "
-                        + label
-                    )
-
-        # - Tier7:Tier3とTier7の境界が一致していない。
-        pitlist = [float(x[2]) for x in textgrid_file.tiers[6].entries if x[2] != ""]
-        avg = sum(pitlist) / len(pitlist)
-
-        for i, item in enumerate(textgrid_file.tiers[2].entries):
-            _ = item.start
-            __ = item.end
-            label = item.label
-
-            # Tier3のラベルがある時
-            if label != "":
-                # Tier7とstart,endが一致し、かつTier7のラベルが空白ではない
-                if (
-                    _ == textgrid_file.tiers[6].entries[i].start
-                    and __ == textgrid_file.tiers[6].entries[i].end
-                    and textgrid_file.tiers[6].entries[i].label != ""
-                ):
-                    pass
-                else:
-                    error_messages.append(
-                        f"{textgrid_file_path} チェックエラー:Tier3とTier7の境界が一致していない  "
-                        + f" {_} "
-                        + label
-                    )
-                    break
-
-                t7label = textgrid_file.tiers[6].entries[i].label
-
-                try:
-                    float(t7label)
-
-                except ValueError:
-                    error_messages.append(
-                        f"{textgrid_file_path} チェックエラー:Tier7:Pitchの値の異常値。数値に変換できない  "
-                        + f" {_} "
-                        + label
-                    )
-                    break
+def deliver_rows(store: masterdata.MasterData, ledger: tgledger.JobLedger) -> int:
+    """元のファイルを消し終わり、まだ渡していない行をマスターデータに保存する。保存した行数を返す
 
-        if error_messages:
-            return False, error_messages
+    行は (ID, RECN) の順に保存し、処理し直したファイルの行は置き換える(master_rows の行だけ)。
+    台帳の「渡した」の記録も同じトランザクションで行う
+    """
+    delivered = ledger.undelivered()
+    rows = master_rows(sorted((row for _, row in delivered), key=masterdata.row_key))
+    return store.upsert(
+        rows,
+        after=lambda conn: ledger.mark_delivered(
+            [filename for filename, _ in delivered], conn
+        ),
+    )
+
+
+def textgrid_pipeline(
+    timed: bool = False, ledger_path: Optional[str] = None
+) -> tgpipeline.Pipeline:
+    """1つのTextGridをチェック・計算し、成功したらsuccessディレクトリに移す処理
+
+    読み込み・計算・書き込みを別のスレッドで重ねて行う。
+    tgbatch.run_batch に渡すと、ワーカープロセスごとにチャンクのファイルを処理する
+    """
+    return tgpipeline.Pipeline(
+        read_textgrid_bytes,
+        functools.partial(compute_textgrid, timed=timed, ledger_path=ledger_path),
+        save_textgrid,
+    )
 
-        return True, result_message
-    except Exception as e:
-        return False, e.__str__()
 
+def main(
+    timings: Optional[tgrules.RuleTimings] = None,
+    workers: int = 1,
+    shard: Optional[tgshard.ShardSpec] = None,
+):
+    """./tgfiles のTextGridを処理し、マスターデータに追記する
 
-def main():
+    Args:
+        timings (tgrules.RuleTimings): 指定するとチェック項目ごとの実行時間を記録する
+        workers (int): 並列に処理するプロセスの数。1ならこのプロセスで順に処理する
+        shard (tgshard.ShardSpec): 指定すると担当のファイルだけを処理し、
+            計算結果はマスターデータではなく tgshard.SHARD_DIR に書き出す(merge_shards でまとめる)
+    """
     from glob import glob
     import os
 
     # import shutil
 
-    if not os.path.exists("success"):
-        os.mkdir("success")
-
-    filelists = glob("./tgfiles/*.TextGrid")
+    # 複数のシャードが同時に作ることがあるので、既にあってもエラーにしない
+    os.makedirs("success", exist_ok=True)
 
-    dflist = []
-    for filename in filelists:
-        result, messages = tg_check(filename)
+    filelists = sorted(glob("./tgfiles/*.TextGrid"))
 
-        # エラーがあった場合は表示する
-        if result is False:
-            for i in messages:
-                print(i)
-            continue
-        # tg_L4rp_to_L3rp(filename)
+    # 内容もプログラムも変わっていないファイルは前回の計算結果を使う
+    # 処理の段階は台帳に記録し、途中で止まった場合は次の実行で続きから行う
+    if shard is None:
+        # 台帳はマスターデータと同じデータベースに置き、行の追記と一緒にコミットする
+        store = open_master_data()
+        manifest_path = tgmanifest.MANIFEST_FILE
+        ledger_path = masterdata.MASTER_DATA_DB
+        results_csv_path = masterdata.RESULTS_CSV
+    else:
+        filelists = [filename for filename in filelists if shard.contains(filename)]
+        os.makedirs(tgshard.SHARD_DIR, exist_ok=True)
+        manifest_path = shard.manifest_path(tgshard.SHARD_DIR)
+        ledger_path = shard.ledger_path(tgshard.SHARD_DIR)
+        results_csv_path = shard.results_csv_path(tgshard.SHARD_DIR)
+    manifest = tgmanifest.Manifest(manifest_path, CODE_VERSION)
+    ledger = tgledger.JobLedger(ledger_path)
+    # 計算結果はファイルごとに、終わった順にCSVに書き出す
+    results_csv = masterdata.ResultCsvWriter(
+        results_csv_path, [key for key in ORDERITEM if key != "duplicate"]
+    )
+
+    states = {filename: manifest.state(filename) for filename in filelists}
+
+    # 元のファイルを消した直後に止まったファイルと、保存した後に止まって
+    # 元のファイルが内容の違うファイルに置き換わったファイルは、行を渡すだけにする
+    for filename in ledger.filenames(tgledger.PERSISTED):
+        if not os.path.exists(filename) or (
+            filename in states and states[filename]["sha256"] != ledger.sha256(filename)
+        ):
+            ledger.mark(filename, tgledger.MOVED)
 
-        tgd = tgdata(filename)
+    # 前回までの実行で渡していない行は、同じ名前のファイルを登録し直す前に渡す
+    if shard is None:
+        deliver_rows(store, ledger)
+    else:
+        # merge_shards でまとめ終わった行は、計算結果に入れない
+        ledger.mark_merged(tgshard.merged_jobs(tgshard.SHARD_DIR, shard, ledger.token))
+    stages = ledger.register(
+        (filename, state["sha256"]) for filename, state in states.items()
+    )
+    # シャードでまとめていない行があるファイルは、まとめた後の実行で処理する
+    for filename in filelists:
+        if filename not in stages:
+            print(f"{filename} 前回の計算結果をまだまとめていないので、処理しない")
+    filelists = [filename for filename in filelists if filename in stages]
 
-        df = pd.DataFrame([tgd.__dict__])
-        dflist.append(df)
-        # 変更後のTextGridをsuccessディレクトリに保存する
-        # コピー先のファイルパスを設定
+    reused = {}
+    resumed = []
+    pending = []
+    for filename in filelists:
         destination_path = filename.replace("./tgfiles", "./success")
+        # 前回の実行で保存まで終わっていたファイルは、元のファイルを消すところから続ける
+        if stages[filename] in (tgledger.PERSISTED, tgledger.MOVED) and os.path.exists(
+            destination_path
+        ):
+            resumed.append(filename)
+            continue
+        entry = manifest.find(filename, states[filename])
+        # 前回チェックエラーだったファイルと、前回成功して保存済みのファイルは計算しない
+        if entry is not None and (
+            entry["status"] == tgmanifest.STATUS_FAILED
+            or (
+                os.path.exists(destination_path)
+                and tgmanifest.file_hash(destination_path) == entry["output_sha256"]
+            )
+        ):
+            reused[filename] = entry
+        else:
+            pending.append(filename)
+
+    def emit(i, result):
+        if isinstance(result, dict) and result["status"] == tgmanifest.STATUS_OK:
+            results_csv.write(result["row"])
+
+    # 計算が必要なファイルは、大きさで釣り合うように分けて並列に処理する
+    results = tgbatch.run_batch(
+        textgrid_pipeline(timings is not None, ledger_path),
+        pending,
+        workers,
+        [os.path.getsize(filename) for filename in pending],
+        emit,
+    )
+    results = dict(zip(pending, results))
+
+    # 結果の表示と記録はファイルの順に行う
+    for filename in filelists:
+        if filename in resumed:
+            row = ledger.row(filename)
+            os.remove(filename)
+            ledger.mark(filename, tgledger.MOVED)
+            results_csv.write(row)
+            manifest.record_ok(
+                filename,
+                states[filename],
+                row,
+                filename.replace("./tgfiles", "./success"),
+            )
+            continue
 
-        # 成功したものはファイルを移動
-        tgd.save(destination_path)
-        # shutil.copy2(filename, destination_path)
-        # shutil.move(filename, destination_path)
-        os.remove(filename)
+        if filename in reused:
+            entry = reused[filename]
+            # 前回チェックエラーだったファイルはエラーを表示するだけ
+            if entry["status"] == tgmanifest.STATUS_FAILED:
+                for i in entry["messages"]:
+                    print(i)
+                ledger.mark(filename, tgledger.FAILED)
+                continue
+            # 行を記録してから元のファイルを消す
+            ledger.mark(filename, tgledger.PERSISTED, entry["row"])
+            os.remove(filename)
+            ledger.mark(filename, tgledger.MOVED)
+            results_csv.write(entry["row"])
+            continue
 
-    filename = "FluencyProsodyMasterData.xlsx"
+        result = results[filename]
+        if isinstance(result, tgbatch.Failure):
+            print(f"{filename} {result.message}")
+            continue
+        if timings is not None:
+            timings.records.extend(result["timings"])
 
-    if os.path.exists(filename):
-        df_excelfile = pd.read_excel(filename)
-        dflist.append(df_excelfile)
+        # エラーがあった場合は表示する
+        if result["status"] == tgmanifest.STATUS_FAILED:
+            for i in result["messages"]:
+                print(i)
+            manifest.record_failed(filename, states[filename], result["messages"])
+            continue
 
-    else:
-        print(f"Error: {filename} not found.")
-
-    acum_df = pd.concat(dflist)
-
-    # カラム名[ID, RECN]で昇順に並び替えを行う
-    acum_df_sorted = acum_df.sort_values(by=["ID", "RECN"], ascending=True)
-
-    # 重複する行に新しいカラム"duplicate"を追加し、値を1に設定する
-    acum_df_sorted["duplicate"] = acum_df_sorted.duplicated(
-        subset=["ID", "RECN"], keep=False
-    ).astype(int)
-
-    # 並び順の整え
-    orderitem = [
-        "filename",
-        "ID",
-        "RECN",
-        "Date",
-        "nsyll",
-        "silenttot",
-        "silenttot_ps",
-        "silenttot_psb",
-        "speakingtot",
-        "asd",
-        "nsounding",
-        "npause",
-        "npause_ps",
-        "npause_psb",
-        "nrFP",
-        "tFP",
-        "nrRP",
-        "tRP",
-        "durs",
-        "SR",
-        "SRP",
-        "AR",
-        "ARP",
-        "MLoR",
-        "PhonRat",
-        "SPauseFreq",
-        "SPauseDur",
-        "FPauseFreq",
-        "FPauseDur",
-        "RpFreq",
-        "RpDur",
-        "SBPauseFreq",
-        "SBPauseDur",
-        "SWPauseFreq",
-        "SWPauseDur",
-        "nPVI",
-        "nPVIn",
-        "nVarDco",
-        "nVarDcon",
-        "DurAllAv",
-        "DurRangeAv",
-        "PPD",
-        "PPDn",
-        "nVarPco",
-        "nVarPcon",
-        "PitAllAv",
-        "PitRangeAv",
-        "Undefined",
-        "PID",
-        "PIDn",
-        "nVarIco",
-        "nVarIcon",
-        "IntAllAv",
-        "IntRangeAv",
-        "duplicate",
-    ]
+        manifest.record_ok(
+            filename, states[filename], result["row"], result["destination_path"]
+        )
 
-    acum_df_sorted = acum_df_sorted[orderitem]
+    manifest.save()
+    results_csv.close()
+
+    if shard is not None:
+        # 元のファイルを消し終わったファイルの行を渡す(前回の実行で止まった分も含む)
+        delivered = ledger.undelivered()
+        delivered_files = [filename for filename, _ in delivered]
+        rows = sorted((row for _, row in delivered), key=masterdata.row_key)
+        # シャードの計算結果は、すべてのシャードが終わってから merge_shards でまとめる
+        # まとめるまでは渡したことにしないので、まとめる前に実行し直しても前回の行は残る
+        tgshard.write_partial(
+            tgshard.SHARD_DIR,
+            shard,
+            rows,
+            [(filename, ledger.sha256(filename)) for filename in delivered_files],
+            sorted(set(filelists) | set(delivered_files)),
+            CODE_VERSION,
+            ledger.token,
+        )
+        ledger.close()
+        if timings is not None:
+            print(timings.report())
+        print(f"finished shard {shard}")
+        return
 
-    acum_df_sorted.to_excel(filename, float_format="%.2f", index=False)
+    # 元のファイルを消し終わったファイルの行をデータベースに保存する。Excelは --export で書き出す
+    deliver_rows(store, ledger)
+    ledger.close()
+    store.close()
+    if timings is not None:
+        print(timings.report())
     print("finished")
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="TextGridは処理せず、Excelのマスターデータを書き出すだけ"
+        "(TextGridの処理ではデータベースに保存し、Excelは書き出さない)",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="チェック項目ごとの実行時間と、時間がかかったファイルを表示する",
+    )
+    parser.add_argument(
+        "--shard",
+        help="k/N: N個に分けたうちのk番目(1始まり)のファイルだけを処理する",
+    )
+    parser.add_argument(
+        "--shard-key",
+        choices=tgshard.SHARD_KEYS,
+        default="filename",
+        help="シャードの分け方(ファイル名またはIDのハッシュ)",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="シャードごとの計算結果をマスターデータにまとめる",
+    )
+    parser.add_argument(
+        "--acoustic-tiers",
+        metavar="WAV_DIR",
+        help="./tgfiles のTextGridに、WAV_DIRの同じ名前のWAVから Intensity と Pitch のTierを加え、"
+        f"{tgacoustic.ACOUSTIC_DIR} に <名前>{tgacoustic.ACOUSTIC_SUFFIX} として保存する"
+        "(Praat で作ったTierとは値が完全には一致しないので、その行はマスターデータに入れない)",
+    )
+    parser.add_argument(
+        "--detect-nuclei",
+        metavar="WAV_DIR",
+        help="WAV_DIRのWAVから Nuclei, Phrases と有声休止(fp)の DFauto のTierを作り、"
+        "<名前>.auto.TextGrid に保存する",
+    )
+    parser.add_argument(
+        "--silence-threshold",
+        type=float,
+        default=tgnuclei.SILENCE_THRESHOLD_DB,
+        help="--detect-nuclei: Silence threshold (dB)",
+    )
+    parser.add_argument(
+        "--minimum-dip",
+        type=float,
+        default=tgnuclei.MINIMUM_DIP_NEAR_PEAK,
+        help="--detect-nuclei: Minimum dip near peak (dB)",
+    )
+    parser.add_argument(
+        "--minimum-pause",
+        type=float,
+        default=tgnuclei.MINIMUM_PAUSE_DURATION,
+        help="--detect-nuclei: Minimum pause duration (s)",
+    )
+    parser.add_argument(
+        "--pre-processing",
+        choices=tgnuclei.PRE_PROCESSING,
+        default=tgnuclei.PRE_PROCESSING_NONE,
+        help="--detect-nuclei: Pre-processing",
+    )
+    parser.add_argument(
+        "--language",
+        choices=tgfilled.LANGUAGES,
+        default=tgfilled.LANGUAGE_ENGLISH,
+        help="--detect-nuclei: Language(有声休止の判定の式)",
+    )
+    parser.add_argument(
+        "--filled-pause-threshold",
+        type=float,
+        default=tgfilled.FILLED_PAUSE_THRESHOLD,
+        help="--detect-nuclei: Filled pause threshold",
+    )
+    parser.add_argument(
+        "--save-table",
+        action="store_true",
+        help="--detect-nuclei: 音節ごとの特徴を <名前>.auto.Table に保存する",
+    )
+    parser.add_argument(
+        "--no-filled-pauses",
+        action="store_true",
+        help="--detect-nuclei: 有声休止を判定せず、Nuclei と Phrases のTierだけを作る",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="並列に処理するプロセスの数(0ならCPUの数)",
+    )
+    args = parser.parse_args()
+
+    if args.export:
+        export_master_data()
+    elif args.merge:
+        merge_shards()
+    elif args.acoustic_tiers:
+        add_acoustic_tiers(args.acoustic_tiers, args.workers or os.cpu_count())
+    elif args.detect_nuclei:
+        params = dict(
+            silence_threshold=args.silence_threshold,
+            minimum_dip_near_peak=args.minimum_dip,
+            minimum_pause_duration=args.minimum_pause,
+            pre_processing=args.pre_processing,
+        )
+        if not args.no_filled_pauses:
+            params.update(
+                language=args.language,
+                filled_pause_threshold=args.filled_pause_threshold,
+                save_features=args.save_table,
+            )
+        detect_nuclei(
+            args.detect_nuclei,
+            args.workers or os.cpu_count(),
+            not args.no_filled_pauses,
+            **params,
+        )
+    else:
+        main(
+            tgrules.RuleTimings() if args.timings else None,
+            args.workers or os.cpu_count(),
+            tgshard.ShardSpec.parse(args.shard, args.shard_key) if args.shard else None,
+        )
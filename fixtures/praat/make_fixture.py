@@ -0,0 +1,117 @@
+"""tgreference.py で比べる Praat の出力(このディレクトリのファイル)を作る
+
+praat-parselmouth(Praat 6.1.38 を含む)が要る。FluencyProsody.py などは使わない。
+
+    pip install praat-parselmouth
+    python fixtures/praat/make_fixture.py
+
+1. Praat の SpeechSynthesizer(eSpeak)で短い英語の発話を合成し、speech.wav にする
+   (録音ではない。区切りの無音と、ゆっくり言った "erm" を入れ、弱い雑音を加える)
+2. このリポジトリの batchrate.praat(FilledPauses.praat も呼ぶ)を wavfiles/speech.wav に対して
+   そのまま実行し、speech.auto.TextGrid を作る(パラメータはフォームの既定値)
+3. speech.auto.TextGrid に IntentisyPitchAverageTiersAdd.praat で Intensity / Pitch のTierを加え、
+   speech.praat.TextGrid として保存する
+4. speech.auto.TextGrid に FilledPauses.praat を Save_Table を yes にして実行し、音節ごとの特徴の表を
+   speech.auto.Table として保存する(batchrate.praat で Table を選んだときと同じ形)
+"""
+
+import os
+import shutil
+import tempfile
+import wave
+
+import numpy as np
+import parselmouth
+from parselmouth.praat import call, run_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(os.path.dirname(HERE))
+NAME = "speech"
+RATE = 16000
+# 雑音の乱数の種と大きさ(最大振幅 0.5 に対して)
+SEED = 20230709
+NOISE = 3e-4
+
+# (文, 1分あたりの語数, 後の無音の秒数)
+UTTERANCES = [
+    ("Well, I think the train was late.", 160, 0.6),
+    ("erm", 50, 0.1),
+    ("and then we walked home together.", 160, 0.3),
+]
+LEADING_SILENCE = 0.3
+
+
+def synthesize(path: str) -> None:
+    synthesizer = call("Create SpeechSynthesizer", "English (Great Britain)", "Female1")
+    parts = [np.zeros(int(LEADING_SILENCE * RATE))]
+    for text, words_per_minute, silence in UTTERANCES:
+        call(
+            synthesizer,
+            "Speech output settings",
+            RATE,
+            0.01,
+            1.0,
+            1.0,
+            words_per_minute,
+            "IPA",
+        )
+        sound = call(synthesizer, "To Sound", text, "no")
+        if isinstance(sound, list):
+            sound = sound[0]
+        parts += [sound.values[0], np.zeros(int(silence * RATE))]
+    x = np.concatenate(parts)
+    x = 0.5 * x / np.abs(x).max()
+    x += np.random.default_rng(SEED).normal(0.0, NOISE, len(x))
+    pcm = np.round(np.clip(x, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as fd:
+        fd.setnchannels(1)
+        fd.setsampwidth(2)
+        fd.setframerate(RATE)
+        fd.writeframes(pcm.tobytes())
+
+
+def main() -> None:
+    wav_path = os.path.join(HERE, NAME + ".wav")
+    synthesize(wav_path)
+
+    with tempfile.TemporaryDirectory() as work:
+        # batchrate.praat は スクリプトと同じ場所の ./wavfiles/*.wav を読み、同じ場所に保存する
+        for script in ("batchrate.praat", "FilledPauses.praat"):
+            shutil.copy(os.path.join(REPO, script), work)
+        os.mkdir(os.path.join(work, "wavfiles"))
+        shutil.copy(wav_path, os.path.join(work, "wavfiles"))
+        run_file(
+            os.path.join(work, "batchrate.praat"),
+            "None",
+            -40,
+            2,
+            0.25,
+            True,
+            "English",
+            2.0,
+            True,
+        )
+        auto_path = os.path.join(HERE, NAME + ".auto.TextGrid")
+        shutil.copy(os.path.join(work, "wavfiles", NAME + ".auto.TextGrid"), auto_path)
+
+    sound = parselmouth.Sound(wav_path)
+    textgrid = parselmouth.read(auto_path)
+    run_file(
+        [sound, textgrid], os.path.join(REPO, "IntentisyPitchAverageTiersAdd.praat")
+    )
+    textgrid.save(os.path.join(HERE, NAME + ".praat.TextGrid"))
+
+    textgrid = parselmouth.read(auto_path)
+    selected = run_file(
+        [sound, textgrid],
+        os.path.join(REPO, "FilledPauses.praat"),
+        "English",
+        2.0,
+        True,
+    )
+    (table,) = [item for item in selected if item.class_name == "Table"]
+    call(table, "Save as tab-separated file", os.path.join(HERE, NAME + ".auto.Table"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""マスターデータ(計算結果)の保存先
+
+計算結果は SQLite のデータベースに1ファイル1行で追記し、(ID, RECN) の索引で
+重複の判定をする。追記したときは、追記した行と同じ (ID, RECN) の行だけ
+duplicate を更新するので、それまでの行を読み直したり書き直したりしない。
+処理し直したファイル(同じファイル名)の行は、前の行と置き換える(upsert)。
+Excelファイル(FluencyProsodyMasterData.xlsx)はデータベースから書き出すだけのものになり、
+--export と --merge のときだけ書き出す。
+
+並び順は以前のExcelの更新方法と同じく、ID, RECN の昇順で、同じ (ID, RECN) の中では
+新しい実行の行が先、同じ実行の中では追加した順になる。
+"""
+
+import csv
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Callable, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+MASTER_DATA_DB = "FluencyProsodyMasterData.sqlite3"
+MASTER_DATA_XLSX = "FluencyProsodyMasterData.xlsx"
+# ファイルごとの計算結果を、計算が終わった順に追記するCSV
+RESULTS_CSV = "FluencyProsodyResults.csv"
+
+# (ID, RECN) はファイル名の先頭3文字ずつ
+KEY_COLUMNS = ("ID", "RECN")
+KEY_WIDTH = 3
+
+
+def _quote(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+
+def normalize_key(value) -> Optional[str]:
+    """ID, RECN を文字列にそろえる
+
+    Excelから読み込んだ値は数値になっていて先頭の0が消えているので、3桁に戻す
+    """
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        if value.is_integer():
+            value = int(value)
+    if isinstance(value, int):
+        return str(value).zfill(KEY_WIDTH)
+    return str(value)
+
+
+def row_key(row: dict) -> tuple:
+    """行の (ID, RECN)。行を並べるときに使う"""
+    return tuple(normalize_key(row.get(key)) or "" for key in KEY_COLUMNS)
+
+
+def _export_key(value):
+    # 以前のExcelと同じく、数字だけのID, RECNは数値のセルにする
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _to_python(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class MasterData:
+    """計算結果のデータベース
+
+    使い方:
+        store = MasterData(MASTER_DATA_DB, columns)
+        store.upsert(rows)
+        store.export_excel(MASTER_DATA_XLSX)
+
+    columns: 保存する列(duplicateは含めない)。足りない列はテーブルに追加する
+    """
+
+    def __init__(self, db_path: str = MASTER_DATA_DB, columns: Sequence[str] = ()):
+        self.db_path = db_path
+        self.columns = list(columns)
+        for key in KEY_COLUMNS:
+            if key not in self.columns:
+                raise ValueError(f"column {key} is required")
+
+        # データベースを新しく作ったかどうか(Excelからの移行に使う)
+        self.created = not os.path.exists(db_path)
+        self.conn = sqlite3.connect(db_path, timeout=60.0)
+        # tgledger が処理中に同じファイルに書き込むので、WALモードにする
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._create_table()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create_table(self) -> None:
+        with self.conn:
+            # seq: 追加した順, run: 何回目の追記か, duplicate: (ID, RECN) が重複しているか
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "run INTEGER NOT NULL, "
+                "duplicate INTEGER NOT NULL DEFAULT 0, "
+                "ID TEXT, RECN TEXT)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_key ON results (ID, RECN)"
+            )
+
+            # 列は型を決めずに作り、渡された値(整数・実数・文字列)をそのまま保存する
+            existing = self._table_columns()
+            for column in self.columns:
+                if column not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE results ADD COLUMN {_quote(column)}"
+                    )
+            if "filename" in self.columns:
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS results_filename ON results (filename)"
+                )
+
+    def _table_columns(self) -> List[str]:
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _values(self, row: dict) -> list:
+        values = []
+        for column in self.columns:
+            value = _to_python(row.get(column))
+            if column in KEY_COLUMNS:
+                value = normalize_key(value)
+            values.append(value)
+        return values
+
+    def _next_run(self) -> int:
+        return self.conn.execute(
+            "SELECT COALESCE(MAX(run), 0) + 1 FROM results"
+        ).fetchone()[0]
+
+    def _insert(self, rows: Iterable[dict], run: int) -> set:
+        sql = (
+            f"INSERT INTO results (run, {', '.join(map(_quote, self.columns))}) "
+            f"VALUES (?, {', '.join('?' * len(self.columns))})"
+        )
+        id_index = self.columns.index("ID")
+        recn_index = self.columns.index("RECN")
+        keys = set()
+        params = []
+        for row in rows:
+            values = self._values(row)
+            keys.add((values[id_index], values[recn_index]))
+            params.append([run] + values)
+        self.conn.executemany(sql, params)
+        return keys
+
+    def _update_duplicate(self, keys: Iterable[tuple]) -> None:
+        # 同じ (ID, RECN) の行だけを索引で探して更新する
+        self.conn.executemany(
+            "UPDATE results SET duplicate = "
+            "(SELECT COUNT(*) FROM results r WHERE r.ID IS results.ID "
+            "AND r.RECN IS results.RECN) > 1 "
+            "WHERE ID IS ? AND RECN IS ?",
+            list(keys),
+        )
+
+    def append(
+        self,
+        rows: Sequence[dict],
+        after: Optional[Callable[[sqlite3.Connection], None]] = None,
+    ) -> int:
+        """行を追記する。追記した行数を返す
+
+        1回の呼び出しで追記した行は同じ実行(run)として扱う
+        after を渡したときは、追記と同じトランザクションの中で after(接続) を呼ぶ
+        (同じデータベースファイルの tgledger の記録を、追記と一緒にコミットするのに使う)。
+        rows が空でも after は呼ぶ
+        """
+        if not rows and after is None:
+            return 0
+        with self.conn:
+            keys = self._insert(rows, self._next_run())
+            self._update_duplicate(keys)
+            if after is not None:
+                after(self.conn)
+        return len(rows)
+
+    def upsert(
+        self,
+        rows: Sequence[dict],
+        after: Optional[Callable[[sqlite3.Connection], None]] = None,
+    ) -> int:
+        """同じファイル名の行を置き換えて保存する。保存した行数を返す
+
+        内容を直して処理し直したファイルは、前の行を消して新しい行だけを残すので、
+        処理し直すたびに重複した行が増えることはない。
+        after は append と同じく、同じトランザクションの中で呼ぶ(rows が空でも呼ぶ)
+        """
+        if not rows and after is None:
+            return 0
+        filenames = [(row.get("filename"),) for row in rows]
+        with self.conn:
+            # 置き換えた行も含めて、この実行の行は前のどの実行よりも新しくする
+            run = self._next_run()
+            keys = set()
+            for filename in filenames:
+                keys.update(
+                    self.conn.execute(
+                        "SELECT DISTINCT ID, RECN FROM results WHERE filename IS ?",
+                        filename,
+                    )
+                )
+            self.conn.executemany("DELETE FROM results WHERE filename IS ?", filenames)
+            keys |= self._insert(rows, run)
+            self._update_duplicate(keys)
+            if after is not None:
+                after(self.conn)
+        return len(rows)
+
+    def import_excel(self, excel_path: str = MASTER_DATA_XLSX) -> int:
+        """既存のExcelのマスターデータを取り込む(データベースを作ったときに1回だけ使う)
+
+        Excelの行は最初の実行(run 0)として、ファイルの並び順のまま保存する
+        """
+        df = pd.read_excel(excel_path)
+        df = df.astype(object).where(df.notna(), None)
+        rows = df.to_dict("records")
+        with self.conn:
+            keys = self._insert(rows, 0)
+            self._update_duplicate(keys)
+        return len(rows)
+
+    def to_dataframe(self, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """全行を ID, RECN の順に並べた DataFrame(duplicate を含む)"""
+        if columns is None:
+            columns = self.columns + ["duplicate"]
+        df = pd.read_sql_query(
+            f"SELECT {', '.join(map(_quote, columns))} FROM results "
+            "ORDER BY ID, RECN, run DESC, seq",
+            self.conn,
+        )
+        for key in KEY_COLUMNS:
+            if key in df:
+                df[key] = df[key].map(_export_key)
+        return df
+
+    def export_excel(
+        self,
+        excel_path: str = MASTER_DATA_XLSX,
+        columns: Optional[Sequence[str]] = None,
+    ) -> None:
+        """Excelに書き出す
+
+        途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+        """
+        df = self.to_dataframe(columns)
+        directory = os.path.dirname(os.path.abspath(excel_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".xlsx")
+        os.close(fd)
+        try:
+            df.to_excel(tmp_path, float_format="%.2f", index=False)
+            os.replace(tmp_path, excel_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class ResultCsvWriter:
+    """計算結果を1ファイル分ずつCSVに追記する
+
+    計算が終わるたびに1行書いてフラッシュするので、計算結果をメモリに溜めない。
+    途中で止まった実行の行も残る(マスターデータに追記されたかどうかは tgledger で管理する)
+    ヘッダはファイルを新しく作ったときだけ書く。Excelで開けるよう、BOM付きのUTF-8にする。
+    既にあるファイルの列が columns と違うとき(列を加えたときなど)は、そのファイルを
+    <名前>-<更新日時>.csv に移してから新しく作る
+    """
+
+    def __init__(self, csv_path: str = RESULTS_CSV, columns: Sequence[str] = ()):
+        self.csv_path = csv_path
+        new = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        if not new:
+            with open(csv_path, "r", encoding="utf-8-sig", newline="") as fd:
+                header = next(csv.reader(fd), [])
+            if header != list(columns):
+                stem, ext = os.path.splitext(csv_path)
+                stamp = time.strftime(
+                    "%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(csv_path))
+                )
+                os.replace(csv_path, f"{stem}-{stamp}{ext}")
+                new = True
+        self._fd = open(csv_path, "a", encoding="utf-8-sig", newline="")
+        self._writer = csv.DictWriter(
+            self._fd, fieldnames=list(columns), extrasaction="ignore"
+        )
+        if new:
+            self._writer.writeheader()
+            self._fd.flush()
+
+    def write(self, row: dict) -> None:
+        self._writer.writerow(row)
+        self._fd.flush()
+
+    def close(self) -> None:
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,1040 @@
+"""音声(WAV)から Intensity / Pitch のTierを作る
+
+IntentisyPitchAverageTiersAdd.praat と同じことを、Praatを使わずに行う。
+
+- To Intensity: 75, 0.001 (Kaiser窓、平均の音圧を引く)
+- To Pitch: 0.0, 80, 400 (自己相関法。候補を求め、経路探索で有声/無声と候補を選ぶ)
+- Tier3(DFauto (English))のラベルのあるintervalごとに Get mean を求め、
+  fixed$ (値, 1) と同じ形(小数1桁、値がなければ --undefined--)でラベルにする。
+  スクリプトの Intensity の Get mean: t1, t2 は平均の方法を指定しないので、dB のまま平均する
+
+計算の手順は Praat の Sound_to_Intensity / Sound_to_Pitch_any / Pitch_pathFinder に合わせているが、
+Praat とは細かい点(Pitch の候補の絞り方、最大値の探し方の精度、Get mean の補間)が違う。
+Praat の出力と比べて確かめたのは合成音(fixtures/praat、tgreference.py で比べる)だけで、
+tgfiles の実際の録音では確かめていない。
+許容差の目安は intervalごとの値で Intensity 0.5 dB、Pitch 1 Hz(fixed$ の小数1桁目は違うことがある)で、
+有声/無声の判定が Praat と違うintervalは --undefined-- かどうかも変わる。
+
+そのため、ここで作る Intensity / Pitch のTierは Praat で作ったTierの置き換えにはならない。
+これらのTierから求める calculate_duration の値(nVarPco, PitAllAv, PPD, nVarIco, PID など)は
+Praat のTierから求めた値と一致しないので、Praat のTierで計算したマスターデータの行と混ぜて比べない。
+元のTextGridは上書きせず、<名前>.acoustic.TextGrid(ACOUSTIC_SUFFIX)として保存する。
+このファイルから求めた行は tier_source が tgacoustic になり、FluencyProsody.main() は
+マスターデータに入れない(計算結果のCSVにだけ残す)。
+
+WAVはメモリマップで開き(WavSamples)、フレームは FRAME_BLOCK 個ずつ、そのフレームが使う範囲の
+サンプルだけを読んで処理する。長い録音でも、使うメモリはブロックの大きさとフレームの数で決まり、
+音声の長さに比例する大きな配列(音声全体の float の配列やフレームの配列)は作らない。
+Tier3 が分かっているときは、ラベルのあるintervalにかかるフレームだけを計算する。
+intervalごとの平均は、フレームの値の累積和から1回で全intervalについて求める。
+
+音声全体のフレームの値(contours)は tgcontours にキャッシュできる。キャッシュがあれば、
+Tier3 の境界を直した後は解析をせずに平均を求め直すだけで Intensity / Pitch のTierを作れる。
+"""
+
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+import tgreader
+
+# IntentisyPitchAverageTiersAdd.praat のパラメータ
+INTENSITY_MIN_PITCH = 75.0
+INTENSITY_TIME_STEP = 0.001
+PITCH_TIME_STEP = 0.0
+PITCH_FLOOR = 80.0
+PITCH_CEILING = 400.0
+
+# To Pitch の既定値(Praat の Sound: To Pitch... と同じ)
+PERIODS_PER_WINDOW = 3.0
+MAX_CANDIDATES = 15
+SILENCE_THRESHOLD = 0.03
+VOICING_THRESHOLD = 0.45
+OCTAVE_COST = 0.01
+OCTAVE_JUMP_COST = 0.35
+VOICED_UNVOICED_COST = 0.14
+
+# To Formant (burg) の既定値
+FORMANT_TIME_STEP = 0.0
+MAX_FORMANTS = 5.0
+FORMANT_CEILING = 5500.0
+FORMANT_WINDOW_LENGTH = 0.025
+PRE_EMPHASIS = 50.0
+# Praat の Sound_to_Formant_burg で固定の値
+_FORMANT_SAFETY_MARGIN = 50.0
+_RESAMPLE_DEPTH = 50
+
+# 基準の音圧(2e-5 Pa)の2乗
+_REFERENCE_POWER = 4e-10
+# 1回に処理するフレームの数(メモリに置くフレームの配列の大きさ)
+FRAME_BLOCK = 256
+# regions を渡したとき、Pitch はintervalの前後この秒数までのフレームも計算する
+# (経路探索がintervalの端で途切れないように)
+REGION_MARGIN = 0.1
+# 音声全体を調べるとき(平均・最大)に一度に読むサンプルの数
+SAMPLE_BLOCK = 1 << 20
+# intervalごとの平均で、一度に累積和を求めるフレームの数
+CUMSUM_BLOCK = 1 << 16
+# Formant で1回に再標本化するフレームの数(再標本化の低域通過フィルタはこの単位で行う)
+FORMANT_BLOCK = 4096
+# 再標本化の低域通過フィルタで、ブロックの前後に余分に使うサンプルの数
+LOWPASS_MARGIN = 1 << 13
+
+# WavSamples で読んだ範囲を手放すとき、範囲の前にさかのぼって手放すバイト数
+_RELEASE_MARGIN = 1 << 20
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# ここで Intensity / Pitch のTierを作ったTextGridのファイル名の終わり
+ACOUSTIC_SUFFIX = ".acoustic.TextGrid"
+# FluencyProsody --acoustic-tiers の保存先(./tgfiles の外)
+ACOUSTIC_DIR = "tgfiles_acoustic"
+# 計算結果の行の tier_source(Intensity / Pitch のTierを何で作ったか)
+TIER_SOURCE_PRAAT = "praat"
+TIER_SOURCE_ACOUSTIC = "tgacoustic"
+
+UNDEFINED = "--undefined--"
+INTENSITY_TIER = "Intensity"
+PITCH_TIER = "Pitch"
+
+# tgcontours のキャッシュのキーに入れる contours の解析の名前。
+# 計算の手順やパラメータを変えたら、古いキャッシュを使わないように変える
+CONTOURS_ANALYSIS = "intensity-pitch-1"
+
+
+class Contour:
+    """フレームごとの値(Intensity の dB、Pitch の Hz。値がないフレームは NaN)
+
+    フレーム i の値は、時刻 times[i] を中心とする長さ time_step の区間の値とする
+    """
+
+    def __init__(self, first_time: float, time_step: float, values: np.ndarray):
+        self.first_time = first_time
+        self.time_step = time_step
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.first_time + self.time_step * np.arange(len(self.values))
+
+
+class WavSamples:
+    """WAVのサンプル(チャンネル x サンプル)をメモリマップで読む
+
+    samples[:, a:b] とすると、その範囲だけをファイルから読んで音圧(float64)の配列にする。
+    ファイル全体をメモリに読み込まず、読んだ範囲もすぐに手放すので、
+    長い録音でも使うメモリは読む範囲の大きさで決まる。
+    np.asarray(samples) とすると全体を読む。
+
+    PCM(8/16/24/32bit)と IEEE float(32/64bit)に対応する。
+    Praat と同じく、整数のサンプルは最大値が 1 になるように割る
+    """
+
+    def __init__(self, wav_path: str):
+        file_size = os.path.getsize(wav_path)
+        with open(wav_path, "rb") as fd:
+            header = fd.read(12)
+            if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+                raise ValueError(f"{wav_path}: not a RIFF/WAVE file")
+            fmt = None
+            offset = 12
+            while True:
+                fd.seek(offset)
+                chunk = fd.read(8)
+                if len(chunk) < 8:
+                    raise ValueError(f"{wav_path}: no data chunk")
+                chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+                if chunk_id == b"fmt ":
+                    fmt = fd.read(size)
+                elif chunk_id == b"data":
+                    break
+                # チャンクの長さは偶数にそろえられている
+                offset += 8 + size + (size & 1)
+        if fmt is None or len(fmt) < 16:
+            raise ValueError(f"{wav_path}: no fmt chunk")
+
+        tag, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+        if tag == _WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            tag = struct.unpack("<H", fmt[24:26])[0]
+        width = (bits + 7) // 8
+        if tag == _WAVE_FORMAT_PCM and width in (1, 2, 3, 4):
+            self._float = False
+        elif tag == _WAVE_FORMAT_IEEE_FLOAT and width in (4, 8):
+            self._float = True
+        else:
+            raise ValueError(f"{wav_path}: unsupported format {tag} ({bits} bit)")
+        if channels < 1 or block_align != channels * width:
+            raise ValueError(f"{wav_path}: invalid block size {block_align}")
+
+        # 録音中に止まったファイルなどでは data の長さが正しくないので、ファイルの大きさで抑える
+        data_offset = offset + 8
+        n = min(size, max(file_size - data_offset, 0)) // block_align
+        self.rate = float(rate)
+        self.shape = (channels, n)
+        self._width = width
+        self._offset = data_offset
+        self._block_align = block_align
+        if n == 0:
+            self._map = None
+            self._data = np.zeros((0, block_align), dtype=np.uint8)
+        else:
+            with open(wav_path, "rb") as fd:
+                self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = np.frombuffer(
+                self._map, dtype=np.uint8, count=n * block_align, offset=data_offset
+            ).reshape(n, block_align)
+
+    def __len__(self) -> int:
+        return self.shape[1]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """samples[チャンネル, a:b](サンプルの範囲は連続したスライスのみ)"""
+        channels, frames = key
+        if not isinstance(frames, slice) or frames.step not in (None, 1):
+            raise TypeError("samples can only be read with a contiguous slice")
+        start, stop, _ = frames.indices(self.shape[1])
+        samples = _pcm_to_float(
+            self._data[start:stop], self._width, self.shape[0], self._float
+        )
+        self._release(start, stop)
+        return samples[channels]
+
+    def _release(self, start: int, stop: int) -> None:
+        # 読んだページはプロセスのメモリから外す(OSのページキャッシュには残る)。
+        # 外さないと、読んだ範囲が増えるにつれて使うメモリ(RSS)がファイルの大きさまで増える。
+        # OSは読んだページの前後のページもまとめて割り当てる(fault-around)ので、少し前から外す
+        if self._map is None or stop <= start or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        first = max(self._offset + start * self._block_align - _RELEASE_MARGIN, 0)
+        first -= first % mmap.PAGESIZE
+        last = self._offset + stop * self._block_align
+        self._map.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+    def __array__(self, dtype=None):
+        samples = self[:, :]
+        return samples if dtype is None else samples.astype(dtype)
+
+
+def open_wav(wav_path: str) -> Tuple[WavSamples, float]:
+    """WAVをメモリマップで開き、(サンプル, サンプリング周波数) を返す"""
+    samples = WavSamples(wav_path)
+    return samples, samples.rate
+
+
+def read_wav(wav_path: str) -> Tuple[np.ndarray, float]:
+    """WAVを読み、(チャンネル x サンプルの音圧の配列, サンプリング周波数) を返す"""
+    samples, rate = open_wav(wav_path)
+    return np.asarray(samples), rate
+
+
+def _pcm_to_float(raw, width: int, channels: int, ieee_float: bool = False):
+    raw = np.ascontiguousarray(raw)
+    if ieee_float:
+        dtype = "<f4" if width == 4 else "<f8"
+        samples = np.frombuffer(raw, dtype=dtype).astype(np.float64)
+    elif width == 1:
+        # 8bit は符号なし
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float64) - 128) / 128
+    elif width == 3:
+        # 24bit は 4バイトに広げてから読む
+        data = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        wide = np.zeros((len(data), 4), dtype=np.uint8)
+        wide[:, 1:] = data
+        samples = wide.view("<i4").ravel().astype(np.float64) / 2.0**31
+    elif width in (2, 4):
+        dtype = "<i2" if width == 2 else "<i4"
+        samples = np.frombuffer(raw, dtype=dtype).astype(np.float64)
+        samples /= 2.0 ** (8 * width - 1)
+    else:
+        raise ValueError(f"unsupported sample width: {width}")
+    return samples.reshape(-1, channels).T
+
+
+# 音声のサンプル: (チャンネル x サンプル) の配列、またはメモリマップの WavSamples
+Samples = Union[np.ndarray, WavSamples]
+# 計算するintervalの (start, end) の配列
+Regions = Tuple[np.ndarray, np.ndarray]
+
+
+def _short_term_analysis(
+    n_samples: int, rate: float, window_duration: float, time_step: float
+) -> Tuple[int, float]:
+    """(フレームの数, 最初のフレームの時刻)。Praat の Sampled_shortTermAnalysis と同じ"""
+    duration = n_samples / rate
+    if window_duration > duration:
+        raise ValueError(
+            f"sound is too short for the analysis window ({duration} < {window_duration} s)"
+        )
+    n_frames = int(np.floor((duration - window_duration) / time_step)) + 1
+    mid_time = 0.5 * duration
+    return n_frames, mid_time - 0.5 * n_frames * time_step + 0.5 * time_step
+
+
+def _frames(samples: Samples, starts: np.ndarray, length: int) -> np.ndarray:
+    """(チャンネル, フレーム, length) の配列。範囲外のサンプルは 0
+
+    starts は昇順。ブロックが使う範囲だけを切り出してから、フレームに分ける
+    """
+    n = samples.shape[1]
+    lo = int(starts[0])
+    hi = int(starts[-1]) + length
+    span = samples[:, max(lo, 0) : min(hi, n)]
+    if lo < 0 or hi > n:
+        span = np.pad(span, ((0, 0), (max(-lo, 0), max(hi - n, 0))))
+    windows = np.lib.stride_tricks.sliding_window_view(span, length, axis=1)
+    return windows[:, starts - lo]
+
+
+def _selected_frames(
+    n_frames: int,
+    first_time: float,
+    time_step: float,
+    regions: Optional[Regions],
+    margin: int,
+) -> np.ndarray:
+    """regions のintervalのどれかと重なるフレーム(前後 margin フレームを含む)の bool 配列
+
+    regions が None なら全フレーム
+    """
+    if regions is None:
+        return np.ones(n_frames, dtype=bool)
+    start, end = (np.asarray(x, dtype=float) for x in regions)
+    # フレーム i は時刻 first_time + i * time_step を中心とする長さ time_step の区間
+    lo = np.floor((start - first_time) / time_step + 0.5).astype(np.int64) - margin
+    hi = np.floor((end - first_time) / time_step + 0.5).astype(np.int64) + margin
+    lo = np.clip(lo, 0, n_frames)
+    hi = np.clip(hi + 1, 0, n_frames)
+    use = lo < hi
+    edges = np.zeros(n_frames + 1, dtype=np.int32)
+    np.add.at(edges, lo[use], 1)
+    np.add.at(edges, hi[use], -1)
+    return np.cumsum(edges[:-1], dtype=np.int32) > 0
+
+
+def _runs(selected: np.ndarray) -> List[Tuple[int, int]]:
+    """選んだフレームの連続した範囲 (最初, 最後 + 1) の一覧"""
+    padded = np.concatenate([[False], selected, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+
+def _blocks(runs: List[Tuple[int, int]]):
+    """連続した範囲を FRAME_BLOCK フレームずつに分けた、フレームの番号の配列"""
+    for first, stop in runs:
+        for block in range(first, stop, FRAME_BLOCK):
+            yield np.arange(block, min(block + FRAME_BLOCK, stop))
+
+
+def _global_peak(samples) -> float:
+    """チャンネルごとに平均を引いた音圧の絶対値の最大(少しずつ読んで求める)"""
+    n_channels, n = samples.shape
+    if n == 0:
+        return 0.0
+    total = np.zeros(n_channels)
+    low = np.full(n_channels, np.inf)
+    high = np.full(n_channels, -np.inf)
+    for block in range(0, n, SAMPLE_BLOCK):
+        chunk = samples[:, block : block + SAMPLE_BLOCK]
+        total += chunk.sum(axis=1)
+        low = np.minimum(low, chunk.min(axis=1))
+        high = np.maximum(high, chunk.max(axis=1))
+    mean = total / n
+    return float(np.max(np.maximum(high - mean, mean - low)))
+
+
+def intensity_contour(
+    samples: Samples,
+    rate: float,
+    min_pitch: float = INTENSITY_MIN_PITCH,
+    time_step: float = INTENSITY_TIME_STEP,
+    subtract_mean: bool = True,
+    regions: Optional[Regions] = None,
+) -> Contour:
+    """Praat の To Intensity と同じ計算で、フレームごとの dB を求める
+
+    regions (start, end の配列) を渡すと、そのintervalと重なるフレームだけを計算する
+    (他のフレームは NaN)
+    """
+    if time_step <= 0.0:
+        time_step = 0.8 / min_pitch
+    window_duration = 6.4 / min_pitch
+    half_duration = 0.5 * window_duration
+    half = int(np.floor(half_duration * rate))
+    x = np.arange(-half, half + 1) / rate / half_duration
+    root = 1.0 - x * x
+    window = np.where(
+        root <= 0.0,
+        0.0,
+        np.i0((2 * np.pi * np.pi + 0.5) * np.sqrt(np.maximum(root, 0.0))),
+    )
+
+    n_channels, n = samples.shape
+    n_frames, first_time = _short_term_analysis(n, rate, window_duration, time_step)
+    values = np.full(n_frames, np.nan)
+    selected = _selected_frames(n_frames, first_time, time_step, regions, 1)
+    for index in _blocks(_runs(selected)):
+        frame_times = first_time + time_step * index
+        # 最初のサンプルの時刻は 0.5 / rate
+        mid = np.floor(frame_times * rate).astype(np.int64)
+        left = np.maximum(mid - half, 0)
+        right = np.minimum(mid + half, n - 1)
+        frames = _frames(samples, mid - half, 2 * half + 1)
+        if subtract_mean:
+            mean = frames.sum(axis=2) / (right - left + 1)
+            frames = frames - mean[:, :, None]
+        if left[0] == mid[0] - half and right[-1] == mid[-1] + half:
+            sumw = np.full(len(mid), n_channels * window.sum())
+        else:
+            # 窓が音声の外にはみ出すフレーム(最初と最後)は、中のサンプルだけを使う
+            position = np.arange(2 * half + 1)
+            inside = (position >= (left - mid + half)[:, None]) & (
+                position <= (right - mid + half)[:, None]
+            )
+            frames = np.where(inside, frames, 0.0)
+            sumw = n_channels * (inside @ window)
+        sumxw = ((frames * frames) @ window).sum(axis=0)
+        power = sumxw / sumw / _REFERENCE_POWER
+        values[index] = np.where(
+            power < 1e-30, -300.0, 10 * np.log10(np.maximum(power, 1e-30))
+        )
+    return Contour(first_time, time_step, values)
+
+
+def _sinc_interpolate(r: np.ndarray, offset: int, x: np.ndarray, depth: int):
+    """Praat の NUM_interpolate_sinc と同じく、窓をかけた sinc で r を x で補間する
+
+    r[k] はラグ k - offset の値。x は補間するラグ(フレームごと)。r は (フレーム, ラグ)
+    """
+    size = r.shape[1]
+    pos = x + offset
+    midleft = np.floor(pos).astype(np.int64)
+    frac = pos - midleft
+    depth_left = np.minimum(depth, midleft + 1)
+    depth_right = np.minimum(depth, size - 1 - midleft)
+    depth_here = np.minimum(depth_left, depth_right)
+    k = np.arange(-depth + 1, depth + 1)
+    index = midleft[:, None] + k
+    d = frac[:, None] - k
+    # 補間の幅の外は使わない
+    use = (k >= 1 - depth_here[:, None]) & (k <= depth_here[:, None])
+    width = np.where(k <= 0, pos[:, None] - (midleft - depth_here + 1)[:, None] + 1, 0)
+    width = np.where(k > 0, (midleft + depth_here)[:, None] - pos[:, None] + 1, width)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sinc = np.where(d == 0, 1.0, np.sin(np.pi * d) / (np.pi * d))
+        taper = 0.5 + 0.5 * np.cos(np.pi * d / width)
+    rows = np.arange(len(pos))[:, None]
+    values = r[rows, np.clip(index, 0, size - 1)]
+    result = np.where(use, values * sinc * taper, 0.0).sum(axis=1)
+    return np.where(
+        frac == 0, r[np.arange(len(pos)), np.clip(midleft, 0, size - 1)], result
+    )
+
+
+def _improve_maxima(r: np.ndarray, offset: int, lag: np.ndarray, depth: int):
+    """ラグ lag の前後1サンプルの中で、sinc 補間した r が最大になるラグと値(黄金分割探索)"""
+    ratio = (np.sqrt(5.0) - 1.0) / 2.0
+    lo = lag - 1.0
+    hi = lag + 1.0
+    a = hi - ratio * (hi - lo)
+    b = lo + ratio * (hi - lo)
+    fa = _sinc_interpolate(r, offset, a, depth)
+    fb = _sinc_interpolate(r, offset, b, depth)
+    for _ in range(30):
+        # fa >= fb なら最大は [lo, b] にある
+        left = fa >= fb
+        hi = np.where(left, b, hi)
+        lo = np.where(left, lo, a)
+        a, b = (
+            np.where(left, hi - ratio * (hi - lo), b),
+            np.where(left, a, lo + ratio * (hi - lo)),
+        )
+        value = _sinc_interpolate(r, offset, np.where(left, a, b), depth)
+        fa, fb = np.where(left, value, fb), np.where(left, fa, value)
+    return np.where(fa >= fb, a, b), np.maximum(fa, fb)
+
+
+def pitch_contour(
+    samples: Samples,
+    rate: float,
+    time_step: float = PITCH_TIME_STEP,
+    floor: float = PITCH_FLOOR,
+    ceiling: float = PITCH_CEILING,
+    max_candidates: int = MAX_CANDIDATES,
+    silence_threshold: float = SILENCE_THRESHOLD,
+    voicing_threshold: float = VOICING_THRESHOLD,
+    octave_cost: float = OCTAVE_COST,
+    octave_jump_cost: float = OCTAVE_JUMP_COST,
+    voiced_unvoiced_cost: float = VOICED_UNVOICED_COST,
+    regions: Optional[Regions] = None,
+) -> Contour:
+    """Praat の To Pitch (ac) と同じ計算で、フレームごとの f0 (Hz) を求める(無声は NaN)
+
+    引数の順序と意味は To Pitch (ac) の引数と同じ(Very accurate は no のみ)。
+    regions (start, end の配列) を渡すと、そのintervalの前後 REGION_MARGIN 秒までの
+    フレームだけを計算し、経路探索は連続したフレームの範囲ごとに行う
+    """
+    n_channels, n = samples.shape
+    if time_step <= 0.0:
+        time_step = PERIODS_PER_WINDOW / floor / 4.0
+    nsamp_period = int(np.floor(rate / floor))
+    halfnsamp_period = nsamp_period // 2 + 1
+    ceiling = min(ceiling, 0.5 * rate)
+    window_duration = PERIODS_PER_WINDOW / floor
+    halfnsamp_window = int(np.floor(window_duration * rate)) // 2 - 1
+    if halfnsamp_window < 2:
+        raise ValueError("analysis window is too short")
+    nsamp_window = halfnsamp_window * 2
+    minimum_lag = max(2, int(np.floor(rate / ceiling)))
+    maximum_lag = min(
+        int(np.floor(nsamp_window / PERIODS_PER_WINDOW)) + 2, nsamp_window
+    )
+
+    n_frames, first_time = _short_term_analysis(n, rate, window_duration, time_step)
+    values = np.full(n_frames, np.nan)
+
+    global_peak = _global_peak(samples)
+    if global_peak == 0.0:
+        return Contour(first_time, time_step, values)
+
+    nfft = 1
+    while nfft < nsamp_window * 1.5:
+        nfft *= 2
+    window = 0.5 - 0.5 * np.cos(
+        np.arange(1, nsamp_window + 1) * 2 * np.pi / (nsamp_window + 1)
+    )
+    window_r = np.fft.irfft(np.abs(np.fft.rfft(window, nfft)) ** 2, nfft)
+    window_r = window_r / window_r[0]
+    brent_ixmax = int(np.floor(nsamp_window * 0.5))
+    lags = np.arange(brent_ixmax + 1)
+    # 局所的なピークを探す範囲(窓の中央の前後、最も長い周期の半分)
+    peak_lo = max(1, halfnsamp_window + 1 - halfnsamp_period) - 1
+    peak_hi = min(nsamp_window, halfnsamp_window + halfnsamp_period)
+    # sinc 補間に使う r[-brent_ixmax .. brent_ixmax]
+    offset = brent_ixmax
+
+    # 候補(周波数, 強さ)はフレームの連続した範囲ごとに求め、その範囲で経路探索を行う。
+    # 0列目は無声の候補
+    k = max_candidates
+    margin = int(np.ceil(REGION_MARGIN / time_step))
+    runs = _runs(_selected_frames(n_frames, first_time, time_step, regions, margin))
+    for first, stop in runs:
+        frequency = np.zeros((stop - first, k))
+        strength = np.zeros((stop - first, k))
+        count = np.ones(stop - first, dtype=np.int16)
+        intensity = np.zeros(stop - first)
+        for index in _blocks([(first, stop)]):
+            local = index - first
+            t = first_time + time_step * index
+            left = np.floor(t * rate - 0.5).astype(np.int64)
+            right = left + 1
+            mean_frames = _frames(samples, right - nsamp_period, 2 * nsamp_period)
+            local_mean = mean_frames.sum(axis=2) / (2 * nsamp_period)
+            frames = _frames(samples, right - halfnsamp_window, nsamp_window)
+            frames = (frames - local_mean[:, :, None]) * window
+            local_peak = np.abs(frames[:, :, peak_lo:peak_hi]).max(axis=(0, 2))
+            intensity[local] = np.minimum(local_peak / global_peak, 1.0)
+
+            ac = np.fft.irfft(
+                (np.abs(np.fft.rfft(frames, nfft)) ** 2).sum(axis=0), nfft
+            )
+            with np.errstate(invalid="ignore", divide="ignore"):
+                r = ac[:, lags] / (ac[:, :1] * window_r[lags])
+            # r[-i] = r[i] として、両側に広げる
+            r_full = np.concatenate([r[:, :0:-1], r], axis=1)
+
+            # 自己相関の極大(有声らしいもの)
+            i = np.arange(2, min(maximum_lag, brent_ixmax))
+            center = r[:, i]
+            is_peak = (
+                (center > 0.5 * voicing_threshold)
+                & (center > r[:, i - 1])
+                & (center >= r[:, i + 1])
+                & (local_peak > 0)[:, None]
+            )
+            rows, cols = np.nonzero(is_peak)
+            if len(rows) == 0:
+                continue
+            peak_lag = i[cols]
+            r0 = r[rows, peak_lag]
+            rm = r[rows, peak_lag - 1]
+            rp = r[rows, peak_lag + 1]
+            dr = 0.5 * (rp - rm)
+            d2r = 2.0 * r0 - rm - rp
+            rough = _sinc_interpolate(r_full[rows], offset, peak_lag + dr / d2r, 30)
+            rough = np.where(rough > 1.0, 1.0 / rough, rough)
+            freq = rate / (peak_lag + dr / d2r)
+            # 候補が多すぎるときは、オクターブのコストを引いた強さの大きいものを残す
+            score = rough - octave_cost * np.log2(floor / freq)
+            order = np.lexsort((-score, rows))
+            rows, peak_lag, score = rows[order], peak_lag[order], score[order]
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            keep = rank < k - 1
+            rows, peak_lag, rank = rows[keep], peak_lag[keep], rank[keep]
+
+            best_lag, best = _improve_maxima(
+                r_full[rows], offset, peak_lag.astype(float), 70
+            )
+            best = np.where(best > 1.0, 1.0 / best, best)
+            frame = local[rows]
+            frequency[frame, rank + 1] = rate / best_lag
+            strength[frame, rank + 1] = best
+            np.add.at(count, frame, 1)
+
+        values[first:stop] = _path_finder(
+            frequency,
+            strength,
+            count,
+            intensity,
+            ceiling,
+            time_step,
+            silence_threshold,
+            voicing_threshold,
+            octave_cost,
+            octave_jump_cost,
+            voiced_unvoiced_cost,
+        )
+    return Contour(first_time, time_step, values)
+
+
+def _path_finder(
+    frequency,
+    strength,
+    count,
+    intensity,
+    ceiling,
+    time_step,
+    silence_threshold,
+    voicing_threshold,
+    octave_cost,
+    octave_jump_cost,
+    voiced_unvoiced_cost,
+):
+    """Praat の Pitch_pathFinder と同じく、有声/無声と候補の経路を選ぶ"""
+    n_frames, k = frequency.shape
+    correction = 0.01 / time_step
+    jump_cost = octave_jump_cost * correction
+    vu_cost = voiced_unvoiced_cost * correction
+
+    exists = np.arange(k) < count[:, None]
+    voiced = exists & (frequency > 0) & (frequency < ceiling)
+    unvoiced_strength = 2.0 - intensity / (silence_threshold / (1 + voicing_threshold))
+    unvoiced_strength = voicing_threshold + np.maximum(unvoiced_strength, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(
+            voiced,
+            strength - octave_cost * np.log2(ceiling / frequency),
+            unvoiced_strength[:, None],
+        )
+        log_f = np.where(voiced, np.log2(np.where(voiced, frequency, 1.0)), 0.0)
+    delta = np.where(exists, delta, -np.inf)
+
+    f0 = np.full(n_frames, np.nan)
+    if n_frames == 0:
+        return f0
+    psi = np.zeros((n_frames, k), dtype=np.int16)
+    total = delta[0].copy()
+    for i in range(1, n_frames):
+        pv = voiced[i - 1][:, None]
+        cv = voiced[i][None, :]
+        transition = np.where(
+            pv & cv,
+            jump_cost * np.abs(log_f[i - 1][:, None] - log_f[i][None, :]),
+            np.where(pv | cv, vu_cost, 0.0),
+        )
+        value = total[:, None] - transition
+        place = np.argmax(value, axis=0)
+        total = value[place, np.arange(k)] + delta[i]
+        psi[i] = place
+
+    place = int(np.argmax(total))
+    for i in range(n_frames - 1, -1, -1):
+        if voiced[i, place]:
+            f0[i] = frequency[i, place]
+        place = psi[i, place]
+    return f0
+
+
+def _mono(samples: Samples, start: int, stop: int) -> np.ndarray:
+    """サンプル start .. stop - 1 のチャンネルの平均(範囲外は 0)"""
+    n = samples.shape[1]
+    lo, hi = max(start, 0), min(stop, n)
+    mono = samples[:, lo:hi].mean(axis=0) if hi > lo else np.zeros(0)
+    return np.pad(mono, (lo - start, stop - hi))
+
+
+def _resampled(
+    samples: Samples, rate: float, new_rate: float, start: int, stop: int
+) -> np.ndarray:
+    """Praat の Resample (precision 50) の結果(チャンネルの平均)のサンプル start .. stop - 1
+
+    低くする場合は、Praat と同じく新しいナイキスト周波数より上を FFT で 0 にしてから
+    窓をかけた sinc で補間する。フィルタは音声全体ではなく、使う範囲の前後 LOWPASS_MARGIN
+    サンプルまでを含むブロックごとに行う
+    """
+    n = samples.shape[1]
+    upfactor = new_rate / rate
+    if abs(upfactor - 1.0) < 1e-6:
+        return _mono(samples, start, stop)
+    new_n = int(np.floor(n / rate * new_rate + 0.5))
+    first_time = 0.5 * (n / rate - (new_n - 1) / new_rate)
+    # 元の音声のサンプルの位置(0始まり)
+    position = (first_time + np.arange(start, stop) / new_rate) * rate - 0.5
+    position = np.clip(position, 0.0, n - 1)
+    if len(position) == 0:
+        return np.zeros(0)
+
+    margin = _RESAMPLE_DEPTH + 1
+    if upfactor < 1.0:
+        margin += LOWPASS_MARGIN
+    lo = max(int(np.floor(position[0])) - margin, 0)
+    hi = min(int(np.floor(position[-1])) + margin + 1, n)
+    source = _mono(samples, lo, hi)
+    if upfactor < 1.0:
+        # Praat の NUMfft の並び(実部と虚部が交互)で、upfactor * nfft 番目から後を 0 にする
+        nfft = 1
+        while nfft < len(source) + 2000:
+            nfft *= 2
+        spectrum = np.fft.rfft(source, nfft)
+        cut = int(np.floor(upfactor * nfft))
+        k = np.arange(len(spectrum))
+        spectrum.real[2 * k >= cut] = 0.0
+        spectrum.imag[2 * k + 1 >= cut] = 0.0
+        source = np.fft.irfft(spectrum, nfft)[: len(source)]
+
+    result = np.empty(len(position))
+    for block in range(0, len(position), FRAME_BLOCK * 16):
+        x = position[block : block + FRAME_BLOCK * 16] - lo
+        rows = np.broadcast_to(source, (len(x), len(source)))
+        result[block : block + len(x)] = _sinc_interpolate(rows, 0, x, _RESAMPLE_DEPTH)
+    return result
+
+
+def _burg(frames: np.ndarray, order: int) -> np.ndarray:
+    """Praat の VECburg。各フレーム(行)の線形予測係数 (フレーム, order)"""
+    count, n = frames.shape
+    a = np.zeros((count, order))
+    aa = np.zeros((count, order))
+    b1 = frames[:, :-1].copy()
+    b2 = frames[:, 1:].copy()
+    # 分母が 0 になったフレームは、Praat と同じくそこで係数の更新をやめる
+    active = np.ones(count, dtype=bool)
+    for i in range(1, order + 1):
+        length = n - i
+        num = (b1[:, :length] * b2[:, :length]).sum(axis=1)
+        den = (b1[:, :length] ** 2 + b2[:, :length] ** 2).sum(axis=1)
+        active &= den > 0.0
+        ai = np.where(active, 2.0 * num / np.where(active, den, 1.0), 0.0)
+        a[active, : i - 1] = (
+            aa[active, : i - 1] - ai[active, None] * aa[active, : i - 1][:, ::-1]
+        )
+        a[active, i - 1] = ai[active]
+        if i < order:
+            aa[:, :i] = a[:, :i]
+            length -= 1
+            b1_next = b1[:, 1 : length + 1].copy()
+            b1[:, :length] -= ai[:, None] * b2[:, :length]
+            b2[:, :length] = b2[:, 1 : length + 1] - ai[:, None] * b1_next
+    return a
+
+
+def _formant_frequencies(
+    coefficients: np.ndarray, nyquist: float, n_formants: int
+) -> np.ndarray:
+    """線形予測多項式の根から、低い順に n_formants 個のフォルマント周波数(なければ NaN)"""
+    count, order = coefficients.shape
+    frequencies = np.full((count, n_formants), np.nan)
+    if count == 0:
+        return frequencies
+    # z^order - a1 z^(order-1) - ... - a_order のコンパニオン行列の固有値が根
+    companion = np.zeros((count, order, order))
+    companion[:, 0, :] = coefficients
+    companion[:, np.arange(1, order), np.arange(order - 1)] = 1.0
+    roots = np.linalg.eigvals(companion)
+    # 単位円の外の根を内側に移しても角度は変わらないので、周波数は角度から求める
+    f = np.abs(np.arctan2(roots.imag, roots.real)) * nyquist / np.pi
+    use = (
+        (roots.imag >= 0.0)
+        & (f >= _FORMANT_SAFETY_MARGIN)
+        & (f <= nyquist - _FORMANT_SAFETY_MARGIN)
+    )
+    f = np.sort(np.where(use, f, np.inf), axis=1)[:, :n_formants]
+    width = f.shape[1]
+    frequencies[:, :width] = np.where(np.isinf(f), np.nan, f)
+    return frequencies
+
+
+def formant_contours(
+    samples: Samples,
+    rate: float,
+    time_step: float = FORMANT_TIME_STEP,
+    max_formants: float = MAX_FORMANTS,
+    ceiling: float = FORMANT_CEILING,
+    window_length: float = FORMANT_WINDOW_LENGTH,
+    pre_emphasis: float = PRE_EMPHASIS,
+) -> List[Contour]:
+    """Praat の To Formant (burg) と同じ計算で、F1, F2, ... のフレームごとの値 (Hz) を求める
+
+    引数の順序と意味は To Formant (burg) の引数と同じ。
+    ceiling の2倍に再標本化し、プリエンファシスをかけて、ガウス窓のフレームごとに
+    Burg 法で線形予測係数を求め、その根をフォルマントとする。
+    再標本化は FORMANT_BLOCK フレームずつ、そのフレームが使う範囲だけを行う
+    """
+    n = samples.shape[1]
+    new_rate = 2.0 * ceiling
+    if ceiling <= 0.0 or abs(new_rate / rate - 1.0) < 1e-12:
+        new_rate = rate
+    new_n = n if new_rate == rate else int(np.floor(n / rate * new_rate + 0.5))
+    dx = 1.0 / new_rate
+    x1 = 0.5 * (n / rate - (new_n - 1) * dx)
+    order = int(np.floor(2.0 * max_formants + 0.5))
+    n_formants = (order + 1) // 2
+
+    if time_step <= 0.0:
+        time_step = window_length / 4.0
+    duration = new_n * dx
+    window_duration = 2.0 * window_length
+    n_frames = 1 + int(np.floor((duration - window_duration) / time_step))
+    nsamp_window = int(np.floor(window_duration / dx))
+    halfnsamp_window = nsamp_window // 2
+    if nsamp_window < order + 1:
+        raise ValueError("analysis window is too short")
+    first_time = x1 + 0.5 * (duration - dx - (n_frames - 1) * time_step)
+    if n_frames < 1:
+        n_frames = 1
+        first_time = x1 + 0.5 * duration
+        nsamp_window = new_n
+
+    i = np.arange(1, nsamp_window + 1)
+    middle = 0.5 * (nsamp_window + 1)
+    edge = np.exp(-12.0)
+    window = (np.exp(-48.0 * (i - middle) ** 2 / (nsamp_window + 1) ** 2) - edge) / (
+        1.0 - edge
+    )
+    emphasis = np.exp(-2.0 * np.pi * pre_emphasis * dx)
+
+    values = np.full((n_frames, n_formants), np.nan)
+    for block in range(0, n_frames, FORMANT_BLOCK):
+        index = np.arange(block, min(block + FORMANT_BLOCK, n_frames))
+        t = first_time + time_step * index
+        # Praat の番号(1始まり)で、フレームの窓の最初と最後のサンプル
+        left = np.floor((t - x1) / dx + 1.0).astype(np.int64)
+        start = np.maximum(left + 1 - halfnsamp_window, 1)
+        end = np.minimum(left + halfnsamp_window, new_n)
+
+        # プリエンファシスは1つ前のサンプルも使う
+        lo = max(int(start[0]) - 2, 0)
+        hi = min(int(start[-1]) - 1 + nsamp_window, new_n)
+        sound = _resampled(samples, rate, new_rate, lo, hi)
+        emphasized = sound.copy()
+        emphasized[1:] -= emphasis * sound[:-1]
+        frames = _frames(emphasized[None, :], start - 1 - lo, nsamp_window)[0]
+
+        inside = np.arange(nsamp_window) <= (end - start)[:, None]
+        peak = np.where(inside, frames * frames, 0.0).max(axis=1)
+        # 無音のフレームは Burg 法が使えないので、フォルマントなしとする
+        sounding = peak > 0.0
+        coefficients = _burg(frames[sounding] * window, order)
+        values[index[sounding]] = _formant_frequencies(
+            coefficients, 0.5 * new_rate, n_formants
+        )
+    return [
+        Contour(first_time, time_step, values[:, k].copy()) for k in range(n_formants)
+    ]
+
+
+def interval_integrals(
+    contour: Contour,
+    start: np.ndarray,
+    end: np.ndarray,
+    energy: bool = False,
+    order: int = 1,
+) -> np.ndarray:
+    """各interval [start, end] の、値のあるフレームの長さと、値の k 乗の積分 (k = 1 .. order)
+
+    各フレームの値はその区間で一定とし、intervalと重なる長さで重みを付ける。
+    energy=True なら dB をエネルギーにしてから積分する。
+
+    フレームの値の累積和を CUMSUM_BLOCK フレームずつ求め、
+    各intervalは両端の累積和の差で求める。累積和の配列全体は作らない
+
+    Returns:
+        (order + 1, intervalの数) の配列。0行目が長さ
+    """
+    values = contour.values
+    n = len(values)
+    if n == 0:
+        return np.zeros((order + 1, len(start)))
+    step = contour.time_step
+    times = np.concatenate([start, end])
+    position = np.clip((times - (contour.first_time - 0.5 * step)) / step, 0.0, n)
+    cell = np.minimum(np.floor(position).astype(np.int64), n - 1)
+    # 各端の、最初のフレームの区間の始めからの積分
+    integral = np.zeros((order + 1, len(times)))
+    before = np.zeros(order + 1)
+    for block in range(0, n, CUMSUM_BLOCK):
+        # キャッシュ(float32)の値も float64 で足す
+        chunk = np.asarray(values[block : block + CUMSUM_BLOCK], dtype=float)
+        defined = ~np.isnan(chunk)
+        if energy:
+            chunk = 10.0 ** (chunk / 10.0)
+        chunk = np.where(defined, chunk, 0.0)
+        cells = np.stack(
+            [defined.astype(float)] + [chunk**k for k in range(1, order + 1)]
+        )
+        cumulative = np.cumsum(cells * step, axis=1)
+        here = np.flatnonzero((cell >= block) & (cell < block + len(defined)))
+        local = cell[here] - block
+        # フレームの前までの累積和 + そのフレームの中の分
+        integral[:, here] = (
+            before[:, None]
+            + cumulative[:, local]
+            - cells[:, local] * step
+            + cells[:, local] * (position[here] - cell[here]) * step
+        )
+        before += cumulative[:, -1]
+    return integral[:, len(start) :] - integral[:, : len(start)]
+
+
+def interval_means(
+    contour: Contour, start: np.ndarray, end: np.ndarray, energy: bool = False
+) -> np.ndarray:
+    """各interval [start, end] の値の平均(値のないフレームは除く。なければ NaN)
+
+    energy=True なら dB をエネルギーにしてから平均し、dB に戻す(Intensity の Get mean の energy)
+    """
+    weight, total = interval_integrals(contour, start, end, energy)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(weight > 0, total / weight, np.nan)
+        if energy:
+            mean = 10.0 * np.log10(mean)
+    return mean
+
+
+def format_value(value: float) -> str:
+    """Praat の fixed$ (value, 1)"""
+    if np.isnan(value):
+        return UNDEFINED
+    return f"{value:.1f}"
+
+
+def value_tier(
+    tier3: tgreader.TierArrays, name: str, means: np.ndarray
+) -> tgreader.TierArrays:
+    """Tier3と同じ境界で、ラベルのあるintervalに値を入れたTier"""
+    labeled = ~tier3.mask("")
+    labels = [""]
+    index = {"": 0}
+    codes = np.zeros(len(tier3), dtype=np.int32)
+    for i in np.flatnonzero(labeled).tolist():
+        label = format_value(means[i])
+        if label not in index:
+            index[label] = len(labels)
+            labels.append(label)
+        codes[i] = index[label]
+    return tgreader.TierArrays(
+        name,
+        tgreader.INTERVAL_TIER,
+        tier3.xmin,
+        tier3.xmax,
+        tier3.start.copy(),
+        tier3.end.copy(),
+        codes,
+        labels,
+    )
+
+
+def contours(samples: Samples, rate: float) -> Dict[str, Contour]:
+    """音声全体の Intensity と Pitch のフレームの値(tgcontours にキャッシュする)"""
+    return {
+        INTENSITY_TIER: intensity_contour(samples, rate),
+        PITCH_TIER: pitch_contour(samples, rate),
+    }
+
+
+def acoustic_tiers(
+    tier3: tgreader.TierArrays, samples: Samples, rate: float
+) -> Tuple[tgreader.TierArrays, tgreader.TierArrays]:
+    """Tier3の各intervalの Intensity と Pitch のTier
+
+    値を入れるのはラベルのあるintervalだけなので、そのintervalにかかるフレームだけを計算する
+    """
+    labeled = ~tier3.mask("")
+    regions = (tier3.start[labeled], tier3.end[labeled])
+    intensity = intensity_contour(samples, rate, regions=regions)
+    pitch = pitch_contour(samples, rate, regions=regions)
+    return contour_tiers(tier3, intensity, pitch)
+
+
+def contour_tiers(
+    tier3: tgreader.TierArrays, intensity: Contour, pitch: Contour
+) -> Tuple[tgreader.TierArrays, tgreader.TierArrays]:
+    """求めてあるフレームの値から、Tier3の各intervalの Intensity と Pitch のTierを作る"""
+    return (
+        value_tier(
+            tier3, INTENSITY_TIER, interval_means(intensity, tier3.start, tier3.end)
+        ),
+        value_tier(tier3, PITCH_TIER, interval_means(pitch, tier3.start, tier3.end)),
+    )
+
+
+def tier_source(textgrid_path: str) -> str:
+    """TextGridの Intensity / Pitch のTierを何で作ったか(ファイル名の ACOUSTIC_SUFFIX で判定する)"""
+    if textgrid_path.endswith(ACOUSTIC_SUFFIX):
+        return TIER_SOURCE_ACOUSTIC
+    return TIER_SOURCE_PRAAT
+
+
+def add_acoustic_tiers(
+    textgrid_path: str,
+    wav_path: str,
+    output_path: Optional[str] = None,
+    contours: Optional[Dict[str, Contour]] = None,
+) -> str:
+    """TextGridに Intensity と Pitch のTierを加えて保存し、保存先を返す
+
+    既に同じ名前のTierがあれば置き換え、なければ最後に加える(IntentisyPitchAverageTiersAdd.praat)。
+    元のファイルは上書きしない。output_path を指定しなければ、元のファイルと同じ場所に
+    <名前>.acoustic.TextGrid として保存する(Praat で作ったTierと区別できるように)。
+    contours(この音声の contours の結果。tgcontours のキャッシュなど)を渡すと、音声は読まない
+    """
+    document = tgreader.read_textgrid(textgrid_path)
+    if contours is None:
+        samples, rate = open_wav(wav_path)
+        tiers = acoustic_tiers(document[2], samples, rate)
+    else:
+        tiers = contour_tiers(
+            document[2], contours[INTENSITY_TIER], contours[PITCH_TIER]
+        )
+
+    overrides = {tier.name: tier.to_praatio() for tier in tiers}
+    textgrid_file = document.to_textgrid(overrides=overrides)
+    for tier in tiers:
+        if tier.name not in document:
+            textgrid_file.addTier(overrides[tier.name], reportingMode="silence")
+
+    output_path = output_path or os.path.splitext(textgrid_path)[0] + ACOUSTIC_SUFFIX
+    if os.path.abspath(output_path) == os.path.abspath(textgrid_path):
+        raise ValueError(f"{textgrid_path} を上書きしない")
+    save_textgrid(textgrid_file, output_path)
+    return output_path
+
+
+def save_textgrid(textgrid_file, output_path: str) -> None:
+    """praatioのTextgridを Praat の Save as text file と同じ形(long)で保存する"""
+    # 途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    tmp_path = output_path + ".tmp"
+    try:
+        textgrid_file.save(tmp_path, format="long_textgrid", includeBlankSpaces=True)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
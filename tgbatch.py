@@ -0,0 +1,107 @@
+"""ファイルごとの処理を複数のプロセスで並列に行う
+
+ファイルを大きさ(処理時間の目安)で釣り合うようにチャンクに分け、
+チャンクごとにワーカープロセスに渡す。大きいチャンクから先に渡すので、
+最後に大きいファイルだけが残って待たされることが少ない。
+
+1つのファイルで例外が起きても、そのファイルの結果が Failure になるだけで、
+同じチャンクの他のファイルの処理は続ける。結果は常に渡したファイルの順に返す。
+"""
+
+import heapq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, List, Optional, Sequence
+
+# ワーカー1つあたりのチャンク数(多いほど釣り合いやすいが、受け渡しが増える)
+CHUNKS_PER_WORKER = 4
+
+
+class Failure:
+    """処理中に例外が起きた項目"""
+
+    def __init__(self, item, message: str):
+        self.item = item
+        self.message = message
+
+
+def make_chunks(weights: Sequence[float], n_chunks: int) -> List[List[int]]:
+    """重みの合計が釣り合うように、項目の番号を n_chunks 個以下のチャンクに分ける
+
+    重いものから順に、その時点で合計が最も小さいチャンクに入れる。
+    チャンクは合計の重い順に並べ、チャンクの中は番号の順にする
+    """
+    n_chunks = max(1, min(n_chunks, len(weights)))
+    heap = [(0.0, k) for k in range(n_chunks)]
+    chunks: List[List[int]] = [[] for _ in range(n_chunks)]
+    for i in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        total, k = heapq.heappop(heap)
+        chunks[k].append(i)
+        heapq.heappush(heap, (total + weights[i], k))
+
+    totals = {k: total for total, k in heap}
+    order = sorted(range(n_chunks), key=lambda k: totals[k], reverse=True)
+    return [sorted(chunks[k]) for k in order if chunks[k]]
+
+
+def _run_chunk(
+    function: Callable, items: Sequence, on_result: Optional[Callable] = None
+) -> list:
+    # tgpipeline.Pipeline のように map を持つものは、チャンク全体をまとめて渡す
+    if hasattr(function, "map"):
+        return function.map(items, on_result)
+    results = []
+    for i, item in enumerate(items):
+        try:
+            results.append(function(item))
+        except Exception as e:
+            results.append(Failure(item, str(e)))
+        if on_result is not None:
+            on_result(i, results[-1])
+    return results
+
+
+def run_batch(
+    function: Callable,
+    items: Sequence,
+    workers: int = 1,
+    weights: Optional[Sequence[float]] = None,
+    on_result: Optional[Callable] = None,
+) -> list:
+    """items の各項目に function を適用した結果(例外が起きた項目は Failure)を items の順に返す
+
+    Args:
+        function: 1項目を処理する関数(または tgpipeline.Pipeline)。
+            ワーカープロセスに渡すので、モジュールの関数(または functools.partial)であること
+        items: 項目(ファイルパスなど)
+        workers: ワーカープロセスの数。1以下ならこのプロセスで順に処理する
+        weights: 各項目の重み(ファイルの大きさなど)。Noneなら全て同じ
+        on_result: 結果ができるたびに、このプロセスで on_result(番号, 結果) を呼ぶ
+            (終わった順。ワーカープロセスを使うときはチャンクが終わったとき)。
+            同時に2つ以上呼ばれることはない
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return _run_chunk(function, items, on_result)
+
+    if weights is None:
+        weights = [1.0] * len(items)
+    chunks = make_chunks(weights, workers * CHUNKS_PER_WORKER)
+
+    results: list = [None] * len(items)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_run_chunk, function, [items[i] for i in chunk]): chunk
+            for chunk in chunks
+        }
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                # ワーカープロセスが落ちた場合などは、そのチャンクの項目だけを失敗にする
+                chunk_results = [Failure(items[i], str(e)) for i in chunk]
+            for i, result in zip(chunk, chunk_results):
+                results[i] = result
+                if on_result is not None:
+                    on_result(i, result)
+    return results
@@ -0,0 +1,183 @@
+"""TextGridの解析結果をディスクにキャッシュする
+
+Tierごとに、ファイル中のそのTierのテキスト(ヘッダと中身)と tgreader.PARSER_VERSION の
+ハッシュをキーにして、読み込んだTierの配列を非圧縮の .npz として保存する。
+チェックエラーになったファイルを直したときは、直したTierだけが別のキーになるので、
+ほかのTierは解析せずにキャッシュから読む(tgmanifest は内容が変わったファイルを
+すべて処理し直すので、キャッシュが効くのは主にこの場合と、プログラムを変えて
+CODE_VERSION が変わり、すべてのファイルを処理し直す場合になる)。
+読み込まなかったTier(Nucleiなど)は保存しないので、キャッシュのために全Tierを読むことはない。
+キャッシュにないTierは、キャッシュを使った場合も必要になったときにファイルの内容から読む。
+内容か解析方法が変われば別のキーになるので、古いキャッシュは使われず、
+容量の上限を超えたときに古いもの(最後に使われたのが古い順)から消される。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+import tgreader
+
+CACHE_DIR = ".tgcache"
+# キャッシュ全体の上限(バイト)
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _save_npz(path: str, tier: tgreader.TierArrays) -> None:
+    meta = {
+        "version": tgreader.PARSER_VERSION,
+        "name": tier.name,
+        "class": tier.tier_class,
+        "xmin": tier.xmin,
+        "xmax": tier.xmax,
+    }
+    arrays = {
+        "meta": np.array(json.dumps(meta, ensure_ascii=False)),
+        "start": tier.start,
+        "end": tier.end,
+        "codes": np.asarray(tier.codes, dtype=np.int32),
+        # 空のTierでも文字列の配列にする
+        "labels": np.array(list(tier.labels), dtype=np.str_),
+    }
+
+    # 途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _load_npz(path: str) -> tgreader.TierArrays:
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz["meta"]))
+        if meta["version"] != tgreader.PARSER_VERSION:
+            raise ValueError(f"parser version mismatch: {meta['version']}")
+        start = npz["start"]
+        end = npz["end"]
+        codes = npz["codes"]
+        labels = npz["labels"].tolist()
+
+    return tgreader.TierArrays(
+        meta["name"],
+        meta["class"],
+        meta["xmin"],
+        meta["xmax"],
+        start,
+        start if meta["class"] == tgreader.POINT_TIER else end,
+        codes,
+        labels,
+    )
+
+
+class TextgridCache:
+    """TextGridの解析結果のキャッシュ
+
+    使い方:
+        cache = TextgridCache()
+        document = cache.parse(raw, tiers)
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> (最後に使った時刻, サイズ)
+        self._entries: Dict[str, Tuple[float, int]] = {}
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    st = entry.stat()
+                    self._entries[entry.name[:-4]] = (st.st_mtime, st.st_size)
+
+    @staticmethod
+    def key(source: str) -> str:
+        """Tierのテキスト(TextgridArrays.tier_source)と解析方法のバージョンからキーを作る"""
+        h = hashlib.sha256(source.encode("utf-8"))
+        h.update(f"parser-{tgreader.PARSER_VERSION}".encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def parse(
+        self,
+        raw: bytes,
+        tiers: Optional[Sequence[tgreader.TierKey]] = None,
+        check: Optional[Callable[[tgreader.TextgridArrays], None]] = None,
+    ) -> tgreader.TextgridArrays:
+        """ファイルの内容(バイト列)から tgreader.read_textgrid と同じものを作る
+
+        tiers のうちキャッシュにあるTierは解析せず、キャッシュにないTierだけを解析して
+        キャッシュに入れる。tiers 以外のTierは必要になったときに読む
+
+        check を指定したときは、Tierの中身を読む前(ヘッダだけを読んだ状態)の文書を渡す。
+        check が例外を送出した場合は、Tierの中身は読まず、キャッシュもしない
+        """
+        # ヘッダとTierの位置だけを調べる(Tierの中身は読まない)
+        document = tgreader.parse_textgrid(tgreader.decode_textgrid(raw), ())
+        if check is not None:
+            check(document)
+
+        names = document.names(range(len(document)) if tiers is None else tiers)
+        keys = {name: self.key(document.tier_source(name)) for name in names}
+        cached = [tier for tier in map(self.get, keys.values()) if tier is not None]
+        document.restore(cached)
+
+        restored = {tier.name for tier in cached}
+        for name in names:
+            if name not in restored:
+                self.put(keys[name], document.tier(name))
+        return document
+
+    def get(self, key: str) -> Optional[tgreader.TierArrays]:
+        if key not in self._entries:
+            return None
+        path = self._path(key)
+        try:
+            tier = _load_npz(path)
+        except Exception:
+            # 壊れている・古い形式のキャッシュは捨てる
+            self._remove(key)
+            return None
+
+        # LRUのため、使った時刻を更新する
+        try:
+            os.utime(path)
+            self._entries[key] = (os.stat(path).st_mtime, self._entries[key][1])
+        except OSError:
+            pass
+        return tier
+
+    def put(self, key: str, tier: tgreader.TierArrays) -> None:
+        path = self._path(key)
+        _save_npz(path, tier)
+        st = os.stat(path)
+        self._entries[key] = (st.st_mtime, st.st_size)
+        self.evict()
+
+    def evict(self) -> None:
+        """容量の上限を超えていたら、最後に使われたのが古いものから消す"""
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for key, (_, size) in sorted(self._entries.items(), key=lambda x: x[1][0]):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
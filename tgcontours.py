@@ -0,0 +1,271 @@
+"""音声のフレームごとの値(Intensity / Pitch など)をディスクにキャッシュする
+
+音声ファイルの内容の sha256 と解析の名前をキーにして、解析で求めた Contour を
+float32 のまま並べたファイルに保存する。読むときはメモリマップで開くので、
+長い録音でもファイル全体は読み込まない。
+Tier3 の境界を直しただけなら音声は変わらないので、解析はせずにキャッシュの値から
+intervalごとの平均(tgacoustic.interval_means)を求め直すだけで済む。
+
+音声の sha256 は、サイズと更新時刻が前回と同じであればファイルを読まずに前回の値を使う
+(tgmanifest と同じ)。容量の上限を超えたときは、最後に使われたのが古い順に消す(tgcache と同じ)。
+
+ファイルの形:
+    ヘッダ: MAGIC, Contour の数 (uint32)
+    Contour ごと: 名前 (16バイト), first_time, time_step (float64), 開始位置, 長さ (uint64)
+    値: すべての Contour の値 (float32) をつなげたもの
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+import tgacoustic
+
+CACHE_DIR = ".tgcontours"
+# キャッシュ全体の上限(バイト)。1時間の録音の Intensity と Pitch で約15MB
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+MAGIC = b"TGCONTR1"
+_HEADER = struct.Struct("<8sI")
+_ENTRY = struct.Struct("<16sddQQ")
+_SUFFIX = ".contours"
+# 音声ファイルのパス -> サイズ・更新時刻・sha256 の記録を置くディレクトリ
+_STAMP_DIR = "audio"
+
+Contours = Dict[str, tgacoustic.Contour]
+
+
+def _write_atomic(path: str, write: Callable) -> None:
+    # 途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_contours(path: str, contours: Contours) -> None:
+    entries = []
+    offset = 0
+    for name, contour in contours.items():
+        entries.append(
+            _ENTRY.pack(
+                name.encode("ascii"),
+                contour.first_time,
+                contour.time_step,
+                offset,
+                len(contour),
+            )
+        )
+        offset += len(contour)
+
+    def write(f):
+        f.write(_HEADER.pack(MAGIC, len(entries)))
+        f.write(b"".join(entries))
+        for contour in contours.values():
+            f.write(np.asarray(contour.values, dtype="<f4").tobytes())
+
+    _write_atomic(path, write)
+
+
+def _load_contours(path: str) -> Contours:
+    with open(path, "rb") as fd:
+        magic, count = _HEADER.unpack(fd.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"not a contour cache: {path}")
+        entries = [_ENTRY.unpack(fd.read(_ENTRY.size)) for _ in range(count)]
+    data_offset = _HEADER.size + _ENTRY.size * count
+    total = sum(length for *_, length in entries)
+    if os.path.getsize(path) != data_offset + 4 * total:
+        raise ValueError(f"truncated contour cache: {path}")
+    values = (
+        np.memmap(path, dtype="<f4", mode="r", offset=data_offset, shape=(total,))
+        if total
+        else np.zeros(0, dtype="<f4")
+    )
+    return {
+        name.rstrip(b"\0").decode("ascii"): tgacoustic.Contour(
+            first_time, time_step, values[offset : offset + length]
+        )
+        for name, first_time, time_step, offset, length in entries
+    }
+
+
+def as_stored(contours: Contours) -> Contours:
+    """キャッシュに保存したときと同じ値(float32)にそろえた contours"""
+    return {
+        name: tgacoustic.Contour(
+            contour.first_time,
+            contour.time_step,
+            np.asarray(contour.values, dtype="<f4"),
+        )
+        for name, contour in contours.items()
+    }
+
+
+def get_contours(
+    cache: Optional["ContourCache"],
+    wav_path: str,
+    analysis: str,
+    compute: Callable[[tgacoustic.Samples, float], Contours],
+) -> Contours:
+    """音声ファイルを compute で解析した結果(cache があれば ContourCache.contours)
+
+    cache がなくても値は as_stored でそろえるので、キャッシュを使うかどうかで結果は変わらない
+    """
+    if cache is not None:
+        return cache.contours(wav_path, analysis, compute)
+    samples, rate = tgacoustic.open_wav(wav_path)
+    return as_stored(compute(samples, rate))
+
+
+def audio_hash(wav_path: str) -> str:
+    """音声ファイルの内容の sha256(長いファイルも少しずつ読む)"""
+    h = hashlib.sha256()
+    with open(wav_path, "rb") as fd:
+        for block in iter(lambda: fd.read(tgacoustic.SAMPLE_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ContourCache:
+    """音声の解析結果(Contour)のキャッシュ
+
+    使い方:
+        cache = ContourCache()
+        contours = cache.contours(wav_path, tgacoustic.CONTOURS_ANALYSIS, tgacoustic.contours)
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, _STAMP_DIR), exist_ok=True)
+
+        # key -> (最後に使った時刻, サイズ)
+        self._entries: Dict[str, Tuple[float, int]] = {}
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    st = entry.stat()
+                    self._entries[entry.name[: -len(_SUFFIX)]] = (
+                        st.st_mtime,
+                        st.st_size,
+                    )
+
+    @staticmethod
+    def key(sha256: str, analysis: str) -> str:
+        """音声の内容のハッシュと解析の名前からキーを作る"""
+        h = hashlib.sha256(sha256.encode())
+        h.update(f"analysis-{analysis}".encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + _SUFFIX)
+
+    def _stamp_path(self, wav_path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(wav_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, _STAMP_DIR, name + ".json")
+
+    def audio_hash(self, wav_path: str) -> str:
+        """音声ファイルの sha256
+
+        サイズと更新時刻が記録と同じであれば、ファイルを読まずに記録のハッシュを使う
+        """
+        st = os.stat(wav_path)
+        state = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        stamp_path = self._stamp_path(wav_path)
+        try:
+            with open(stamp_path, "r", encoding="utf-8") as fd:
+                stamp = json.load(fd)
+            if stamp["size"] == state["size"] and stamp["mtime"] == state["mtime"]:
+                return stamp["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        state["sha256"] = audio_hash(wav_path)
+        text = json.dumps(state).encode("utf-8")
+        _write_atomic(stamp_path, lambda f: f.write(text))
+        return state["sha256"]
+
+    def contours(
+        self,
+        wav_path: str,
+        analysis: str,
+        compute: Callable[[tgacoustic.Samples, float], Contours],
+    ) -> Contours:
+        """音声ファイルを compute で解析した結果。同じ内容・同じ解析はキャッシュから読む
+
+        Args:
+            wav_path: WAVのファイルパス
+            analysis: 解析の名前(compute の手順やパラメータを変えたら名前も変える)
+            compute: (サンプル, サンプリング周波数) から 名前 -> Contour を求める関数
+                (名前は16バイトまでのASCII)
+        """
+        key = self.key(self.audio_hash(wav_path), analysis)
+        contours = self.get(key)
+        if contours is not None:
+            return contours
+
+        samples, rate = tgacoustic.open_wav(wav_path)
+        contours = compute(samples, rate)
+        self.put(key, contours)
+        # 次からキャッシュを使ったときと同じ値(float32)にそろえる
+        cached = self.get(key)
+        return contours if cached is None else cached
+
+    def get(self, key: str) -> Optional[Contours]:
+        if key not in self._entries:
+            return None
+        path = self._path(key)
+        try:
+            contours = _load_contours(path)
+        except Exception:
+            # 壊れているキャッシュは捨てる
+            self._remove(key)
+            return None
+
+        # LRUのため、使った時刻を更新する
+        try:
+            os.utime(path)
+            self._entries[key] = (os.stat(path).st_mtime, self._entries[key][1])
+        except OSError:
+            pass
+        return contours
+
+    def put(self, key: str, contours: Contours) -> None:
+        path = self._path(key)
+        _save_contours(path, contours)
+        st = os.stat(path)
+        self._entries[key] = (st.st_mtime, st.st_size)
+        self.evict()
+
+    def evict(self) -> None:
+        """容量の上限を超えていたら、最後に使われたのが古いものから消す"""
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for key, (_, size) in sorted(self._entries.items(), key=lambda x: x[1][0]):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,620 @@
+"""音節核(Nuclei)のまわりの特徴から有声休止(filled pause)を見つける
+
+batchrate.praat から呼ばれる FilledPauses.praat と同じことを、Praatを使わずに行う。
+
+1. setSB: To Intensity: 100, 0, "yes" で、音節核の間の最小と、音節核から -6 dB 下がるところを
+   求め、音節の範囲(ts, te)と DFauto のTierの境界を決める
+2. doGlobalAnalyses: 全音節の F0 (To Pitch (ac)) と F1-F3 (To Formant (burg)) の中央値
+3. sdF0 / sdFmt: 音節ごとの F0, F1-F3 の中央値・全体の中央値との差・90%の幅・標準偏差
+4. processData: z 得点にして言語ごとの式で得点を求め、閾値を超えた音節を "fp" にする
+
+音節ごとの計算は、全音節のフレームを1つの配列に並べて一度に行う。
+音声の解析(Intensity, Pitch, Formant)は tgcontours にキャッシュできるので、
+閾値を変えて実行し直すときは解析をせずに得点と分類だけを求め直す。
+
+Praat との違い:
+- doGlobalAnalyses は音節を切り出してつなげた音声を解析するが、ここでは音声全体の解析の
+  音節の範囲のフレームを集めて求める(つなぎ目の 0.01 秒の重なりの影響がない)
+- Pitch の標準偏差はフレームの値をその区間で一定として求め、Formant の標準偏差の平均は
+  フレームの値の平均を使う(Praat はフレームの間を線形に補間する)
+- 2回目の To Pitch と To Formant の上限は、1回目の F0 の中央値を F0_RESOLUTION に丸めてから
+  決める(上限の違いは Pitch で 1.25 Hz、Formant で 2 Hz 以下)。境界や閾値を少し変えても
+  F0 の中央値が同じ幅に入っていれば、音声の解析をやり直さずにキャッシュを使える
+
+FilledPauses.praat の出力との比較は tgreference.py で行う(fixtures/praat の合成音。DFauto の境界と
+ラベルは一致し、得点の差は 0.05 以内)。
+"""
+
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import tgacoustic
+import tgcontours
+import tgnuclei
+import tgreader
+
+# FilledPauses.praat のフォームの選択肢と、batchrate.praat の既定値
+LANGUAGE_ENGLISH = "English"
+LANGUAGE_DUTCH = "Dutch"
+LANGUAGES = (LANGUAGE_ENGLISH, LANGUAGE_DUTCH)
+FILLED_PAUSE_THRESHOLD = 2.0
+
+# FilledPauses.praat で固定のパラメータ
+INTENSITY_MIN_PITCH = 100.0
+SYLLABLE_DROP_DB = 6.0
+BOUNDARY_OFFSET = 0.00005
+# 2回目の To Pitch の上限と、To Formant の上限は、1回目の F0 の中央値から決める
+PITCH_CEILING_FACTOR = 2.5
+# 上限を決める F0 の中央値を丸める幅 (Hz)。tgcontours のキャッシュのキーにも使う
+F0_RESOLUTION = 1.0
+MAX_FORMANTS = 4.0
+FORMANT_CEILING_BASE = 4000.0
+FORMANT_CEILING_SLOPE = 4.0
+FORMANT_WINDOW_LENGTH = 0.025
+PRE_EMPHASIS = 50.0
+# 得点の閾値(Filled_Pause_threshold を掛ける)
+SCORE_THRESHOLD = {LANGUAGE_ENGLISH: 3.4942, LANGUAGE_DUTCH: 2.7094}
+
+FILLED_PAUSE_LABEL = "fp"
+# FilledPauses.praat を変えて、English で fp でない音節には "v" を入れている
+VOICED_LABEL = "v"
+REPAIR_TIER = "Repair"
+JAPANESE_TIER = "Japanese"
+
+# 音節ごとの特徴の表(Save_Table)の列と拡張子
+TABLE_COLUMNS = (
+    "type ts dur durz F0 F0z F1 F1z F2 F2z F3 F3z dF0 dF0z dF1 dF1z dF2 dF2z dF3 dF3z"
+    " dqF0 dqF0z dqF1 dqF1z dqF2 dqF2z dqF3 dqF3z"
+    " sdF0 sdF0z sdF1 sdF1z sdF2 sdF2z sdF3 sdF3z score"
+).split()
+TABLE_SUFFIX = ".auto.Table"
+
+# tgcontours のキャッシュのキーに入れる解析の名前。計算の手順やパラメータを変えたら変える
+CONTOURS_ANALYSIS = "filled-pauses-1"
+VOICE_ANALYSIS = "filled-pauses-voice-1"
+
+# 音節ごとの特徴(z 得点にする前の値)の名前
+FEATURES = (
+    "dur F0 F1 F2 F3 dF0 dF1 dF2 dF3 dqF0 dqF1 dqF2 dqF3 sdF0 sdF1 sdF2 sdF3"
+).split()
+# 値がない場合に平均で置き換える特徴(replaceUndefinedF0)
+F0_FEATURES = ("F0", "dF0", "dqF0", "sdF0")
+_FORMANTS = ("F1", "F2", "F3")
+
+Features = Dict[str, np.ndarray]
+
+
+def dfauto_tier_name(language: str) -> str:
+    """FilledPauses.praat が作るTierの名前"""
+    return f"DFauto ({language})"
+
+
+def hertz_to_semitones(values: np.ndarray) -> np.ndarray:
+    """Praat の "semitones re 100 Hz\" """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 12.0 * np.log2(np.asarray(values, dtype=float) / 100.0)
+
+
+def hertz_to_bark(values: np.ndarray) -> np.ndarray:
+    """Praat の NUMhertzToBark"""
+    return 7.0 * np.arcsinh(np.asarray(values, dtype=float) / 650.0)
+
+
+def _expand(first: np.ndarray, last: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """各範囲 [first, last] の番号を並べた (範囲の番号, 番号) の配列"""
+    counts = np.maximum(last - first + 1, 0)
+    owner = np.repeat(np.arange(len(first)), counts)
+    index = (
+        np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+        + np.repeat(first, counts)
+    )
+    return owner, index
+
+
+def _frame_values(values: np.ndarray, index: np.ndarray) -> np.ndarray:
+    """フレーム index(0始まり)の値。範囲外は NaN(比較は常に偽になる)"""
+    result = np.full(len(index), np.nan)
+    inside = (index >= 0) & (index < len(values))
+    result[inside] = values[index[inside]]
+    return result
+
+
+def _window_values(
+    contour: tgacoustic.Contour, start: np.ndarray, end: np.ndarray, convert
+) -> Tuple[np.ndarray, np.ndarray]:
+    """各窓 [start, end] の中の値のあるフレームの (窓の番号, 単位を変えた値)"""
+    first, last = tgnuclei.window_samples(contour, start, end)
+    owner, index = _expand(first, last)
+    values = convert(_frame_values(contour.values, index))
+    defined = ~np.isnan(values)
+    return owner[defined], values[defined]
+
+
+def window_quantiles(
+    owner: np.ndarray, values: np.ndarray, n_windows: int, q: float
+) -> np.ndarray:
+    """窓ごとの Get quantile(tgnuclei.quantile と同じ NUMquantile)。値がない窓は NaN"""
+    data = values[np.lexsort((values, owner))]
+    counts = np.bincount(owner, minlength=n_windows)
+    have = counts > 0
+    counts = counts[have]
+    offset = np.cumsum(counts) - counts
+    place = q * counts + 0.5
+    left = np.floor(place).astype(np.int64)
+    # NUMquantile と同じく、両端の外は最初と最後の値
+    low = offset + np.clip(left - 1, 0, counts - 1)
+    high = offset + np.clip(left, 0, counts - 1)
+    fraction = np.where((left >= 1) & (left < counts), place - left, 0.0)
+    result = np.full(n_windows, np.nan)
+    result[have] = data[low] + fraction * (data[high] - data[low])
+    return result
+
+
+def _window_deviations(
+    owner: np.ndarray, values: np.ndarray, n_windows: int
+) -> np.ndarray:
+    """窓ごとのフレームの値の標準偏差(Formant の Get standard deviation)。2個未満なら NaN"""
+    counts = np.bincount(owner, minlength=n_windows)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(owner, values, minlength=n_windows) / counts
+        squares = np.bincount(owner, (values - mean[owner]) ** 2, minlength=n_windows)
+        return np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+
+
+def _interval_deviations(
+    contour: tgacoustic.Contour, start: np.ndarray, end: np.ndarray
+) -> np.ndarray:
+    """各interval の値の標準偏差(Pitch の Get standard deviation)
+
+    Praat と同じく、重みの合計からフレーム1つ分を引いたもので割る
+    """
+    weight, total, squares = tgacoustic.interval_integrals(contour, start, end, order=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = (squares - total * total / weight) / (weight - contour.time_step)
+        return np.where(
+            weight > contour.time_step, np.sqrt(np.maximum(variance, 0.0)), np.nan
+        )
+
+
+def _last_below(values, first, last, threshold) -> np.ndarray:
+    """各範囲 [first, last] で threshold より小さい最後のフレーム。なければ -1"""
+    owner, index = _expand(first, last)
+    hit = _frame_values(values, index) < threshold[owner]
+    result = np.full(len(first), -1)
+    owner, index = owner[hit][::-1], index[hit][::-1]
+    found, position = np.unique(owner, return_index=True)
+    result[found] = index[position]
+    return result
+
+
+def _first_below(values, first, last, threshold) -> np.ndarray:
+    """各範囲 [first, last] で threshold より小さい最初のフレーム。なければ -1"""
+    owner, index = _expand(first, last)
+    hit = _frame_values(values, index) < threshold[owner]
+    result = np.full(len(first), -1)
+    owner, index = owner[hit], index[hit]
+    found, position = np.unique(owner, return_index=True)
+    result[found] = index[position]
+    return result
+
+
+def syllable_boundaries(
+    intensity: tgacoustic.Contour,
+    nuclei: np.ndarray,
+    phrases: tgreader.TierArrays,
+    xmin: float,
+    xmax: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """FilledPauses.praat の setSB。各音節の範囲と、DFauto のTierの境界
+
+    音節核から前後に、Intensity が音節核より SYLLABLE_DROP_DB 下がるか、
+    音節核の間の最小を越えるところまで広げ、音節核のある Phrases のintervalの中に収める
+
+    Returns:
+        (ts, te, 境界)。境界は音節ごとに始めと終わりを並べたもの
+    """
+    n = len(nuclei)
+    x1, dx = intensity.first_time, intensity.time_step
+    n_frames = len(intensity)
+    values = np.asarray(intensity.values, dtype=float)
+
+    # 音節核の間(最初と最後は音声の端まで)の最小の時刻
+    edges = np.concatenate([[xmin], nuclei, [xmax]])
+    _, minimum = tgnuclei.window_extrema(intensity, edges[:-1], edges[1:])
+
+    def time_of(frame):
+        return x1 + (frame - 1) * dx
+
+    # 以下、フレームの番号は Praat と同じく1始まり
+    nucleus = np.floor((nuclei - x1) / dx + 1.0 + 0.5).astype(np.int64)
+    threshold = _frame_values(values, nucleus - 1) - SYLLABLE_DROP_DB
+
+    # 前に広げる: 音節の前の最小より前のフレーム(と1番目のフレーム)で必ず止まる
+    stop = np.ceil((minimum[:-1] - x1) / dx + 1.0).astype(np.int64) - 1
+    stop += time_of(stop + 1) < minimum[:-1]
+    stop -= time_of(stop) >= minimum[:-1]
+    stop = np.maximum(stop, 1)
+    below = _last_below(values, stop, nucleus - 2, threshold)
+    frame_from = np.where(below >= 0, below + 1, stop)
+    frame_from = np.where(stop >= nucleus - 1, nucleus - 1, frame_from)
+
+    # 後に広げる: 音節の後の最小より後のフレーム(と最後のフレーム)で必ず止まる
+    stop = np.floor((minimum[1:] - x1) / dx + 1.0).astype(np.int64) + 1
+    stop -= time_of(stop - 1) > minimum[1:]
+    stop += time_of(stop) <= minimum[1:]
+    stop = np.minimum(stop, n_frames)
+    below = _first_below(values, nucleus, np.maximum(stop - 2, -1), threshold)
+    frame_to = np.where(below >= 0, below + 1, stop)
+    frame_to = np.where(stop <= nucleus + 1, nucleus + 1, frame_to)
+
+    t_from = time_of(frame_from)
+    t_to = time_of(frame_to)
+    if len(phrases):
+        # Get interval at time: 音節核を含む(始め <= 時刻 < 終わり)Phrases のinterval
+        phrase = np.clip(
+            np.searchsorted(phrases.start, nuclei, side="right") - 1,
+            0,
+            len(phrases) - 1,
+        )
+        t_from = np.maximum(phrases.start[phrase], t_from)
+        t_to = np.minimum(phrases.end[phrase], t_to)
+
+    before = t_from > minimum[:-1]
+    after = t_to < minimum[1:]
+    ts = np.where(before, t_from, minimum[:-1])
+    te = np.where(after, t_to, minimum[1:])
+    bounds = np.empty(2 * n)
+    bounds[0::2] = np.where(before, t_from, minimum[:-1] + BOUNDARY_OFFSET)
+    bounds[1::2] = np.where(after, t_to, minimum[1:] - BOUNDARY_OFFSET)
+    # Phrases と同じく、フレームの時刻から求めた境界の浮動小数点の誤差を残さない
+    return ts, te, np.round(bounds, tgnuclei.TIME_DECIMALS)
+
+
+def global_f0(pitch: tgacoustic.Contour, ts: np.ndarray, te: np.ndarray) -> float:
+    """全音節の F0 の中央値 (Hz)。2回目の To Pitch と To Formant の上限を決める"""
+    _, values = _window_values(pitch, ts, te, lambda v: v)
+    return tgnuclei.quantile(values, 0.5)
+
+
+def voice_contours(
+    samples: tgacoustic.Samples, rate: float, f0: float
+) -> Dict[str, tgacoustic.Contour]:
+    """全音節の F0 の中央値 f0 から上限を決めた Pitch と F1-F3(tgcontours にキャッシュする)"""
+    pitch = tgacoustic.pitch_contour(
+        samples,
+        rate,
+        tgnuclei.PITCH_TIME_STEP,
+        tgnuclei.PITCH_FLOOR,
+        PITCH_CEILING_FACTOR * f0,
+        tgnuclei.MAX_CANDIDATES,
+        tgnuclei.SILENCE_THRESHOLD,
+        tgnuclei.VOICING_THRESHOLD,
+        tgnuclei.OCTAVE_COST,
+        tgnuclei.OCTAVE_JUMP_COST,
+        tgnuclei.VOICED_UNVOICED_COST,
+    )
+    formants = tgacoustic.formant_contours(
+        samples,
+        rate,
+        0.0,
+        MAX_FORMANTS,
+        FORMANT_CEILING_BASE + FORMANT_CEILING_SLOPE * (f0 - 100.0),
+        FORMANT_WINDOW_LENGTH,
+        PRE_EMPHASIS,
+    )
+    found = {tgacoustic.PITCH_TIER: pitch}
+    found.update(zip(_FORMANTS, formants))
+    return found
+
+
+def syllable_features(
+    ts: np.ndarray, te: np.ndarray, voice: Dict[str, tgacoustic.Contour]
+) -> Features:
+    """FilledPauses.praat の sdF0 と sdFmt。音節ごとの特徴
+
+    全体の中央値(qGlobF0 など)は、全音節のフレームの値から求める
+    """
+    n = len(ts)
+    features = {"dur": te - ts}
+
+    pitch = voice[tgacoustic.PITCH_TIER]
+    owner, values = _window_values(pitch, ts, te, hertz_to_semitones)
+    global_median = tgnuclei.quantile(values, 0.5)
+    features["F0"] = window_quantiles(owner, values, n, 0.5)
+    features["dF0"] = global_median - features["F0"]
+    features["dqF0"] = window_quantiles(owner, values, n, 0.95) - window_quantiles(
+        owner, values, n, 0.05
+    )
+    semitones = tgacoustic.Contour(
+        pitch.first_time, pitch.time_step, hertz_to_semitones(pitch.values)
+    )
+    features["sdF0"] = _interval_deviations(semitones, ts, te)
+
+    for name in _FORMANTS:
+        formant = voice[name]
+        owner, values = _window_values(formant, ts, te, hertz_to_bark)
+        global_median = tgnuclei.quantile(values, 0.5)
+        features[name] = window_quantiles(owner, values, n, 0.5)
+        features["dq" + name] = window_quantiles(
+            owner, values, n, 0.95
+        ) - window_quantiles(owner, values, n, 0.05)
+        features["sd" + name] = _window_deviations(owner, values, n)
+
+        # 音節の始めと終わりに近いフレームの間で、全体の中央値との差の平均
+        # (値のないフレームも数に入れる)
+        x1, dx = formant.first_time, formant.time_step
+        first = np.maximum(np.floor((ts - x1) / dx + 1.0 + 0.5).astype(np.int64), 1)
+        last = np.floor((te - x1) / dx + 1.0 + 0.5).astype(np.int64)
+        frame_owner, index = _expand(first - 1, last - 1)
+        distance = np.abs(
+            global_median - hertz_to_bark(_frame_values(formant.values, index))
+        )
+        defined = ~np.isnan(distance)
+        total = np.bincount(frame_owner[defined], distance[defined], minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            features["d" + name] = np.where(
+                last >= first, total / (last - first + 1), np.nan
+            )
+    return features
+
+
+def z_scores(features: Features) -> Features:
+    """FilledPauses.praat の replaceUndefinedF0 と z-transform
+
+    F0 の特徴は、値のない音節を平均で置き換えてから z 得点にする
+    """
+    z = {}
+    for name in FEATURES:
+        values = features[name]
+        if name in F0_FEATURES:
+            defined = values[~np.isnan(values)]
+            if len(defined):
+                values = np.where(np.isnan(values), defined.mean(), values)
+        # Praat の mean と stdev(値のないものがあれば値なし)
+        n = len(values)
+        mean = values.mean() if n else np.nan
+        sd = np.sqrt(((values - mean) ** 2).sum() / (n - 1)) if n > 1 else np.nan
+        with np.errstate(invalid="ignore", divide="ignore"):
+            z[name] = (values - mean) / sd
+    return z
+
+
+def scores(features: Features, z: Features, language: str) -> np.ndarray:
+    """音節ごとの得点(大きいほど有声休止らしい)"""
+    f = features
+    with np.errstate(invalid="ignore"):
+        if language == LANGUAGE_ENGLISH:
+            return (
+                4.73 * np.sqrt(f["dur"])
+                - 0.29 * z["F0"]
+                - 0.32 * np.sqrt(f["sdF1"])
+                - 0.10 * np.sqrt(f["dF1"])
+                - 1.38 * np.sqrt(f["sdF2"])
+                - 0.80 * np.sqrt(f["dF2"])
+                - 0.20 * (f["F2"] - f["F1"])
+                + 0.31 * f["F3"]
+            )
+        if language == LANGUAGE_DUTCH:
+            return (
+                8.62 * np.sqrt(f["dur"])
+                - 0.36 * z["F0"]
+                - 0.72 * np.sqrt(f["dF1"])
+                - 1.36 * np.sqrt(f["sdF2"])
+                - 1.62 * np.sqrt(f["dF2"])
+                - 1.02 * np.sqrt(f["sdF3"])
+                - 0.11 * (f["F2"] - f["F1"])
+                + 0.21 * f["F3"]
+            )
+    raise ValueError(f"language not supported: {language}")
+
+
+def classify(score: np.ndarray, language: str, threshold: float) -> List[str]:
+    """得点が閾値を超えた音節を "fp" にしたラベル(得点がない音節は超えないものとする)"""
+    filled = score > SCORE_THRESHOLD[language] * threshold
+    other = VOICED_LABEL if language == LANGUAGE_ENGLISH else ""
+    return [FILLED_PAUSE_LABEL if f else other for f in filled.tolist()]
+
+
+def dfauto_tier(
+    bounds: np.ndarray, labels: Sequence[str], xmin: float, xmax: float, language: str
+) -> tgreader.TierArrays:
+    """境界(音節ごとに始めと終わり)で分け、音節のintervalにラベルを入れた DFauto のTier
+
+    Praat の Insert boundary と同じく、同じ時刻の境界や音声の端の境界は入れられない。
+    その場合は、入れられない境界の時刻を示して ValueError を送出する
+    (tgbatch ではそのファイルだけが Failure になる)
+    """
+    bounds = np.sort(bounds)
+    problems = []
+    if len(bounds):
+        if bounds[0] <= xmin:
+            problems.append(f"{bounds[0]} (音声の始め)")
+        if bounds[-1] >= xmax:
+            problems.append(f"{bounds[-1]} (音声の終わり)")
+        same = np.unique(bounds[1:][np.diff(bounds) == 0])
+        problems.extend(f"{t} (2つの音節の境界が同じ時刻)" for t in same.tolist())
+    if problems:
+        raise ValueError(
+            "DFauto のTierに音節の境界を入れられない: " + ", ".join(problems)
+        )
+    times = np.concatenate([[xmin], bounds, [xmax]])
+    vocabulary = [""]
+    codes = np.zeros(len(times) - 1, dtype=np.int32)
+    for i, label in enumerate(labels):
+        if label not in vocabulary:
+            vocabulary.append(label)
+        # 音節は挿入した境界で区切られた 2, 4, 6, ... 番目(1始まり)のinterval
+        codes[2 * i + 1] = vocabulary.index(label)
+    return tgreader.TierArrays(
+        dfauto_tier_name(language),
+        tgreader.INTERVAL_TIER,
+        xmin,
+        xmax,
+        times[:-1],
+        times[1:],
+        codes,
+        vocabulary,
+    )
+
+
+def empty_tier(name: str, xmin: float, xmax: float) -> tgreader.TierArrays:
+    """Insert interval tier で作る空のTier"""
+    return tgreader.TierArrays(
+        name,
+        tgreader.INTERVAL_TIER,
+        xmin,
+        xmax,
+        np.array([xmin]),
+        np.array([xmax]),
+        np.zeros(1, dtype=np.int32),
+        [""],
+    )
+
+
+def feature_table(
+    ts: np.ndarray,
+    features: Features,
+    z: Features,
+    score: np.ndarray,
+    labels: Sequence[str],
+) -> List[List[str]]:
+    """音節ごとの特徴の表(TABLE_COLUMNS の順。値は fixed$ (値, 3))"""
+
+    def fixed(value):
+        return tgacoustic.UNDEFINED if np.isnan(value) else f"{value:.3f}"
+
+    columns = [ts, features["dur"], z["dur"]]
+    for name in FEATURES[1:]:
+        columns += [features[name], z[name]]
+    columns.append(score)
+    return [
+        [label] + [fixed(column[i]) for column in columns]
+        for i, label in enumerate(labels)
+    ]
+
+
+def save_table(rows: List[List[str]], output_path: str) -> None:
+    """Praat の Save as tab-separated file と同じ形で保存する(空の文字列は "?")"""
+    lines = ["\t".join(TABLE_COLUMNS)]
+    lines += ["\t".join(cell or "?" for cell in row) for row in rows]
+    tmp_path = output_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8", newline="\n") as fd:
+            fd.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def filled_pauses(
+    wav_path: str,
+    nuclei_tier: tgreader.TierArrays,
+    phrases_tier: tgreader.TierArrays,
+    language: str = LANGUAGE_ENGLISH,
+    threshold: float = FILLED_PAUSE_THRESHOLD,
+    cache: Optional[tgcontours.ContourCache] = None,
+) -> Tuple[tgreader.TierArrays, List[List[str]]]:
+    """FilledPauses.praat。DFauto のTierと、音節ごとの特徴の表を作る
+
+    Args:
+        wav_path: WAVのファイルパス
+        nuclei_tier, phrases_tier: tgnuclei で作った Nuclei と Phrases のTier
+        language, threshold: FilledPauses.praat の Language と Filled_Pause_threshold
+        cache: 指定すると、音声の解析結果をキャッシュから読む(なければ解析して保存する)
+    """
+    if language not in LANGUAGES:
+        raise ValueError(f"language not supported: {language}")
+    xmin, xmax = nuclei_tier.xmin, nuclei_tier.xmax
+    nuclei = nuclei_tier.start
+    if len(nuclei) == 0:
+        return dfauto_tier(np.zeros(0), [], xmin, xmax, language), []
+
+    intensity = tgcontours.get_contours(
+        cache,
+        wav_path,
+        CONTOURS_ANALYSIS,
+        lambda samples, rate: {
+            tgacoustic.INTENSITY_TIER: tgacoustic.intensity_contour(
+                samples, rate, INTENSITY_MIN_PITCH, 0.0
+            )
+        },
+    )[tgacoustic.INTENSITY_TIER]
+    ts, te, bounds = syllable_boundaries(intensity, nuclei, phrases_tier, xmin, xmax)
+
+    # 1回目の To Pitch (ac) は音節核を探したときと同じ(前処理をしない音声の)設定
+    pitch = tgcontours.get_contours(
+        cache,
+        wav_path,
+        tgnuclei.contours_analysis(tgnuclei.PRE_PROCESSING_NONE),
+        tgnuclei.contours,
+    )[tgacoustic.PITCH_TIER]
+    f0 = global_f0(pitch, ts, te)
+    if np.isnan(f0):
+        raise ValueError("no voiced frames in the syllables")
+    f0 = round(f0 / F0_RESOLUTION) * F0_RESOLUTION
+    voice = tgcontours.get_contours(
+        cache,
+        wav_path,
+        f"{VOICE_ANALYSIS}-{f0:g}",
+        lambda samples, rate: voice_contours(samples, rate, f0),
+    )
+
+    features = syllable_features(ts, te, voice)
+    z = z_scores(features)
+    score = scores(features, z, language)
+    labels = classify(score, language, threshold)
+    tier = dfauto_tier(bounds, labels, xmin, xmax, language)
+    return tier, feature_table(ts, features, z, score, labels)
+
+
+def detect_file(
+    wav_path: str,
+    output_path: Optional[str] = None,
+    silence_threshold: float = tgnuclei.SILENCE_THRESHOLD_DB,
+    minimum_dip_near_peak: float = tgnuclei.MINIMUM_DIP_NEAR_PEAK,
+    minimum_pause_duration: float = tgnuclei.MINIMUM_PAUSE_DURATION,
+    pre_processing: str = tgnuclei.PRE_PROCESSING_NONE,
+    language: str = LANGUAGE_ENGLISH,
+    filled_pause_threshold: float = FILLED_PAUSE_THRESHOLD,
+    save_features: bool = False,
+    cache: Optional[tgcontours.ContourCache] = None,
+) -> str:
+    """batchrate.praat の1ファイル分(Detect_Filled_Pauses が yes のとき)。保存先を返す
+
+    Nuclei, Phrases, DFauto, Repair(空), Japanese(空)のTierを作り、WAVと同じ場所の
+    <名前>.auto.TextGrid(output_path を指定すればそこ)に保存する。
+    save_features なら、音節ごとの特徴の表を <名前>.auto.Table に保存する
+    """
+    # Nuclei と Phrases は、有声休止を判定しないとき(tgnuclei.detect_file)と同じ手順で作る
+    nuclei_tier, phrases_tier = tgnuclei.file_tiers(
+        wav_path,
+        silence_threshold,
+        minimum_dip_near_peak,
+        minimum_pause_duration,
+        pre_processing,
+        cache,
+    )
+    xmin, xmax = nuclei_tier.xmin, nuclei_tier.xmax
+    tier, table = filled_pauses(
+        wav_path, nuclei_tier, phrases_tier, language, filled_pause_threshold, cache
+    )
+
+    stem = os.path.splitext(wav_path)[0]
+    if save_features:
+        save_table(table, stem + TABLE_SUFFIX)
+    tiers = [
+        nuclei_tier,
+        phrases_tier,
+        tier,
+        empty_tier(REPAIR_TIER, xmin, xmax),
+        empty_tier(JAPANESE_TIER, xmin, xmax),
+    ]
+    document = tgreader.TextgridArrays.from_tiers(xmin, xmax, tiers)
+    output_path = output_path or stem + tgnuclei.AUTO_SUFFIX
+    tgacoustic.save_textgrid(document.to_textgrid(), output_path)
+    return output_path
@@ -0,0 +1,65 @@
+"""Tier間の「含まれる」関係を求める
+
+FluencyProsody.py では「Tier2の"pr"の範囲内にあるTier3の"v"」のように、
+子Tierの各intervalがどの親Tierのintervalに含まれるかを何度も調べる。
+これを子 × 親の二重ループではなく、親の開始時刻の二分探索で一度に求める。
+
+1つのIntervalTierのintervalは重ならずに並んでいるので、子 [s, e] を含みうる親は
+「開始時刻が s 以下の最後の親」だけである(それより前の親は s より前に終わっている)。
+その親について e <= 親の終了時刻 であれば含まれる。
+判定は元のループと同じく parent.start <= child.start and child.end <= parent.end で行う。
+"""
+
+from typing import Optional, Sequence
+
+import numpy as np
+
+import tgreader
+
+NOT_CONTAINED = -1
+
+
+def containing_index(
+    child_start: np.ndarray,
+    child_end: np.ndarray,
+    parent_start: np.ndarray,
+    parent_end: np.ndarray,
+) -> np.ndarray:
+    """各子intervalを含む親intervalの番号(含まれなければ NOT_CONTAINED)
+
+    親は開始時刻の順に並び、互いに重ならないこと
+    """
+    child_start = np.asarray(child_start, dtype=float)
+    child_end = np.asarray(child_end, dtype=float)
+    result = np.full(len(child_start), NOT_CONTAINED, dtype=np.intp)
+    if len(parent_start) == 0 or len(child_start) == 0:
+        return result
+
+    candidate = np.searchsorted(parent_start, child_start, side="right") - 1
+    valid = candidate >= 0
+    inside = np.zeros(len(child_start), dtype=bool)
+    inside[valid] = child_end[valid] <= parent_end[candidate[valid]]
+    result[inside] = candidate[inside]
+    return result
+
+
+def contained_in(
+    child: tgreader.TierArrays,
+    parent: tgreader.TierArrays,
+    parent_labels: Optional[Sequence[str]] = None,
+) -> np.ndarray:
+    """child の各intervalを含む parent のintervalの番号
+
+    parent_labels を指定したときは、そのラベルの親だけを対象にする
+    含まれる親がなければ NOT_CONTAINED
+    """
+    if parent_labels is None:
+        return containing_index(child.start, child.end, parent.start, parent.end)
+
+    parent_index = np.flatnonzero(parent.mask(*parent_labels))
+    found = containing_index(
+        child.start, child.end, parent.start[parent_index], parent.end[parent_index]
+    )
+    if len(parent_index) == 0:
+        return found
+    return np.where(found == NOT_CONTAINED, NOT_CONTAINED, parent_index[found])
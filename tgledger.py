@@ -0,0 +1,222 @@
+"""処理の途中で止まっても、ファイルを失ったり2回処理したりしないための記録(ジョブ台帳)
+
+TextGridごとに処理の段階(state)を SQLite(WALモード)に記録する。
+
+    pending   -> ./tgfiles にあり、これから処理する
+    checked   -> チェックを通過した
+    computed  -> 計算した(計算結果の行も記録する)
+    persisted -> 変更後のTextGridを ./success に保存した
+    moved     -> 元のファイルを ./tgfiles から消した
+    failed    -> チェックエラー(元のファイルは ./tgfiles に残る)
+
+段階はワーカープロセスからもその都度書き込み、1回ずつコミットする。
+moved になった行は、マスターデータに渡すまで台帳に残り、渡したら delivered にする。
+シャードの場合は、計算結果を merge でマスターデータにまとめ終わってから delivered にする
+(まとめる前にもう一度実行したときは、前回の分も含めて計算結果を書き出す)。途中で止まった実行の後にもう一度実行すると、
+
+- persisted のファイル(保存済みで元のファイルが残っている)は、計算し直さずに元のファイルを消す。
+  元のファイルが既に消えていれば(消した直後に止まった)、moved にする
+- moved で delivered でないファイル(元のファイルは消えている)の行は、今回の実行で渡す。
+  同じ名前で内容の違うファイルが ./tgfiles に置かれても、行を渡すまでは登録し直さない
+- それより前の段階のファイルは、元のファイルが残っているので計算し直す
+
+WALモードなので、読み込みが書き込みを待たず、複数のプロセスから少しずつ書き込める。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+PENDING = "pending"
+CHECKED = "checked"
+COMPUTED = "computed"
+PERSISTED = "persisted"
+MOVED = "moved"
+FAILED = "failed"
+
+# 他のプロセスが書き込み中のときに待つ時間(秒)
+BUSY_TIMEOUT = 60.0
+
+
+class JobLedger:
+    """ジョブ台帳
+
+    tgpipeline の計算と書き込みのスレッドから同時に使えるよう、書き込みはロックで順にする
+
+    使い方:
+        ledger = JobLedger(db_path)
+        ledger.register([(filename, sha256), ...])
+        ledger.mark(filename, CHECKED)
+        ledger.mark(filename, COMPUTED, row)
+        ...
+        rows = ledger.undelivered()
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(
+            db_path, timeout=BUSY_TIMEOUT, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "filename TEXT PRIMARY KEY, "
+                "sha256 TEXT, "
+                "state TEXT NOT NULL, "
+                "row TEXT, "
+                "delivered INTEGER NOT NULL DEFAULT 0, "
+                "updated REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS ledger_info (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            # 台帳ごとの識別子(シャードの計算結果のファイル名などに使う)
+            self.conn.execute(
+                "INSERT OR IGNORE INTO ledger_info (key, value) VALUES ('token', ?)",
+                (uuid.uuid4().hex[:12],),
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def token(self) -> str:
+        return self.conn.execute(
+            "SELECT value FROM ledger_info WHERE key = 'token'"
+        ).fetchone()[0]
+
+    def register(self, jobs: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+        """これから処理するファイルを (ファイルパス, 内容のハッシュ) で登録し、各ファイルの段階を返す
+
+        前回の実行の記録があり、内容が同じで、まだ渡していないファイルは段階をそのまま残す
+        (途中から再開する)。それ以外は pending から始める。
+        ただし moved で、まだ渡していない行があるファイルは、内容が変わっていても登録し直さず、
+        返す dict に含めない(置き換えると、その行の記録がなくなる)。行を渡した後の実行で処理する
+        """
+        states = {}
+        now = time.time()
+        with self.conn:
+            for filename, sha256 in jobs:
+                found = self.conn.execute(
+                    "SELECT sha256, state, delivered FROM jobs WHERE filename = ?",
+                    (filename,),
+                ).fetchone()
+                if found is not None and not found[2]:
+                    if found[0] == sha256:
+                        states[filename] = found[1]
+                        continue
+                    if found[1] == MOVED:
+                        continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO jobs "
+                    "(filename, sha256, state, row, delivered, updated) "
+                    "VALUES (?, ?, ?, NULL, 0, ?)",
+                    (filename, sha256, PENDING, now),
+                )
+                states[filename] = PENDING
+        return states
+
+    def mark(self, filename: str, state: str, row: Optional[dict] = None) -> None:
+        """ファイルの段階を記録する(row を渡したときは計算結果も記録する)"""
+        with self._lock, self.conn:
+            if row is None:
+                self.conn.execute(
+                    "UPDATE jobs SET state = ?, updated = ? WHERE filename = ?",
+                    (state, time.time(), filename),
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE jobs SET state = ?, row = ?, updated = ? WHERE filename = ?",
+                    (state, json.dumps(row, ensure_ascii=False), time.time(), filename),
+                )
+
+    def row(self, filename: str) -> Optional[dict]:
+        found = self.conn.execute(
+            "SELECT row FROM jobs WHERE filename = ?", (filename,)
+        ).fetchone()
+        if found is None or found[0] is None:
+            return None
+        return json.loads(found[0])
+
+    def filenames(self, state: str) -> List[str]:
+        """段階が state のファイル"""
+        return [
+            filename
+            for (filename,) in self.conn.execute(
+                "SELECT filename FROM jobs WHERE state = ? ORDER BY filename",
+                (state,),
+            )
+        ]
+
+    def sha256(self, filename: str) -> Optional[str]:
+        """登録したときのファイルの内容のハッシュ"""
+        found = self.conn.execute(
+            "SELECT sha256 FROM jobs WHERE filename = ?", (filename,)
+        ).fetchone()
+        return None if found is None else found[0]
+
+    def undelivered(self) -> List[Tuple[str, dict]]:
+        """moved になったが、まだ渡していない (ファイルパス, 計算結果の行)"""
+        return [
+            (filename, json.loads(row))
+            for filename, row in self.conn.execute(
+                "SELECT filename, row FROM jobs "
+                "WHERE state = ? AND delivered = 0 ORDER BY filename",
+                (MOVED,),
+            )
+        ]
+
+    def mark_delivered(
+        self, filenames: Sequence[str], conn: Optional[sqlite3.Connection] = None
+    ) -> None:
+        """行を渡したファイルを記録する
+
+        conn を渡したときは、その接続(同じデータベースファイル)のトランザクションの中で行う。
+        行の追記と同じトランザクションにすれば、2回渡すことはない
+        """
+        params = [(filename,) for filename in filenames]
+        sql = "UPDATE jobs SET delivered = 1 WHERE filename = ?"
+        if conn is not None:
+            conn.executemany(sql, params)
+            return
+        with self.conn:
+            self.conn.executemany(sql, params)
+
+    def mark_merged(self, jobs: Iterable[Tuple[str, str]]) -> None:
+        """シャードの計算結果をまとめ終わったファイルを (ファイルパス, 内容のハッシュ) で記録する
+
+        まとめた後に内容が変わって登録し直したファイルは、ハッシュが違うので記録しない
+        """
+        params = [(filename, sha256, MOVED) for filename, sha256 in jobs]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE jobs SET delivered = 1 "
+                "WHERE filename = ? AND sha256 = ? AND state = ?",
+                params,
+            )
+
+
+# ワーカープロセスごとに、台帳のファイルごとに1つ開いて使い回す
+# (fork で作られたプロセスは親の接続を使わないよう、プロセスIDも記録する)
+_ledgers: Dict[str, Tuple[int, JobLedger]] = {}
+
+
+def open_ledger(db_path: str) -> JobLedger:
+    """このプロセスで db_path の台帳を開く(開いていれば同じものを返す)"""
+    found = _ledgers.get(db_path)
+    if found is None or found[0] != os.getpid():
+        found = (os.getpid(), JobLedger(db_path))
+        _ledgers[db_path] = found
+    return found[1]
@@ -0,0 +1,113 @@
+"""一括処理の記録(マニフェスト)
+
+処理したTextGridごとに、パス・サイズ・更新時刻・内容のハッシュ・プログラムのバージョンと
+その結果(計算した値、またはチェックエラー)をマスターデータの隣に保存する。
+次の実行では、内容もプログラムも変わっていないファイルは計算せず、前回の結果を使う。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional, Sequence
+
+MANIFEST_FILE = "FluencyProsodyManifest.json"
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+
+def code_version(source_paths: Sequence[str]) -> str:
+    """計算に使うソースファイルの内容からバージョンを作る"""
+    h = hashlib.sha256()
+    for path in source_paths:
+        with open(path, "rb") as fd:
+            h.update(fd.read())
+    return h.hexdigest()[:16]
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+class Manifest:
+    """処理済みファイルの記録
+
+    files: パス -> {
+        "size", "mtime", "sha256", "version",
+        "status": "ok" / "failed",
+        "row": 計算した値(status == "ok"),
+        "output_sha256": 保存したTextGridのハッシュ(status == "ok"),
+        "messages": チェックエラー(status == "failed"),
+    }
+    """
+
+    def __init__(self, manifest_path: str = MANIFEST_FILE, version: str = ""):
+        self.manifest_path = manifest_path
+        self.version = version
+        self.files: Dict[str, dict] = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as fd:
+                self.files = json.load(fd)["files"]
+
+    def state(self, textgrid_file_path: str) -> dict:
+        """ファイルの現在の状態(サイズ・更新時刻・ハッシュ)
+
+        サイズと更新時刻が記録と同じであれば、ファイルを読まずに記録のハッシュを使う
+        """
+        st = os.stat(textgrid_file_path)
+        entry = self.files.get(textgrid_file_path)
+        if (
+            entry is not None
+            and entry["size"] == st.st_size
+            and entry["mtime"] == st.st_mtime
+        ):
+            sha256 = entry["sha256"]
+        else:
+            sha256 = file_hash(textgrid_file_path)
+        return {"size": st.st_size, "mtime": st.st_mtime, "sha256": sha256}
+
+    def find(self, textgrid_file_path: str, state: dict) -> Optional[dict]:
+        """内容もプログラムも同じで、前回の結果が使える記録を返す"""
+        entry = self.files.get(textgrid_file_path)
+        if entry is None:
+            return None
+        if entry["sha256"] != state["sha256"] or entry["version"] != self.version:
+            return None
+        # 更新時刻だけが変わった場合は記録を合わせておく
+        entry["size"] = state["size"]
+        entry["mtime"] = state["mtime"]
+        return entry
+
+    def record_ok(
+        self, textgrid_file_path: str, state: dict, row: dict, output_path: str
+    ) -> None:
+        self.files[textgrid_file_path] = dict(
+            state,
+            version=self.version,
+            status=STATUS_OK,
+            row=row,
+            output_sha256=file_hash(output_path),
+        )
+
+    def record_failed(
+        self, textgrid_file_path: str, state: dict, messages: List[str]
+    ) -> None:
+        self.files[textgrid_file_path] = dict(
+            state,
+            version=self.version,
+            status=STATUS_FAILED,
+            messages=messages,
+        )
+
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.manifest_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"files": self.files}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,95 @@
+"""1ファイル分の計算結果(マスターデータの1行)
+
+tgdata は計算の途中の値や変更中のTextGridも属性に持つが、マスターデータに書き出すのは
+決まった列だけなので、計算が終わったらその列だけを型をそろえて FluencyMetrics に移す。
+FluencyMetrics は __slots__ の固定の形なので、1ファイル分の大きさが小さく、
+TextGrid(tgdata)は保存したら手放せる。
+
+列の型は int(個数)・float(長さ・率)・str(ファイル名から取るもの)のどれか。
+値がない場合(0個で割ったときなど)の float は NaN になる。
+"""
+
+from typing import Dict, Mapping, Tuple
+
+# (列名, 型)。マスターデータの列の並び順(duplicate以外)
+FIELDS: Tuple[Tuple[str, type], ...] = (
+    ("filename", str),
+    ("ID", str),
+    ("RECN", str),
+    ("Date", str),
+    ("nsyll", int),
+    ("silenttot", float),
+    ("silenttot_ps", float),
+    ("silenttot_psb", float),
+    ("speakingtot", float),
+    ("asd", float),
+    ("nsounding", int),
+    ("npause", int),
+    ("npause_ps", int),
+    ("npause_psb", int),
+    ("nrFP", int),
+    ("tFP", float),
+    ("nrRP", int),
+    ("tRP", float),
+    ("durs", float),
+    ("SR", float),
+    ("SRP", float),
+    ("AR", float),
+    ("ARP", float),
+    ("MLoR", float),
+    ("PhonRat", float),
+    ("SPauseFreq", float),
+    ("SPauseDur", float),
+    ("FPauseFreq", float),
+    ("FPauseDur", float),
+    ("RpFreq", float),
+    ("RpDur", float),
+    ("SBPauseFreq", float),
+    ("SBPauseDur", float),
+    ("SWPauseFreq", float),
+    ("SWPauseDur", float),
+    ("nPVI", float),
+    ("nPVIn", int),
+    ("nVarDco", float),
+    ("nVarDcon", int),
+    ("DurAllAv", float),
+    ("DurRangeAv", float),
+    ("PPD", float),
+    ("PPDn", int),
+    ("nVarPco", float),
+    ("nVarPcon", int),
+    ("PitAllAv", float),
+    ("PitRangeAv", float),
+    ("Undefined", int),
+    ("PID", float),
+    ("PIDn", int),
+    ("nVarIco", float),
+    ("nVarIcon", int),
+    ("IntAllAv", float),
+    ("IntRangeAv", float),
+    # Intensity / Pitch のTierを何で作ったか(tgacoustic.tier_source)
+    ("tier_source", str),
+)
+
+COLUMNS: Tuple[str, ...] = tuple(name for name, _ in FIELDS)
+
+
+class FluencyMetrics:
+    """1ファイル分の計算結果
+
+    使い方:
+        metrics = FluencyMetrics(tgd.__dict__)
+        row = metrics.as_row()
+    """
+
+    __slots__ = COLUMNS
+
+    def __init__(self, values: Mapping):
+        """計算した値(列名 -> 値)から作る。足りない列があれば KeyError を送出する"""
+        # numpyの値(np.float64, np.int64 など)もPythonの int / float にそろえる
+        for name, kind in FIELDS:
+            setattr(self, name, kind(values[name]))
+
+    def as_row(self) -> Dict:
+        """マスターデータの1行分(duplicate以外)。JSONにできる"""
+        return {name: getattr(self, name) for name in COLUMNS}
@@ -0,0 +1,527 @@
+"""音声(WAV)から音節核(Nuclei)と発話区間(Phrases)のTierを作る
+
+batchrate.praat (Syllable Nuclei v3) の findSyllableNuclei と同じことを、Praatを使わずに行う。
+
+1. To Intensity: 50, 0, "yes" の 0.99 分位点から、音節核とする強さの閾値を決める
+2. To TextGrid (silences) で発話区間(pr)と無音区間(ps)に分ける
+3. Intensity の極大のうち、閾値を超え、To Pitch (ac) で有声のものを音節核の候補(peak)にする
+4. peak の間の最小(dip)と合わせ、dip-peak-dip の規則で音節核を選ぶ
+
+フレームごとの計算(Intensity, Pitch, 極大・極小の放物線補間、区間ごとの最小)は配列で一度に行う。
+無音区間の整理と dip-peak-dip の規則は前の結果に依存する手順なので、
+Praat と同じ順に1つずつ処理する(どちらも区間・peak の数だけの繰り返しで、フレームの数にはよらない)。
+
+batchrate.praat の出力との比較は tgreference.py で行う(fixtures/praat の合成音。音節核の数と Phrases は
+一致し、音節核の時刻の差は 0.001 秒以内)。
+"""
+
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+import tgacoustic
+import tgcontours
+import tgreader
+
+# batchrate.praat のフォームの既定値
+SILENCE_THRESHOLD_DB = -40.0
+MINIMUM_DIP_NEAR_PEAK = 2.0
+MINIMUM_PAUSE_DURATION = 0.25
+
+# Pre_processing の選択肢(Reduce noise は未対応)
+PRE_PROCESSING_NONE = "None"
+PRE_PROCESSING_BAND_PASS = "Band pass (300..3300 Hz)"
+PRE_PROCESSING = (PRE_PROCESSING_NONE, PRE_PROCESSING_BAND_PASS)
+
+# batchrate.praat で固定のパラメータ
+INTENSITY_MIN_PITCH = 50.0
+MINIMUM_SOUNDING_DURATION = 0.1
+PITCH_TIME_STEP = 0.02
+PITCH_FLOOR = 30.0
+PITCH_CEILING = 450.0
+MAX_CANDIDATES = 4
+SILENCE_THRESHOLD = 0.03
+VOICING_THRESHOLD = 0.25
+OCTAVE_COST = 0.01
+OCTAVE_JUMP_COST = 0.35
+VOICED_UNVOICED_COST = 0.25
+
+NUCLEI_TIER = "Nuclei"
+PHRASES_TIER = "Phrases"
+SOUNDING_LABEL = "pr"
+SILENT_LABEL = "ps"
+
+# 保存するファイルの拡張子(batchrate.praat と同じく、WAVの拡張子を置き換える)
+AUTO_SUFFIX = ".auto.TextGrid"
+# フレームの時刻から求めた境界と音節核の時刻は、この桁(秒)で丸める
+# (0.4819999999999999 のような浮動小数点の誤差を TextGrid に書かない。サンプルの間隔よりずっと細かい)
+TIME_DECIMALS = 9
+
+# tgcontours のキャッシュのキーに入れる contours の解析の名前(Pre_processing を後に付ける)。
+# 計算の手順やパラメータを変えたら、古いキャッシュを使わないように変える
+CONTOURS_ANALYSIS = "nuclei-1"
+
+
+def band_pass(
+    samples: np.ndarray,
+    rate: float,
+    low: float = 300.0,
+    high: float = 3300.0,
+    smoothing: float = 100.0,
+) -> np.ndarray:
+    """Praat の Filter (pass Hann band) と Scale peak: 0.99
+
+    音声全体のスペクトルに窓をかけるので、音声全体をメモリに読み込む
+    """
+    n = samples.shape[1]
+    nfft = 1 << max(n - 1, 0).bit_length()
+    spectrum = np.fft.rfft(samples, nfft, axis=1)
+    frequency = np.arange(spectrum.shape[1]) * rate / nfft
+    factor = np.ones(len(frequency))
+    rising = frequency < low + smoothing
+    factor[rising] = 0.5 - 0.5 * np.cos(
+        np.pi * (frequency[rising] - low + smoothing) / (2 * smoothing)
+    )
+    falling = frequency > high - smoothing
+    factor[falling] = 0.5 + 0.5 * np.cos(
+        np.pi * (frequency[falling] - high + smoothing) / (2 * smoothing)
+    )
+    factor[(frequency < low - smoothing) | (frequency > high + smoothing)] = 0.0
+    filtered = np.fft.irfft(spectrum * factor, nfft, axis=1)[:, :n]
+    peak = np.abs(filtered).max() if n else 0.0
+    if peak > 0.0:
+        filtered *= 0.99 / peak
+    return filtered
+
+
+def window_samples(
+    contour: tgacoustic.Contour, start: np.ndarray, end: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Praat の Sampled_getWindowSamples。[start, end] の中の最初と最後のフレーム(0始まり)"""
+    x1, dx = contour.first_time, contour.time_step
+    # Praat と同じく、1始まりの番号で切り上げ・切り捨てる
+    first = np.ceil((start - x1) / dx + 1.0).astype(np.int64)
+    last = np.floor((end - x1) / dx + 1.0).astype(np.int64)
+    return np.maximum(first, 1) - 1, np.minimum(last, len(contour)) - 1
+
+
+def _value_at(
+    contour: tgacoustic.Contour, times: np.ndarray, xmin: float, xmax: float
+) -> np.ndarray:
+    """Praat の Get value at time (Linear)。近い方のフレームに値がなければ NaN"""
+    values = contour.values
+    n = len(values)
+    position = (times - contour.first_time) / contour.time_step
+    left = np.floor(position).astype(np.int64)
+    phase = position - left
+    near_left = phase < 0.5
+    near = np.where(near_left, left, left + 1)
+    far = np.where(near_left, left + 1, left)
+    phase = np.where(near_left, phase, 1.0 - phase)
+
+    inside = (near >= 0) & (near < n) & (times >= xmin) & (times <= xmax)
+    f_near = np.where(inside, values[np.clip(near, 0, n - 1)], np.nan)
+    far_inside = (far >= 0) & (far < n)
+    f_far = np.where(far_inside, values[np.clip(far, 0, n - 1)], np.nan)
+    # 遠い方のフレームに値がなければ、近い方の値をそのまま使う
+    return np.where(np.isnan(f_far), f_near, f_near + phase * (f_far - f_near))
+
+
+def window_extrema(
+    contour: tgacoustic.Contour,
+    start: Sequence[float],
+    end: Sequence[float],
+    maximum: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """各窓 [start, end] の最小値(maximum=True なら最大値)とその時刻
+
+    Praat の Get minimum / Get time of minimum (Parabolic) と同じく、
+    窓の端のフレームの値と、窓の中の極小を放物線で補間した値のうち最も小さいものを選ぶ
+    """
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    sign = -1.0 if maximum else 1.0
+    y = sign * contour.values
+    n = len(y)
+    x1, dx = contour.first_time, contour.time_step
+
+    first, last = window_samples(contour, start, end)
+    empty = first > last
+    first = np.where(empty, 0, first)
+    last = np.where(empty, 0, last)
+    value = y[first]
+    position = first.astype(float)
+    lower = y[last] < value
+    value = np.where(lower, y[last], value)
+    position = np.where(lower, last, position)
+
+    # 極小(前のフレームより小さく、後のフレーム以下)を放物線で補間する
+    i = np.arange(1, n - 1)
+    i = i[(y[i] < y[i - 1]) & (y[i] <= y[i + 1])]
+    dy = 0.5 * (y[i + 1] - y[i - 1])
+    d2y = 2.0 * y[i] - y[i - 1] - y[i + 1]
+    peak_position = i + dy / d2y
+    peak_value = y[i] + 0.5 * dy * dy / d2y
+
+    # 窓ごとに、窓の中の極小を並べて、最も小さいもの(同じなら前のもの)を選ぶ
+    lo = np.searchsorted(i, np.maximum(first, 1), side="left")
+    hi = np.searchsorted(i, np.minimum(last, n - 2), side="right")
+    counts = np.where(empty, 0, np.maximum(hi - lo, 0))
+    if counts.sum():
+        window = np.repeat(np.arange(len(start)), counts)
+        k = (
+            np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(lo, counts)
+        )
+        order = np.lexsort((k, peak_value[k], window))
+        head = np.ones(len(order), dtype=bool)
+        head[1:] = window[order][1:] != window[order][:-1]
+        best = order[head]
+        window, k = window[best], k[best]
+        lower = peak_value[k] < value[window]
+        value[window[lower]] = peak_value[k][lower]
+        position[window[lower]] = peak_position[k][lower]
+
+    times = np.clip(x1 + position * dx, start, end)
+
+    if empty.any():
+        # 窓の中にフレームがなければ、窓の両端の値(線形補間)の小さい方
+        frame_times = contour.times
+        edge = x1 - 0.5 * dx, x1 + (n - 0.5) * dx
+        y_start = np.interp(start[empty], frame_times, y)
+        y_end = np.interp(end[empty], frame_times, y)
+        y_start[(start[empty] < edge[0]) | (start[empty] > edge[1])] = np.nan
+        y_end[(end[empty] < edge[0]) | (end[empty] > edge[1])] = np.nan
+        value[empty] = np.fmin(y_start, y_end)
+        times[empty] = np.where(
+            y_start == y_end,
+            0.5 * (start[empty] + end[empty]),
+            np.where(y_start < y_end, start[empty], end[empty]),
+        )
+    return sign * value, times
+
+
+def quantile(values: np.ndarray, q: float) -> float:
+    """Praat の Get quantile(NUMquantile)。値のないフレームは除く"""
+    data = np.sort(values[~np.isnan(values)])
+    n = len(data)
+    if n == 0:
+        return float("nan")
+    place = q * n + 0.5
+    left = int(np.floor(place))
+    if n == 1 or left < 1:
+        return float(data[0])
+    if left >= n:
+        return float(data[-1])
+    return float(data[left - 1] + (place - left) * (data[left] - data[left - 1]))
+
+
+def _cut_short(intervals: list, sounding: bool, minimum_duration: float) -> list:
+    """Praat の IntervalTier_cutIntervals_minimumDuration
+
+    sounding が同じで minimum_duration より短いintervalを消し、前のintervalを延ばす
+    (最初のintervalなら次のintervalを延ばす)
+    """
+    result = []
+    pending_start = None
+    for i, (start, end, is_sounding) in enumerate(intervals):
+        if pending_start is not None:
+            start, pending_start = pending_start, None
+        last = i == len(intervals) - 1
+        if is_sounding == sounding and end - start < minimum_duration:
+            if result:
+                result[-1][1] = end
+                continue
+            if not last:
+                pending_start = start
+                continue
+        result.append([start, end, is_sounding])
+    return result
+
+
+def _combine(intervals: list, sounding: bool) -> list:
+    """Praat の IntervalTier_combineIntervalsOnLabelMatch。隣り合う同じ種類のintervalをまとめる"""
+    result = []
+    for start, end, is_sounding in intervals:
+        if result and is_sounding == sounding and result[-1][2] == sounding:
+            result[-1][1] = end
+        else:
+            result.append([start, end, is_sounding])
+    return result
+
+
+def silences(
+    contour: tgacoustic.Contour,
+    xmin: float,
+    xmax: float,
+    threshold: float,
+    minimum_silence: float,
+    minimum_sounding: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Praat の To TextGrid (silences)。音声を発話区間と無音区間に分ける
+
+    Args:
+        contour: Intensity
+        threshold: 無音とする強さ(最大値からの dB。負の値)
+        minimum_silence: これより短い無音区間は前の発話区間に含める
+        minimum_sounding: これより短い発話区間は前の無音区間に含める
+
+    Returns:
+        (start, end, 発話区間かどうか) の配列
+    """
+    (db_max,), _ = window_extrema(contour, [xmin], [xmax], maximum=True)
+    (db_min,), _ = window_extrema(contour, [xmin], [xmax])
+    level = max(db_max + threshold, db_min)
+
+    # 境界は、無音/発話が変わった最初のフレームの時刻
+    silent = contour.values < level
+    change = np.flatnonzero(silent[1:] != silent[:-1]) + 1
+    times = np.round(contour.first_time + change * contour.time_step, TIME_DECIMALS)
+    bounds = np.concatenate([[xmin], times, [xmax]])
+    sounding = ~np.concatenate([silent[:1], silent[change]])
+    intervals = [
+        [start, end, is_sounding]
+        for start, end, is_sounding in zip(
+            bounds[:-1].tolist(), bounds[1:].tolist(), sounding.tolist()
+        )
+    ]
+
+    # 短い発話区間を先に除き、その後で短い無音区間を除く(Praat と同じ順)
+    if minimum_sounding > 0:
+        intervals = _cut_short(intervals, True, minimum_sounding)
+        intervals = _combine(intervals, False)
+    if minimum_silence > 0:
+        intervals = _cut_short(intervals, False, minimum_silence)
+        intervals = _combine(intervals, True)
+
+    start, end, is_sounding = zip(*intervals)
+    return np.array(start), np.array(end), np.array(is_sounding, dtype=bool)
+
+
+def intensity_peaks(contour: tgacoustic.Contour) -> Tuple[np.ndarray, np.ndarray]:
+    """Praat の To IntensityTier (peaks)。極大の (時刻, 放物線で補間した値)"""
+    y = contour.values
+    i = np.arange(1, len(y) - 1)
+    i = i[(y[i - 1] <= y[i]) & (y[i + 1] < y[i])]
+    x1, dx = contour.first_time, contour.time_step
+    values, times = window_extrema(
+        contour, x1 + (i - 1.5) * dx, x1 + (i + 1) * dx, maximum=True
+    )
+    return times, values
+
+
+def dip_peak_dip(times: np.ndarray, db: np.ndarray, minimum_dip: float) -> list:
+    """batchrate.praat の dip-peak-dip の規則で音節核の時刻を選ぶ
+
+    前後の dip との差が minimum_dip を超える peak のうち、最も強いものを音節核にする
+
+    Args:
+        times, db: 0番目は音声の始め。以降、dip(奇数番目)と peak(偶数番目)が交互に並び、
+            最後は dip
+        minimum_dip: batchrate.praat の Minimum_dip_near_peak (dB)
+    """
+    times = times.tolist()
+    db = db.tolist()
+    t0 = times[0]
+    t_rise = t_fall = t_max = t0
+    db_max = db_min = db[1]
+    nuclei = []
+    for point in range(1, len(times)):
+        if db[point] > db_max:
+            t_max, db_max = times[point], db[point]
+            if db[point] - db_min > minimum_dip:
+                t_rise, db_min = times[point], db[point]
+        elif db[point] < db_min:
+            db_min = db[point]
+            if db_max - db[point] > minimum_dip:
+                t_fall, db_max = times[point], db[point]
+
+        # batchrate.praat は音節核が発話区間にあるか(Phrasesのラベルが空でないか)も調べるが、
+        # 無音区間にも ps を入れた後なので、常に当てはまる
+        if t_rise != t0 and t_rise < t_fall and t_fall != t0:
+            nuclei.append(t_max)
+            t_max = times[point]
+            db_min = db_max = db[point]
+            t_rise = t_fall = t0
+    return nuclei
+
+
+def contours(
+    samples: tgacoustic.Samples,
+    rate: float,
+    pre_processing: str = PRE_PROCESSING_NONE,
+) -> Dict[str, tgacoustic.Contour]:
+    """音節核を探すのに使う Intensity と Pitch のフレームの値(tgcontours にキャッシュする)"""
+    if pre_processing == PRE_PROCESSING_BAND_PASS:
+        samples = band_pass(samples, rate)
+    elif pre_processing != PRE_PROCESSING_NONE:
+        raise ValueError(f"unsupported pre-processing: {pre_processing}")
+    intensity = tgacoustic.intensity_contour(samples, rate, INTENSITY_MIN_PITCH, 0.0)
+    pitch = tgacoustic.pitch_contour(
+        samples,
+        rate,
+        PITCH_TIME_STEP,
+        PITCH_FLOOR,
+        PITCH_CEILING,
+        MAX_CANDIDATES,
+        SILENCE_THRESHOLD,
+        VOICING_THRESHOLD,
+        OCTAVE_COST,
+        OCTAVE_JUMP_COST,
+        VOICED_UNVOICED_COST,
+    )
+    return {tgacoustic.INTENSITY_TIER: intensity, tgacoustic.PITCH_TIER: pitch}
+
+
+def contours_analysis(pre_processing: str = PRE_PROCESSING_NONE) -> str:
+    """contours の解析の名前(tgcontours のキャッシュのキーに入れる)"""
+    return f"{CONTOURS_ANALYSIS}-{pre_processing}"
+
+
+def syllable_nuclei(
+    samples: tgacoustic.Samples,
+    rate: float,
+    silence_threshold: float = SILENCE_THRESHOLD_DB,
+    minimum_dip_near_peak: float = MINIMUM_DIP_NEAR_PEAK,
+    minimum_pause_duration: float = MINIMUM_PAUSE_DURATION,
+    pre_processing: str = PRE_PROCESSING_NONE,
+) -> Tuple[tgreader.TierArrays, tgreader.TierArrays]:
+    """音声から Nuclei と Phrases のTierを作る(引数は batchrate.praat のフォームと同じ)
+
+    フレームの値は tgcontours のキャッシュと同じ float32 にそろえる(file_tiers と同じ結果にする)
+    """
+    found = tgcontours.as_stored(contours(samples, rate, pre_processing))
+    return nuclei_tiers(
+        found[tgacoustic.INTENSITY_TIER],
+        found[tgacoustic.PITCH_TIER],
+        0.0,
+        samples.shape[1] / rate,
+        silence_threshold,
+        minimum_dip_near_peak,
+        minimum_pause_duration,
+    )
+
+
+def nuclei_tiers(
+    intensity: tgacoustic.Contour,
+    pitch: tgacoustic.Contour,
+    xmin: float,
+    xmax: float,
+    silence_threshold: float = SILENCE_THRESHOLD_DB,
+    minimum_dip_near_peak: float = MINIMUM_DIP_NEAR_PEAK,
+    minimum_pause_duration: float = MINIMUM_PAUSE_DURATION,
+) -> Tuple[tgreader.TierArrays, tgreader.TierArrays]:
+    """求めてある contours の Intensity と Pitch から Nuclei と Phrases のTierを作る"""
+    (db_min,), _ = window_extrema(intensity, [xmin], [xmax])
+    (db_max,), _ = window_extrema(intensity, [xmin], [xmax], maximum=True)
+    # 雑音の影響を避けるため、最大値の代わりに 0.99 分位点を使う
+    db_q99 = quantile(intensity.values, 0.99)
+    threshold = max(db_q99 + silence_threshold, db_min)
+    start, end, sounding = silences(
+        intensity,
+        xmin,
+        xmax,
+        silence_threshold - (db_max - db_q99),
+        minimum_pause_duration,
+        MINIMUM_SOUNDING_DURATION,
+    )
+
+    peak_times, peak_db = intensity_peaks(intensity)
+    voiced = ~np.isnan(_value_at(pitch, peak_times, xmin, xmax))
+    keep = (peak_db > threshold) & voiced
+    peak_times, peak_db = peak_times[keep], peak_db[keep]
+
+    # peak の間(最初と最後は音声の端まで)の最小が dip
+    edges = np.concatenate([[xmin], peak_times, [xmax]])
+    dip_db, dip_times = window_extrema(intensity, edges[:-1], edges[1:])
+    times = np.empty(2 * len(peak_times) + 2)
+    db = np.full(len(times), np.nan)
+    times[0] = xmin
+    times[1::2], db[1::2] = dip_times, dip_db
+    times[2::2], db[2::2] = peak_times, peak_db
+    nuclei = np.round(
+        np.array(dip_peak_dip(times, db, minimum_dip_near_peak)), TIME_DECIMALS
+    )
+
+    nuclei_tier = tgreader.TierArrays(
+        NUCLEI_TIER,
+        tgreader.POINT_TIER,
+        xmin,
+        xmax,
+        nuclei,
+        nuclei.copy(),
+        np.arange(len(nuclei), dtype=np.int32),
+        [str(i + 1) for i in range(len(nuclei))],
+    )
+    phrases_tier = tgreader.TierArrays(
+        PHRASES_TIER,
+        tgreader.INTERVAL_TIER,
+        xmin,
+        xmax,
+        start,
+        end,
+        np.where(sounding, 0, 1).astype(np.int32),
+        [SOUNDING_LABEL, SILENT_LABEL],
+    )
+    return nuclei_tier, phrases_tier
+
+
+def file_tiers(
+    wav_path: str,
+    silence_threshold: float = SILENCE_THRESHOLD_DB,
+    minimum_dip_near_peak: float = MINIMUM_DIP_NEAR_PEAK,
+    minimum_pause_duration: float = MINIMUM_PAUSE_DURATION,
+    pre_processing: str = PRE_PROCESSING_NONE,
+    cache: Optional[tgcontours.ContourCache] = None,
+) -> Tuple[tgreader.TierArrays, tgreader.TierArrays]:
+    """WAVから Nuclei と Phrases のTierを作る
+
+    cache を指定すると、音声の解析結果をキャッシュから読む(なければ解析して保存する)。
+    キャッシュを使うかどうかで結果は変わらない(tgcontours.get_contours)
+    """
+    samples, rate = tgacoustic.open_wav(wav_path)
+    found = tgcontours.get_contours(
+        cache,
+        wav_path,
+        contours_analysis(pre_processing),
+        lambda samples, rate: contours(samples, rate, pre_processing),
+    )
+    return nuclei_tiers(
+        found[tgacoustic.INTENSITY_TIER],
+        found[tgacoustic.PITCH_TIER],
+        0.0,
+        samples.shape[1] / rate,
+        silence_threshold,
+        minimum_dip_near_peak,
+        minimum_pause_duration,
+    )
+
+
+def detect_file(
+    wav_path: str,
+    output_path: Optional[str] = None,
+    silence_threshold: float = SILENCE_THRESHOLD_DB,
+    minimum_dip_near_peak: float = MINIMUM_DIP_NEAR_PEAK,
+    minimum_pause_duration: float = MINIMUM_PAUSE_DURATION,
+    pre_processing: str = PRE_PROCESSING_NONE,
+    cache: Optional[tgcontours.ContourCache] = None,
+) -> str:
+    """WAVから Nuclei と Phrases のTierを作って保存し、保存先を返す
+
+    output_path を指定しなければ、WAVと同じ場所の <名前>.auto.TextGrid に保存する。
+    cache は file_tiers と同じ
+    """
+    tiers = file_tiers(
+        wav_path,
+        silence_threshold,
+        minimum_dip_near_peak,
+        minimum_pause_duration,
+        pre_processing,
+        cache,
+    )
+    document = tgreader.TextgridArrays.from_tiers(tiers[0].xmin, tiers[0].xmax, tiers)
+    output_path = output_path or os.path.splitext(wav_path)[0] + AUTO_SUFFIX
+    tgacoustic.save_textgrid(document.to_textgrid(), output_path)
+    return output_path
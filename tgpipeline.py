@@ -0,0 +1,117 @@
+"""読み込み・計算・書き込みを重ねて行うパイプライン
+
+ファイルごとの処理を「読み込み」「計算」「書き込み」の3段に分け、
+読み込みと書き込みはそれぞれ別のスレッドで行う。
+次のファイルの読み込みと前のファイルの書き込み(ネットワーク上のディスクなどの待ち時間)が、
+今のファイルの計算と重なる。
+
+段の間は大きさに上限のあるキューでつなぐので、計算が遅れているときは読み込みが止まり、
+書き込みが遅れているときは計算が止まる(読み込んだデータがメモリに溜まり続けない)。
+
+1つの項目で例外が起きても、その項目の結果が tgbatch.Failure になるだけで、
+他の項目の処理は続ける。結果は常に渡した項目の順に返す。
+"""
+
+import queue
+import threading
+from typing import Callable, Optional, Sequence
+
+import tgbatch
+
+# 段の間のキューに入れておける項目の数
+PIPELINE_DEPTH = 4
+
+# キューの終わりの印
+_DONE = object()
+
+
+class Pipeline:
+    """read(item) -> compute(item, data) -> write(item, computed) の3段の処理
+
+    tgbatch.run_batch に関数の代わりに渡すと、チャンクごとに map で処理される。
+    ワーカープロセスに渡すので、read / compute / write はモジュールの関数
+    (または functools.partial)であること
+    """
+
+    def __init__(
+        self,
+        read: Callable,
+        compute: Callable,
+        write: Callable,
+        depth: int = PIPELINE_DEPTH,
+    ):
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.depth = depth
+
+    def __call__(self, item):
+        """1項目を順に処理する(例外はそのまま送出する)"""
+        return self.write(item, self.compute(item, self.read(item)))
+
+    def map(self, items: Sequence, on_result: Optional[Callable] = None) -> list:
+        """全項目を処理し、結果(例外が起きた項目は tgbatch.Failure)を items の順に返す
+
+        on_result を渡したときは、各項目の処理が終わるたびに on_result(番号, 結果) を呼ぶ
+        (書き込みのスレッドから、1つずつ順に呼ぶ)
+        """
+        items = list(items)
+        results: list = [None] * len(items)
+        read_queue: queue.Queue = queue.Queue(self.depth)
+        write_queue: queue.Queue = queue.Queue(self.depth)
+
+        def reader():
+            for i, item in enumerate(items):
+                try:
+                    read_queue.put((i, self.read(item), None))
+                except Exception as e:
+                    read_queue.put((i, None, e))
+            read_queue.put(_DONE)
+
+        def finish(i, result):
+            results[i] = result
+            if on_result is not None:
+                on_result(i, result)
+
+        def writer():
+            while True:
+                task = write_queue.get()
+                if task is _DONE:
+                    return
+                i, computed = task
+                if isinstance(computed, tgbatch.Failure):
+                    # 読み込みか計算で失敗した項目(結果を渡す順をそろえるため、ここを通す)
+                    finish(i, computed)
+                    continue
+                try:
+                    result = self.write(items[i], computed)
+                except Exception as e:
+                    result = tgbatch.Failure(items[i], str(e))
+                finish(i, result)
+
+        # 計算が途中で止まった(KeyboardInterruptなど)場合に読み込みを待たないよう、
+        # 読み込みのスレッドはデーモンにする
+        read_thread = threading.Thread(target=reader, daemon=True)
+        write_thread = threading.Thread(target=writer)
+        read_thread.start()
+        write_thread.start()
+        try:
+            while True:
+                task = read_queue.get()
+                if task is _DONE:
+                    break
+                i, data, error = task
+                if error is not None:
+                    computed = tgbatch.Failure(items[i], str(error))
+                else:
+                    try:
+                        computed = self.compute(items[i], data)
+                    except Exception as e:
+                        computed = tgbatch.Failure(items[i], str(e))
+                write_queue.put((i, computed))
+        finally:
+            # 計算が終わったものは最後まで書き込む
+            write_queue.put(_DONE)
+            write_thread.join()
+        read_thread.join()
+        return results
@@ -0,0 +1,546 @@
+"""TextGrid(long / short形式)をTier毎のNumPy配列として読み込む
+
+praatio.textgrid.openTextgrid は全Tierの全intervalについて Interval を作るが、
+FluencyProsody.py が使うのは一部のTierだけである。
+ここではファイル全体を一度だけ読み、Tierの位置(ヘッダ)だけを先に調べておき、
+必要なTierの中身だけを start / end / ラベルコード の配列に変換する。
+要求されなかったTier(Nucleiなど)は、保存時など実際に必要になった時点で読む。
+"""
+
+import codecs
+import re
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from praatio import textgrid
+from praatio.utilities import errors
+
+# 解析方法を変えたときは上げる(tgcacheのキャッシュが無効になる)
+PARSER_VERSION = 1
+
+INTERVAL_TIER = "IntervalTier"
+POINT_TIER = "TextTier"
+
+TierKey = Union[int, str]
+
+# short形式: 数値 / 数値 / "ラベル" の並び
+_SHORT_INTERVAL = re.compile(r'(\S+)\s+(\S+)\s+"((?:[^"]|"")*)"')
+_SHORT_POINT = re.compile(r'(\S+)\s+"((?:[^"]|"")*)"')
+# short形式のTierヘッダ: "class" "name" xmin xmax size
+_SHORT_TOKEN = re.compile(r'"((?:[^"]|"")*)"|(\S+)')
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$")
+
+# long形式
+_LONG_INTERVAL = re.compile(
+    r'xmin\s*=\s*(\S+)\s+xmax\s*=\s*(\S+)\s+text\s*=\s*"((?:[^"]|"")*)"'
+)
+_LONG_POINT = re.compile(r'number\s*=\s*(\S+)\s+mark\s*=\s*"((?:[^"]|"")*)"')
+_LONG_CLASS = re.compile(r'class\s*=\s*"(.*)"')
+_LONG_NAME = re.compile(r'name\s*=\s*"(.*)"\s*$', re.MULTILINE)
+_LONG_XMIN = re.compile(r"xmin\s*=\s*(\S+)")
+_LONG_XMAX = re.compile(r"xmax\s*=\s*(\S+)")
+_LONG_SIZE = re.compile(r"size\s*=\s*(\d+)")
+
+
+def _clean_label(label: str) -> str:
+    # praatioと同じく前後の空白を除き、エスケープされた""を戻す
+    return label.strip().replace('""', '"')
+
+
+def _intern_labels(raw_labels: Sequence[str]):
+    """ラベル列を (コード配列, 語彙リスト) に変換する
+
+    np.unique で重複を除いた後の語彙に対してだけ文字列処理を行う
+    """
+    if len(raw_labels) == 0:
+        return np.zeros(0, dtype=np.int32), []
+
+    raw_vocab, inverse = np.unique(
+        np.asarray(raw_labels, dtype=object), return_inverse=True
+    )
+
+    labels: List[str] = []
+    index: Dict[str, int] = {}
+    remap = np.empty(len(raw_vocab), dtype=np.int32)
+    for i, raw in enumerate(raw_vocab):
+        label = _clean_label(raw)
+        if label not in index:
+            index[label] = len(labels)
+            labels.append(label)
+        remap[i] = index[label]
+
+    return remap[inverse], labels
+
+
+class TierArrays:
+    """1つのTierを列(start, end, ラベルコード)で保持する
+
+    ラベルは codes (int32) と labels (語彙) で表し、
+    labels[codes[i]] が i番目のintervalのラベルになる。
+    PointTier(TextTier)は start == end として保持する。
+
+    FluencyProsody.tgdata の計算とTierの書き換え(tgedit)もこの形のまま行い、
+    ラベルの比較はコードの比較にする。praatioのTierは保存するときにだけ作る。
+    Tierの配列は変更せず、書き換えるときは new / take で新しいものを作る
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tier_class: str,
+        xmin: float,
+        xmax: float,
+        start: np.ndarray,
+        end: np.ndarray,
+        codes: np.ndarray,
+        labels: List[str],
+    ):
+        self.name = name
+        self.tier_class = tier_class
+        self.xmin = xmin
+        self.xmax = xmax
+        self.start = start
+        self.end = end
+        self.codes = codes
+        self.labels = labels
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @property
+    def is_interval(self) -> bool:
+        return self.tier_class == INTERVAL_TIER
+
+    def code(self, label: str) -> int:
+        """ラベルのコードを返す。語彙に無いラベルは -1"""
+        try:
+            return self.labels.index(label)
+        except ValueError:
+            return -1
+
+    def mask(self, *labels: str) -> np.ndarray:
+        """ラベルが labels のいずれかである interval の bool 配列"""
+        codes = [self.code(label) for label in labels]
+        return np.isin(self.codes, [c for c in codes if c >= 0])
+
+    def label_at(self, i: int) -> str:
+        return self.labels[self.codes[i]]
+
+    def vocabulary(self, label: str) -> Tuple[List[str], int]:
+        """label を含む語彙と label のコード(語彙に無ければ加えた新しい語彙を返す)"""
+        code = self.code(label)
+        if code >= 0:
+            return self.labels, code
+        return self.labels + [label], len(self.labels)
+
+    def convert(
+        self, convert: Callable[[str], float] = float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """語彙の各ラベルを数値に変換する(Pitch, Intensity のような数値のTierに使う)
+
+        変換は語彙ごとに1回だけ行う。変換できないラベル(空白や--undefined--)は NaN
+
+        Returns:
+            (語彙ごとの値, 語彙ごとに変換できたかどうか)。codes で引くとintervalごとになる
+        """
+        values = np.full(len(self.labels), np.nan)
+        ok = np.zeros(len(self.labels), dtype=bool)
+        for i, label in enumerate(self.labels):
+            try:
+                values[i] = convert(label)
+                ok[i] = True
+            except ValueError:
+                pass
+        return values, ok
+
+    def new(
+        self,
+        start: np.ndarray,
+        end: np.ndarray,
+        codes: np.ndarray,
+        labels: Optional[List[str]] = None,
+    ) -> "TierArrays":
+        """名前と種類が同じで、intervalを入れ替えたTierを作る
+
+        praatioのTierと同じく、intervalが範囲の外にあれば範囲を広げる
+        """
+        xmin, xmax = self.xmin, self.xmax
+        if len(start):
+            xmin = min(xmin, float(start.min()))
+            xmax = max(xmax, float(end.max()))
+        return TierArrays(
+            self.name,
+            self.tier_class,
+            xmin,
+            xmax,
+            start,
+            end,
+            codes,
+            self.labels if labels is None else labels,
+        )
+
+    def take(self, where: np.ndarray) -> "TierArrays":
+        """where(bool配列または番号の配列)のintervalだけのTier"""
+        return self.new(self.start[where], self.end[where], self.codes[where])
+
+    def label_array(self) -> np.ndarray:
+        """ラベル文字列の配列(object)"""
+        return np.asarray(self.labels, dtype=object)[self.codes]
+
+    def to_praatio(self):
+        """praatioのTierに変換する(保存時など、praatioが必要な場合のみ使う)"""
+        labels = self.label_array().tolist()
+        if self.is_interval:
+            entries = list(zip(self.start.tolist(), self.end.tolist(), labels))
+            return textgrid.IntervalTier(self.name, entries, self.xmin, self.xmax)
+        entries = list(zip(self.start.tolist(), labels))
+        return textgrid.PointTier(self.name, entries, self.xmin, self.xmax)
+
+
+class _TierBlock:
+    """ファイル中の1つのTierの位置とヘッダ情報(中身はまだ読まない)"""
+
+    def __init__(
+        self, tier_class, name, xmin, xmax, size, header_start, body_start, body_end
+    ):
+        self.tier_class = tier_class
+        self.name = name
+        self.xmin = xmin
+        self.xmax = xmax
+        self.size = size
+        self.header_start = header_start
+        self.body_start = body_start
+        self.body_end = body_end
+
+
+class TextgridArrays:
+    """読み込んだTextGrid全体
+
+    Tierの一覧(名前・順序・ヘッダ)はすぐに分かるが、
+    各Tierの中身は要求されたときに初めて配列に変換される。
+    """
+
+    def __init__(
+        self,
+        xmin: float,
+        xmax: float,
+        tier_names: List[str],
+        data: Optional[str] = None,
+        blocks: Optional[List[_TierBlock]] = None,
+        short: bool = True,
+    ):
+        self._data = data
+        self._blocks = blocks
+        self._short = short
+        self._tiers: Dict[str, TierArrays] = {}
+        self.xmin = xmin
+        self.xmax = xmax
+        self.tier_names: List[str] = list(tier_names)
+
+        if len(set(self.tier_names)) != len(self.tier_names):
+            raise errors.DuplicateTierName(
+                f"Your textgrid contains tiers with the same name {self.tier_names}"
+            )
+
+    @classmethod
+    def from_tiers(
+        cls, xmin: float, xmax: float, tiers: Sequence[TierArrays]
+    ) -> "TextgridArrays":
+        """読み込み済みのTierから作る(キャッシュからの復元など)"""
+        doc = cls(xmin, xmax, [tier.name for tier in tiers])
+        doc._tiers = {tier.name: tier for tier in tiers}
+        return doc
+
+    def __len__(self) -> int:
+        return len(self.tier_names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.tier_names
+
+    def __getitem__(self, key: TierKey) -> TierArrays:
+        return self.tier(key)
+
+    def tier(self, key: TierKey) -> TierArrays:
+        """名前または番号(0始まり)でTierを取得する。未読なら読む"""
+        if isinstance(key, int):
+            name = self.tier_names[key]
+        else:
+            name = key
+        if name not in self._tiers:
+            self._tiers[name] = self._parse_block(
+                self._blocks[self.tier_names.index(name)]
+            )
+        return self._tiers[name]
+
+    def tier_classes(self) -> List[str]:
+        """各Tierの種類(IntervalTier / TextTier)。Tierの中身は読まない"""
+        if self._blocks is None:
+            return [self._tiers[name].tier_class for name in self.tier_names]
+        return [block.tier_class for block in self._blocks]
+
+    def tier_sizes(self) -> List[int]:
+        """各Tierのintervalの数
+
+        読み込み済みのTierは配列の長さ、未読のTierはヘッダの size を返す
+        (Tierの中身は読まない)
+        """
+        sizes = []
+        for i, name in enumerate(self.tier_names):
+            if name in self._tiers:
+                sizes.append(len(self._tiers[name]))
+            else:
+                sizes.append(self._blocks[i].size)
+        return sizes
+
+    def tiers(self) -> List[TierArrays]:
+        """全Tierをファイル中の順序で返す(未読のTierも読む)"""
+        return [self.tier(name) for name in self.tier_names]
+
+    def loaded(self) -> List[TierArrays]:
+        """読み込み済みのTierだけをファイル中の順序で返す(未読のTierは読まない)"""
+        return [self._tiers[name] for name in self.tier_names if name in self._tiers]
+
+    def restore(self, tiers: Sequence[TierArrays]) -> None:
+        """読み込み済みのTier(キャッシュから復元したものなど)を入れ、そのTierは読まないようにする"""
+        for tier in tiers:
+            if tier.name not in self.tier_names:
+                raise ValueError(f"no tier named {tier.name}")
+            self._tiers[tier.name] = tier
+
+    def names(self, keys: Sequence[TierKey]) -> List[str]:
+        """指定されたTier(名前または番号)の名前。ファイルに無いTierは除く"""
+        names = []
+        for key in keys:
+            if isinstance(key, int):
+                if -len(self.tier_names) <= key < len(self.tier_names):
+                    names.append(self.tier_names[key])
+            elif key in self.tier_names:
+                names.append(key)
+        return names
+
+    def load(self, keys: Sequence[TierKey]) -> None:
+        """指定されたTierを読む。ファイルに無いTierは無視する"""
+        for name in self.names(keys):
+            self.tier(name)
+
+    def tier_source(self, key: TierKey) -> str:
+        """Tierのファイル中のテキスト(ヘッダと中身)。Tierの中身は読まない
+
+        Tierの配列はこのテキストだけから決まる(tgcache のキーに使う)
+        """
+        if self._blocks is None:
+            raise ValueError("the tiers were not read from a file")
+        name = self.tier_names[key] if isinstance(key, int) else key
+        block = self._blocks[self.tier_names.index(name)]
+        return self._data[block.header_start : block.body_end]
+
+    def to_textgrid(
+        self,
+        keys: Optional[Sequence[TierKey]] = None,
+        overrides: Optional[Mapping[str, object]] = None,
+    ) -> textgrid.Textgrid:
+        """praatioのTextgridを作る
+
+        Args:
+            keys: 含めるTier。Noneなら全Tier(ファイル中の順序)
+            overrides: Tier名 -> praatioのTier。指定されたTierは配列の代わりにこれを使う
+
+        Returns:
+            textgrid.Textgrid
+        """
+        overrides = overrides or {}
+        if keys is None:
+            names = list(self.tier_names)
+        else:
+            names = [
+                self.tier_names[k] if isinstance(k, int) else k
+                for k in keys
+                if isinstance(k, int) or k in self.tier_names
+            ]
+
+        tg = textgrid.Textgrid(self.xmin, self.xmax)
+        for name in names:
+            if name in overrides:
+                tier = overrides[name]
+            else:
+                tier = self.tier(name).to_praatio()
+            tg.addTier(tier, reportingMode="silence")
+        return tg
+
+    def _parse_block(self, block: _TierBlock) -> TierArrays:
+        body = self._data[block.body_start : block.body_end]
+        is_interval = block.tier_class == INTERVAL_TIER
+        if is_interval:
+            pattern = _SHORT_INTERVAL if self._short else _LONG_INTERVAL
+        else:
+            pattern = _SHORT_POINT if self._short else _LONG_POINT
+
+        rows = pattern.findall(body)
+        if rows:
+            columns = list(zip(*rows))
+        else:
+            columns = [(), (), ()] if is_interval else [(), ()]
+
+        start = np.array(columns[0], dtype=np.float64)
+        if is_interval:
+            end = np.array(columns[1], dtype=np.float64)
+        else:
+            end = start
+        codes, labels = _intern_labels(columns[-1])
+
+        # praatioと同様に時間順に並べ、不正なintervalは例外にする
+        if len(start) > 1 and np.any(np.diff(start) < 0):
+            order = np.lexsort((end, start))
+            start, end, codes = start[order], end[order], codes[order]
+        if is_interval and len(start):
+            if np.any(start >= end):
+                i = int(np.argmax(start >= end))
+                raise errors.TextgridStateError(
+                    f"The start time of an interval ({start[i]}) "
+                    f"cannot occur after its end time ({end[i]})"
+                )
+            if np.any(end[:-1] > start[1:]):
+                i = int(np.argmax(end[:-1] > start[1:]))
+                raise errors.TextgridStateError(
+                    "Two intervals in the same tier overlap in time:\n"
+                    f"({start[i]}, {end[i]}) and ({start[i + 1]}, {end[i + 1]})"
+                )
+
+        xmin, xmax = block.xmin, block.xmax
+        if len(start):
+            xmin = min(xmin, float(start[0]))
+            xmax = max(xmax, float(end.max()))
+
+        return TierArrays(
+            block.name, block.tier_class, xmin, xmax, start, end, codes, labels
+        )
+
+
+def _scan_short(data: str):
+    """short形式のヘッダとTierの位置を調べる"""
+    markers = []
+    for tier_class in (INTERVAL_TIER, POINT_TIER):
+        token = f'"{tier_class}"'
+        i = data.find(token)
+        while i != -1:
+            markers.append((i, tier_class))
+            i = data.find(token, i + 1)
+    markers.sort()
+    if not markers:
+        raise errors.ParsingError("No tiers found in textgrid")
+
+    header = _SHORT_TOKEN.findall(data[: markers[0][0]])
+    numbers = [bare for quoted, bare in header if bare and _NUMBER.match(bare)]
+    xmin, xmax = float(numbers[0]), float(numbers[1])
+
+    blocks = []
+    ends = [m[0] for m in markers[1:]] + [len(data)]
+    for (pos, tier_class), block_end in zip(markers, ends):
+        tokens = _SHORT_TOKEN.finditer(data, pos, block_end)
+        values = []
+        for match in tokens:
+            values.append(match)
+            if len(values) == 5:
+                break
+        name = values[1].group(1).replace('""', '"')
+        blocks.append(
+            _TierBlock(
+                tier_class,
+                name,
+                float(values[2].group(2)),
+                float(values[3].group(2)),
+                int(values[4].group(2)),
+                pos,
+                values[4].end(),
+                block_end,
+            )
+        )
+    return xmin, xmax, blocks
+
+
+def _scan_long(data: str):
+    """long形式のヘッダとTierの位置を調べる"""
+    markers = [m.start() for m in re.finditer(r"item ?\[\d+\]", data)]
+    if not markers:
+        raise errors.ParsingError("No tiers found in textgrid")
+
+    header = data[: markers[0]]
+    xmin = float(_LONG_XMIN.search(header).group(1))
+    xmax = float(_LONG_XMAX.search(header).group(1))
+
+    blocks = []
+    ends = markers[1:] + [len(data)]
+    for pos, block_end in zip(markers, ends):
+        body_start = data.find("[1]", data.find("size", pos, block_end), block_end)
+        if body_start == -1:
+            body_start = block_end
+        tier_header = data[pos:body_start]
+        tier_class = _LONG_CLASS.search(tier_header).group(1)
+        name = _LONG_NAME.search(tier_header).group(1).replace('""', '"')
+        size = _LONG_SIZE.search(tier_header)
+        blocks.append(
+            _TierBlock(
+                tier_class,
+                name,
+                float(_LONG_XMIN.search(tier_header).group(1)),
+                float(_LONG_XMAX.search(tier_header).group(1)),
+                int(size.group(1)) if size else 0,
+                pos,
+                body_start,
+                block_end,
+            )
+        )
+    return xmin, xmax, blocks
+
+
+def parse_textgrid(
+    data: str, tiers: Optional[Sequence[TierKey]] = None
+) -> TextgridArrays:
+    """TextGridの文字列を読み込む
+
+    Args:
+        data: TextGridファイルの内容(long / short形式)
+        tiers: 最初に読み込むTier(名前または番号)。Noneなら全Tier。
+            指定されなかったTierは、アクセスされた時点で読まれる
+
+    Returns:
+        TextgridArrays
+    """
+    data = data.replace("\r\n", "\n")
+
+    # 形式の判定はpraatioと同じ
+    short = "ooTextFile short" in data or "item [" not in data
+    if short:
+        xmin, xmax, blocks = _scan_short(data)
+    else:
+        xmin, xmax, blocks = _scan_long(data)
+
+    doc = TextgridArrays(xmin, xmax, [b.name for b in blocks], data, blocks, short)
+    if tiers is None:
+        doc.load(range(len(blocks)))
+    else:
+        doc.load(tiers)
+    return doc
+
+
+def decode_textgrid(raw: bytes) -> str:
+    """ファイルの内容を文字列にする
+
+    praatio(io.open)と同じく、BOMがあればutf-16、なければutf-8として読み、
+    改行は\nに揃える
+    """
+    if raw[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        data = raw.decode("utf-16")
+    else:
+        data = raw.decode("utf-8")
+    return data.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def read_textgrid(
+    textgrid_file_path: str, tiers: Optional[Sequence[TierKey]] = None
+) -> TextgridArrays:
+    """TextGridファイルを読み込む"""
+    with open(textgrid_file_path, "rb") as fd:
+        raw = fd.read()
+
+    return parse_textgrid(decode_textgrid(raw), tiers)
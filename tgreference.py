@@ -0,0 +1,255 @@
+"""Praat の出力(fixtures/praat)と、Praat を使わずに作ったTierを比べる
+
+fixtures/praat には、短いWAV(speech.wav)と、このリポジトリの Praat スクリプトで作った出力を置いてある
+(作り方は fixtures/praat/make_fixture.py)。
+
+- speech.auto.TextGrid: batchrate.praat(FilledPauses.praat も)の出力
+- speech.praat.TextGrid: それに IntentisyPitchAverageTiersAdd.praat で Intensity / Pitch のTierを加えたもの
+- speech.auto.Table: FilledPauses.praat(Save_Table)の音節ごとの特徴の表
+
+Intensity / Pitch は Praat の Tier3 に tgacoustic で加えたTierと、Nuclei / Phrases は WAVから
+tgnuclei で作ったTierと、DFauto と表は WAVから tgfilled で作ったものと比べる。
+
+    python tgreference.py
+
+比べた結果を1行ずつ表示し、許容差を超えたものがあれば終了コード 1 で終わる。
+WAVは録音ではなく Praat の SpeechSynthesizer で作った合成音なので、
+tgfiles の実際の録音で Praat とどれだけ違うかはこれでは分からない。
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+
+import tgacoustic
+import tgfilled
+import tgnuclei
+import tgreader
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "praat"
+)
+FIXTURE_NAME = "speech"
+
+# intervalごとの値の許容差(tgacoustic のdocstringの目安)
+INTENSITY_TOLERANCE = 0.5
+PITCH_TOLERANCE = 1.0
+# intervalの境界の許容差(秒)
+BOUNDARY_TOLERANCE = 1e-6
+# 音節核の時刻の許容差(秒)。Intensity の極大の放物線補間の細かい違いの分
+NUCLEI_TOLERANCE = 0.001
+# 音節ごとの有声休止の得点の許容差。Formant の変化の幅など、得点に効く特徴の細かい違いの分
+SCORE_TOLERANCE = 0.05
+
+# (比べたものの名前, 差の要約, 許容差を超えたもの)
+Comparison = Tuple[str, str, List[str]]
+
+
+def fixture_path(suffix: str) -> str:
+    return os.path.join(FIXTURE_DIR, FIXTURE_NAME + suffix)
+
+
+def compare_boundaries(
+    tier: tgreader.TierArrays, reference: tgreader.TierArrays
+) -> List[str]:
+    """intervalの数と境界が同じか(違いを返す)"""
+    if len(tier) != len(reference):
+        return [f"intervalの数 {len(tier)} (Praat {len(reference)})"]
+    problems = []
+    for edge, mine, theirs in (
+        ("start", tier.start, reference.start),
+        ("end", tier.end, reference.end),
+    ):
+        for i in np.flatnonzero(np.abs(mine - theirs) > BOUNDARY_TOLERANCE).tolist():
+            problems.append(f"interval {i + 1} {edge}: {mine[i]} (Praat {theirs[i]})")
+    return problems
+
+
+def compare_labels(
+    tier: tgreader.TierArrays, reference: tgreader.TierArrays
+) -> List[str]:
+    """ラベルが同じか(数は同じとする。違いを返す)"""
+    return [
+        f"{i + 1}: {mine!r} (Praat {theirs!r})"
+        for i, (mine, theirs) in enumerate(
+            zip(tier.label_array(), reference.label_array())
+        )
+        if mine != theirs
+    ]
+
+
+def compare_intervals(
+    tier: tgreader.TierArrays, reference: tgreader.TierArrays
+) -> Comparison:
+    """intervalの境界とラベルを比べる"""
+    problems = compare_boundaries(tier, reference) or compare_labels(tier, reference)
+    return reference.name, f"interval {len(reference)}", problems
+
+
+def compare_points(
+    tier: tgreader.TierArrays, reference: tgreader.TierArrays, tolerance: float
+) -> Comparison:
+    """pointの時刻とラベルを比べる"""
+    if len(tier) != len(reference):
+        return reference.name, "", [f"pointの数 {len(tier)} (Praat {len(reference)})"]
+    difference = np.abs(tier.start - reference.start)
+    problems = [
+        f"point {i + 1}: {tier.start[i]} (Praat {reference.start[i]})"
+        for i in np.flatnonzero(difference > tolerance).tolist()
+    ]
+    problems += compare_labels(tier, reference)
+    largest = difference.max() if len(difference) else 0.0
+    return (
+        reference.name,
+        f"point {len(reference)}、最大の差 {largest:.6f} 秒 (許容差 {tolerance:g})",
+        problems,
+    )
+
+
+def compare_values(
+    tier: tgreader.TierArrays, reference: tgreader.TierArrays, tolerance: float
+) -> Comparison:
+    """値(fixed$ (値, 1))をラベルにしたTierを比べる"""
+    problems = compare_boundaries(tier, reference)
+    if problems:
+        return reference.name, "", problems
+    largest = 0.0
+    for i, (mine, theirs) in enumerate(
+        zip(tier.label_array(), reference.label_array())
+    ):
+        if mine == theirs:
+            continue
+        if tgacoustic.UNDEFINED in (mine, theirs) or "" in (mine, theirs):
+            problems.append(f"interval {i + 1}: {mine!r} (Praat {theirs!r})")
+            continue
+        difference = abs(float(mine) - float(theirs))
+        largest = max(largest, difference)
+        if difference > tolerance:
+            problems.append(f"interval {i + 1}: {mine} (Praat {theirs})")
+    return reference.name, f"最大の差 {largest:.1f} (許容差 {tolerance:g})", problems
+
+
+def compare_acoustic(work_dir: str) -> List[Comparison]:
+    """Praat の Tier3 に tgacoustic で Intensity / Pitch のTierを加え、Praat のTierと比べる"""
+    output_path = tgacoustic.add_acoustic_tiers(
+        fixture_path(".auto.TextGrid"),
+        fixture_path(".wav"),
+        os.path.join(work_dir, FIXTURE_NAME + tgacoustic.ACOUSTIC_SUFFIX),
+    )
+    tiers = tgreader.read_textgrid(output_path)
+    reference = tgreader.read_textgrid(fixture_path(".praat.TextGrid"))
+    return [
+        compare_values(tiers[name], reference[name], tolerance)
+        for name, tolerance in (
+            (tgacoustic.INTENSITY_TIER, INTENSITY_TOLERANCE),
+            (tgacoustic.PITCH_TIER, PITCH_TOLERANCE),
+        )
+    ]
+
+
+def compare_nuclei(work_dir: str) -> List[Comparison]:
+    """WAVから tgnuclei で Nuclei / Phrases のTierを作り、batchrate.praat のTierと比べる"""
+    output_path = tgnuclei.detect_file(
+        fixture_path(".wav"),
+        os.path.join(work_dir, FIXTURE_NAME + tgnuclei.AUTO_SUFFIX),
+    )
+    tiers = tgreader.read_textgrid(output_path)
+    reference = tgreader.read_textgrid(fixture_path(tgnuclei.AUTO_SUFFIX))
+    return [
+        compare_points(
+            tiers[tgnuclei.NUCLEI_TIER],
+            reference[tgnuclei.NUCLEI_TIER],
+            NUCLEI_TOLERANCE,
+        ),
+        compare_intervals(
+            tiers[tgnuclei.PHRASES_TIER], reference[tgnuclei.PHRASES_TIER]
+        ),
+    ]
+
+
+def read_table(path: str) -> List[List[str]]:
+    """Save as tab-separated file の表(見出しの行を除く)"""
+    with open(path, encoding="utf-8") as fd:
+        return [line.rstrip("\n").split("\t") for line in fd][1:]
+
+
+def compare_table(rows: List[List[str]], reference: List[List[str]]) -> Comparison:
+    """音節ごとの特徴の表の、ラベル(type)・始まり(ts)・得点(score)を比べる"""
+    name = "Table"
+    if len(rows) != len(reference):
+        return name, "", [f"音節の数 {len(rows)} (Praat {len(reference)})"]
+    score = tgfilled.TABLE_COLUMNS.index("score")
+    problems = []
+    largest = 0.0
+    for i, (mine, theirs) in enumerate(zip(rows, reference)):
+        if mine[:2] != theirs[:2]:
+            problems.append(f"音節 {i + 1}: {mine[:2]} (Praat {theirs[:2]})")
+        if tgacoustic.UNDEFINED in (mine[score], theirs[score]):
+            if mine[score] != theirs[score]:
+                problems.append(
+                    f"音節 {i + 1} score: {mine[score]} (Praat {theirs[score]})"
+                )
+            continue
+        difference = abs(float(mine[score]) - float(theirs[score]))
+        largest = max(largest, difference)
+        if difference > SCORE_TOLERANCE:
+            problems.append(
+                f"音節 {i + 1} score: {mine[score]} (Praat {theirs[score]})"
+            )
+    return (
+        name,
+        f"音節 {len(reference)}、score の最大の差 {largest:.3f} (許容差 {SCORE_TOLERANCE:g})",
+        problems,
+    )
+
+
+def compare_filled(work_dir: str) -> List[Comparison]:
+    """WAVから tgfilled で DFauto のTierと特徴の表を作り、FilledPauses.praat の出力と比べる"""
+    # 表は WAVと同じ場所に保存されるので、WAVを作業用のディレクトリに写してから作る
+    wav_path = os.path.join(work_dir, FIXTURE_NAME + ".wav")
+    shutil.copy(fixture_path(".wav"), wav_path)
+    output_path = tgfilled.detect_file(wav_path, save_features=True)
+    tiers = tgreader.read_textgrid(output_path)
+    reference = tgreader.read_textgrid(fixture_path(tgnuclei.AUTO_SUFFIX))
+    comparisons = [
+        compare_intervals(tiers[name], reference[name])
+        for name in (
+            tgfilled.dfauto_tier_name(tgfilled.LANGUAGE_ENGLISH),
+            tgfilled.REPAIR_TIER,
+            tgfilled.JAPANESE_TIER,
+        )
+    ]
+    table_path = os.path.splitext(wav_path)[0] + tgfilled.TABLE_SUFFIX
+    comparisons.append(
+        compare_table(
+            read_table(table_path), read_table(fixture_path(tgfilled.TABLE_SUFFIX))
+        )
+    )
+    return comparisons
+
+
+def compare_all() -> List[Comparison]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        return (
+            compare_acoustic(work_dir)
+            + compare_nuclei(work_dir)
+            + compare_filled(work_dir)
+        )
+
+
+def main() -> int:
+    failed = False
+    for name, summary, problems in compare_all():
+        print(f"{'NG' if problems else 'OK'} {name}: {summary}")
+        for problem in problems:
+            print(f"    {problem}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+"""tg_check のチェック項目(ルール)とその実行
+
+チェック項目はルールの一覧 CHECK_RULES として宣言し、run_rules で上から順に
+読み込み済みの配列(tgreader.TierArrays)に対して評価する。
+エラーメッセージの内容と順序は、以前の tg_check で項目ごとにループしていたときと同じ。
+
+ルールごとにかかった時間を RuleTimings に記録できるので、
+どのルールがどのファイルで遅いかを調べられる。
+
+PRESCAN_RULES は TextGrid と各Tierのヘッダ(Tierの数・種類・名前・intervalの数)だけで
+判定できるチェックで、Tierの中身(interval)を読む前に構造の誤ったファイルを除くのに使う。
+"""
+
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import tgreader
+
+# Tier2のポーズ(rpの境界と比べる)
+PAUSE_LABELS = ("ps", "psb", "fp")
+
+# batchrate.praat / IntentisyPitchAverageTiersAdd.praat で作られるTierの構成 (種類, 名前)
+TIER_LAYOUT = (
+    ("TextTier", "Nuclei"),
+    ("IntervalTier", "Phrases"),
+    ("IntervalTier", "DFauto (English)"),
+    ("IntervalTier", "Repair"),
+    ("IntervalTier", "Japanese"),
+    ("IntervalTier", "Intensity"),
+    ("IntervalTier", "Pitch"),
+)
+
+
+class StructureError(Exception):
+    """ヘッダの事前チェック(PRESCAN_RULES)で見つかったエラー"""
+
+    def __init__(self, messages: List[str]):
+        super().__init__("\n".join(messages))
+        self.messages = messages
+
+
+class CheckContext:
+    """1ファイル分のチェックで、ルールの間で共有する値"""
+
+    def __init__(self, path: str, document: tgreader.TextgridArrays):
+        self.path = path
+        self.document = document
+        self._pitch = None
+
+    def message(self, text: str, at=None, label: str = "") -> str:
+        """エラーメッセージ(以前の tg_check と同じ形式)。at はintervalの開始時刻"""
+        head = f"{self.path} チェックエラー:{text}  "
+        if at is None:
+            return head
+        return f"{head} {at} {label}"
+
+    def messages(self, text: str, tier: tgreader.TierArrays, index) -> List[str]:
+        """tier の index 番目のintervalの開始時刻とラベルを並べたメッセージ"""
+        labels = tier.labels
+        return [
+            self.message(text, start, labels[code])
+            for start, code in zip(
+                tier.start[index].tolist(), tier.codes[index].tolist()
+            )
+        ]
+
+    def pitch(self) -> Tuple[np.ndarray, List[int]]:
+        """Tier7(Pitch)の値の配列と、数値に変換できないラベルのコード
+
+        変換はラベルの語彙ごとに1回だけ行い、ルールの間で使い回す。
+        空白のラベルは NaN、変換できないラベルも NaN にする
+        """
+        if self._pitch is None:
+            tier7 = self.document[6]
+            vocab, ok = tier7.convert(float)
+            invalid = [
+                code
+                for code, label in enumerate(tier7.labels)
+                if label != "" and not ok[code]
+            ]
+            self._pitch = (vocab[tier7.codes], invalid)
+        return self._pitch
+
+
+class Rule:
+    """チェック項目
+
+    check は CheckContext を受け取り、エラーメッセージのリストを返す。
+    stop=True のルールでエラーがあった場合は、以降のルールは評価しない
+    """
+
+    def __init__(
+        self, name: str, check: Callable[[CheckContext], List[str]], stop=False
+    ):
+        self.name = name
+        self.check = check
+        self.stop = stop
+
+
+class RuleTimings:
+    """ルールごとの実行時間の記録"""
+
+    def __init__(self):
+        # (ファイルパス, ルール名, 秒)
+        self.records: List[Tuple[str, str, float]] = []
+
+    def add(self, path: str, rule: str, seconds: float) -> None:
+        self.records.append((path, rule, seconds))
+
+    def totals(self) -> Dict[str, float]:
+        """ルールごとの合計時間(ルールを最初に記録した順)"""
+        totals: Dict[str, float] = {}
+        for _, rule, seconds in self.records:
+            totals[rule] = totals.get(rule, 0.0) + seconds
+        return totals
+
+    def slowest(self, rule: str, n: int = 3) -> List[Tuple[str, float]]:
+        """rule に時間がかかったファイルの上位 n 件 (ファイルパス, 秒)"""
+        records = [(path, s) for path, name, s in self.records if name == rule]
+        records.sort(key=lambda record: record[1], reverse=True)
+        return records[:n]
+
+    def report(self, n: int = 3) -> str:
+        """ルールごとの合計時間と、時間がかかったファイルの一覧"""
+        lines = []
+        for rule, total in self.totals().items():
+            lines.append(f"{rule}: {total * 1000:.1f} ms")
+            for path, seconds in self.slowest(rule, n):
+                lines.append(f"    {path}: {seconds * 1000:.2f} ms")
+        return "\n".join(lines)
+
+
+def run_rules(
+    rules: Sequence[Rule],
+    path: str,
+    document: tgreader.TextgridArrays,
+    timings: Optional[RuleTimings] = None,
+) -> List[str]:
+    """rules を順に評価し、エラーメッセージを返す
+
+    ルールで起きた例外はそのまま呼び出し元に送る
+    """
+    context = CheckContext(path, document)
+    messages: List[str] = []
+    for rule in rules:
+        started = time.perf_counter()
+        try:
+            found = rule.check(context)
+        finally:
+            if timings is not None:
+                timings.add(path, rule.name, time.perf_counter() - started)
+        messages.extend(found)
+        if rule.stop and found:
+            break
+    return messages
+
+
+def allowed_labels(tier_index: int, labels: Iterable[str], text: str) -> Callable:
+    """tier_index 番目のTierに labels 以外のラベルがあればエラーにするルール"""
+    labels = tuple(labels)
+
+    def check(context: CheckContext) -> List[str]:
+        tier = context.document[tier_index]
+        return context.messages(text, tier, np.flatnonzero(~tier.mask(*labels)))
+
+    return check
+
+
+def _tier2_edges(context: CheckContext) -> List[str]:
+    # Tier2の最初と最後の境界に記号があることはない。
+    document = context.document
+    tier2 = document[1]
+    t2start = tier2.start.tolist()
+    messages = []
+    if t2start[0] == document.xmin and tier2.label_at(0) != "":
+        messages.append(
+            context.message(
+                "TTier2の最初と最後の境界に記号があることはない。",
+                t2start[0],
+                tier2.label_at(0),
+            )
+        )
+    t2last = len(tier2) - 1
+    if tier2.end[t2last] == document.xmax and tier2.label_at(t2last) != "":
+        messages.append(
+            context.message(
+                "Tier2の最初と最後の境界に記号があることはない。",
+                t2start[t2last],
+                tier2.label_at(t2last),
+            )
+        )
+    return messages
+
+
+def _tier_count(context: CheckContext) -> List[str]:
+    # - 全体: Tier6, 7がない。
+    if len(context.document) < 7:
+        return [context.message("- 全体: Tier6, 7がない。")]
+    return []
+
+
+def _tier2_inner_blanks(context: CheckContext) -> List[str]:
+    # Tier2: ２番目の境界内と、最後から２番目の境界内の間に空白の境界内があることはない
+    # （新しい境界を作ったさいにprを入れるのを忘れたさいに起きるエラー）
+    tier2 = context.document[1]
+    t2blank = tier2.mask("")
+    t2blank[[0, len(tier2) - 1]] = False
+    text = "Tier2: ２番目の境界内と、最後から２番目の境界内の間に空白の境界内があることはない"
+    return [context.message(text, t, "") for t in tier2.start[t2blank].tolist()]
+
+
+def _rp_pause_boundaries(context: CheckContext) -> List[str]:
+    """Tier4のrpの境界とTier2のポーズ(ps, psb, fp)の境界
+
+    - Tier4:rpの境界が、 Tier2、ps, psb, fp内部にあることはありえない。
+    - Tier4:rpの左側の境界が、Tier2、ps, psb, fpの左側の境界と一致することはない
+    - Tier4:rpの右側の境界が、ps, psb, fpの右側の境界と一致することはない
+
+    ポーズは重ならずに時間順に並んでいるので、ある時刻 t を内部に含みうるポーズは
+    「開始時刻が t より前の最後のポーズ」だけであり、開始時刻・終了時刻が t と
+    一致するポーズも高々1つである。これを二分探索で求める。
+    メッセージは rp ごと、ポーズごとに、内部(左・右の境界)、左側の一致、右側の一致の順に並べる
+    """
+    tier2 = context.document[1]
+    tier4 = context.document[3]
+    pause = tier2.mask(*PAUSE_LABELS)
+    p_start = tier2.start[pause]
+    p_end = tier2.end[pause]
+    p_label = tier2.label_array()[pause]
+    rp = tier4.mask("rp")
+    rp_start = tier4.start[rp]
+    rp_end = tier4.end[rp]
+    n_pause = len(p_start)
+    if n_pause == 0 or len(rp_start) == 0:
+        return []
+
+    def inside(t):
+        j = np.searchsorted(p_start, t, side="left") - 1
+        found = j >= 0
+        found[found] = t[found] < p_end[j[found]]
+        return j, found
+
+    def same(boundary, t):
+        j = np.searchsorted(boundary, t, side="left")
+        found = j < n_pause
+        found[found] = boundary[j[found]] == t[found]
+        return j, found
+
+    inside_text = "Tier4:rpの境界が、 Tier2、ps, psb, fp内部にあることはありえない。"
+    kinds = (
+        # (対応するポーズ, 見つかったか, 時刻, ラベル, メッセージ)
+        inside(rp_start) + (rp_start, None, inside_text),
+        inside(rp_end) + (rp_end, None, inside_text),
+        same(p_start, rp_start)
+        + (
+            rp_start,
+            "rp",
+            "Tier4:rpの左側の境界が、Tier2、ps, psb, fpの左側の境界と一致することはない（rpはポーズから始まらない）",
+        ),
+        same(p_end, rp_end)
+        + (
+            rp_end,
+            "rp",
+            "- Tier4:rpの右側の境界が、ps, psb, fpの右側の境界と一致することはない（rpはポーズで終わらない）。",
+        ),
+    )
+
+    hit_rp, hit_pause, hit_kind = [], [], []
+    for kind, (j, found, _, _, _) in enumerate(kinds):
+        index = np.flatnonzero(found)
+        hit_rp.append(index)
+        hit_pause.append(j[index])
+        hit_kind.append(np.full(len(index), kind))
+    hit_rp = np.concatenate(hit_rp)
+    hit_pause = np.concatenate(hit_pause)
+    hit_kind = np.concatenate(hit_kind)
+
+    messages = []
+    for k in np.lexsort((hit_kind, hit_pause, hit_rp)).tolist():
+        i, j = hit_rp[k], hit_pause[k]
+        _, _, times, label, text = kinds[hit_kind[k]]
+        if label is None:
+            label = p_label[j]
+        messages.append(context.message(text, times[i].item(), label))
+    return messages
+
+
+def _pitch_unparsable(context: CheckContext) -> List[str]:
+    # - Tier7:Pitchの値の異常値。数値に変換できない(最初の1つだけ)
+    _, invalid = context.pitch()
+    if not invalid:
+        return []
+    tier7 = context.document[6]
+    i = np.flatnonzero(np.isin(tier7.codes, invalid))[:1]
+    return context.messages("Tier7:Pitchの値の異常値。数値に変換できない", tier7, i)
+
+
+def _pitch_low(context: CheckContext) -> List[str]:
+    # - Tier7:Pitchの値の異常値。pitchの値がpitchの平均値の２分の１より低い値
+    tier7 = context.document[6]
+    pitch, _ = context.pitch()
+    t7filled = ~tier7.mask("")
+    pitlist = pitch[t7filled].tolist()
+    avg = sum(pitlist) / len(pitlist)
+    return context.messages(
+        "Tier7:Pitchの値の異常値。pitchの値がpitchの平均値の２分の１より低い値",
+        tier7,
+        np.flatnonzero(t7filled & (pitch < (avg / 2))),
+    )
+
+
+def _tier3_tier7_boundaries(context: CheckContext) -> List[str]:
+    # - Tier7:Tier3とTier7の境界が一致していない。(最初の1つだけ)
+    # Tier3のラベルがある時、Tier7とstart,endが一致し、かつTier7のラベルが空白ではない
+    tier3 = context.document[2]
+    tier7 = context.document[6]
+    labeled = np.flatnonzero(~tier3.mask(""))
+    n7 = len(tier7)
+    paired = labeled[labeled < n7]
+    matched = (
+        (tier3.start[paired] == tier7.start[paired])
+        & (tier3.end[paired] == tier7.end[paired])
+        & ~tier7.mask("")[paired]
+    )
+    first_mismatch = paired[~matched][0] if not matched.all() else None
+    first_missing = labeled[labeled >= n7][0] if len(paired) < len(labeled) else None
+
+    if first_mismatch is not None and (
+        first_missing is None or first_mismatch < first_missing
+    ):
+        return context.messages(
+            "Tier3とTier7の境界が一致していない", tier3, [first_mismatch]
+        )
+    if first_missing is not None:
+        return context.messages(
+            "Tier7のintervalがTier3より少ない", tier3, [first_missing]
+        )
+    return []
+
+
+# tg_check のチェック項目(この順に評価する)
+CHECK_RULES = [
+    Rule("tier2_edges", _tier2_edges),
+    Rule("tier_count", _tier_count, stop=True),
+    Rule(
+        "tier2_labels",
+        allowed_labels(
+            1,
+            ("pr", "ps", "psb", "fp", ""),
+            "Tier2:pr, ps, psb, fp以外の記号があることはない",
+        ),
+    ),
+    Rule("tier2_inner_blanks", _tier2_inner_blanks),
+    # この時点では、Tier3の全ての境界内の記号はvとなる
+    # (fp, rpへの置き換えは tgdata で行う)
+    Rule(
+        "tier3_labels",
+        allowed_labels(2, ("v", ""), "Tier3:v以外の記号があることはない"),
+    ),
+    Rule("tier4_labels", allowed_labels(3, ("rp", ""), "Tier4:rp以外の記号がある。")),
+    Rule("rp_pause_boundaries", _rp_pause_boundaries),
+    Rule("tier5_labels", allowed_labels(4, ("jp", ""), "Tier5:jp以外の記号がある。")),
+    Rule("pitch_unparsable", _pitch_unparsable, stop=True),
+    Rule("pitch_low", _pitch_low),
+    Rule("tier3_tier7_boundaries", _tier3_tier7_boundaries),
+]
+
+
+def _tier_layout(context: CheckContext) -> List[str]:
+    # - 全体: Tierの種類・名前が TIER_LAYOUT と違う
+    document = context.document
+    messages = []
+    actual = list(zip(document.tier_classes(), document.tier_names))
+    for n, (found, expected) in enumerate(zip(actual, TIER_LAYOUT), start=1):
+        if found != expected:
+            messages.append(
+                context.message(
+                    f"- 全体: Tier{n}が{found[1]}({found[0]})になっている。"
+                    f"{expected[1]}({expected[0]})であること"
+                )
+            )
+    if len(actual) > len(TIER_LAYOUT):
+        messages.append(
+            context.message(
+                f"- 全体: Tierが{len(actual)}個ある。{len(TIER_LAYOUT)}個であること"
+            )
+        )
+    return messages
+
+
+def _tier3_tier7_sizes(context: CheckContext) -> List[str]:
+    # - 全体: Tier3とTier7のintervalの数が一致していない
+    # (Tier7はTier3の境界から作るので、数が違えば境界も一致しない)
+    sizes = context.document.tier_sizes()
+    if sizes[2] != sizes[6]:
+        return [
+            context.message(
+                f"- 全体: Tier3とTier7のintervalの数が一致していない。 {sizes[2]} {sizes[6]}"
+            )
+        ]
+    return []
+
+
+# Tierの中身を読む前に、ヘッダだけで行うチェック(この順に評価する)
+PRESCAN_RULES = [
+    Rule("header_tier_count", _tier_count, stop=True),
+    Rule("header_tier_layout", _tier_layout, stop=True),
+    Rule("header_tier3_tier7_sizes", _tier3_tier7_sizes),
+]
+
+
+def prescan(
+    path: str,
+    document: tgreader.TextgridArrays,
+    timings: Optional[RuleTimings] = None,
+) -> None:
+    """PRESCAN_RULES でヘッダをチェックし、エラーがあれば StructureError を送出する
+
+    document はTierの中身を読んでいなくてよい(読まれない)
+    """
+    messages = run_rules(PRESCAN_RULES, path, document, timings)
+    if messages:
+        raise StructureError(messages)
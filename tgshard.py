@@ -0,0 +1,351 @@
+"""複数のマシン(プロセス)で分担して処理するためのシャード
+
+./tgfiles のファイルを、ファイル名または ID のハッシュで N 個のシャードに分ける。
+シャード k の実行は自分の担当のファイルだけを処理し、計算結果をマスターデータに
+追記する代わりに、シャードのディレクトリに次の2つを書き出す。
+
+- <name>.rows.jsonl: 計算結果(1行に1ファイル分)
+- <name>.manifest.json: シャードの記録(シャード番号・数、分け方、プログラムのバージョン、
+  処理したファイル、計算結果の行のファイルとその内容のハッシュ、計算結果のファイルのハッシュ)。
+  計算結果を書き終えてから書くので、これがあるシャードは最後まで終わっている
+
+計算結果には、まだまとめていない行をすべて入れる。まとめる前に同じシャードをもう一度実行すると、
+前回の行も含めて同じ名前のファイルに書き直すので、前回の行が失われることはない。
+まとめた行は、次にそのシャードを実行したときに merged ディレクトリの記録を見て
+台帳(tgledger)に渡し終わったと記録し(merged_jobs)、それ以降の計算結果には入れない。
+
+すべてのシャードが終わったら、別に merge を実行してマスターデータにまとめる。
+merge はシャードが欠けていたり重複していたりする場合はエラーにして、何も追記しない。
+まとめた行のファイルは、マスターデータへの保存と同じトランザクションで
+マスターデータのデータベースに記録し(record_merged)、次の merge ではまとめない(unmerged)。
+保存した後、シャードのファイルを merged ディレクトリに移す前に止まっても、同じ行を2回まとめない。
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import time
+import zlib
+from typing import Dict, List, Sequence, Tuple
+
+SHARD_DIR = "FluencyProsodyShards"
+MERGED_DIR = "merged"
+
+# シャードの分け方
+SHARD_KEYS = ("filename", "ID")
+
+# まとめた行のファイルを記録する、マスターデータのデータベースのテーブル
+MERGED_TABLE = "shard_merged"
+
+_MANIFEST_SUFFIX = ".manifest.json"
+_ROWS_SUFFIX = ".rows.jsonl"
+
+
+class ShardError(Exception):
+    """シャードをまとめられない(欠けている・重複している・一致しない)"""
+
+    def __init__(self, messages: List[str]):
+        super().__init__("\n".join(messages))
+        self.messages = messages
+
+
+class ShardSpec:
+    """N 個のうち k 番目(1始まり)のシャード
+
+    key が "filename" ならファイル名、"ID" ならファイル名の先頭3文字(ID)のハッシュで分ける。
+    ID で分けると、同じ ID のファイルは同じシャードになる
+    """
+
+    def __init__(self, index: int, count: int, key: str = "filename"):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(f"invalid shard {index}/{count}")
+        if key not in SHARD_KEYS:
+            raise ValueError(f"shard key must be one of {SHARD_KEYS}: {key}")
+        self.index = index
+        self.count = count
+        self.key = key
+
+    @classmethod
+    def parse(cls, spec: str, key: str = "filename") -> "ShardSpec":
+        """文字列 "k/N" から作る"""
+        index, _, count = spec.partition("/")
+        try:
+            return cls(int(index), int(count), key)
+        except ValueError:
+            raise ValueError(f"shard must be given as k/N: {spec}") from None
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def contains(self, textgrid_file_path: str) -> bool:
+        """このシャードの担当のファイルか
+
+        プロセスやマシンが違っても同じ結果になるよう、Pythonの hash ではなく crc32 を使う
+        """
+        name = os.path.basename(textgrid_file_path)
+        if self.key == "ID":
+            name = name[0:3]
+        return zlib.crc32(name.encode("utf-8")) % self.count == self.index - 1
+
+    def _path(self, shard_dir: str, stem: str, ext: str) -> str:
+        return os.path.join(
+            shard_dir, f"{stem}-{self.index:03d}-of-{self.count:03d}{ext}"
+        )
+
+    def manifest_path(self, shard_dir: str) -> str:
+        """このシャードで使う tgmanifest のマニフェスト(シャードごとに別のファイルにする)"""
+        return self._path(shard_dir, "FluencyProsodyManifest", ".json")
+
+    def ledger_path(self, shard_dir: str) -> str:
+        """このシャードで使う tgledger の台帳"""
+        return self._path(shard_dir, "FluencyProsodyLedger", ".sqlite3")
+
+    def results_csv_path(self, shard_dir: str) -> str:
+        """このシャードの計算結果を終わった順に追記するCSV(masterdata.ResultCsvWriter)"""
+        return self._path(shard_dir, "FluencyProsodyResults", ".csv")
+
+    def name(self, run_id: str) -> str:
+        """書き出すファイルの名前(拡張子なし)
+
+        run_id には台帳の識別子(tgledger.JobLedger.token)を渡す。
+        同じ台帳で実行し直したときは、まとめていない行をすべて入れて同じ名前で書き直し、
+        同じシャードを別の場所で実行したときは別の名前になる
+        """
+        return (
+            f"shard-{self.index:03d}-of-{self.count:03d}"
+            f"-{socket.gethostname()}-{run_id}"
+        )
+
+
+def _write_atomic(path: str, text: str) -> None:
+    # 途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_partial(
+    shard_dir: str,
+    spec: ShardSpec,
+    rows: Sequence[dict],
+    jobs: Sequence[Tuple[str, str]],
+    files: Sequence[str],
+    version: str,
+    run_id: str,
+) -> str:
+    """シャードの計算結果と記録を書き出す。記録のファイルパスを返す
+
+    Args:
+        shard_dir: 書き出すディレクトリ
+        spec: このシャード
+        rows: 計算結果(まだまとめていない行すべて)
+        jobs: rows の各行のファイルの (台帳のファイルパス, 内容のハッシュ)
+        files: このシャードが担当したファイル
+        version: プログラムのバージョン(tgmanifest.code_version)
+        run_id: 実行の識別子(ShardSpec.name を参照)
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    base = os.path.join(shard_dir, spec.name(run_id))
+
+    text = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+    _write_atomic(base + _ROWS_SUFFIX, text)
+
+    manifest = {
+        "shard": spec.index,
+        "count": spec.count,
+        "key": spec.key,
+        "version": version,
+        "files": [os.path.basename(path) for path in files],
+        "rows": len(rows),
+        "jobs": [list(job) for job in jobs],
+        "rows_file": os.path.basename(base + _ROWS_SUFFIX),
+        "rows_sha256": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+    }
+    _write_atomic(
+        base + _MANIFEST_SUFFIX, json.dumps(manifest, ensure_ascii=False, indent=1)
+    )
+    return base + _MANIFEST_SUFFIX
+
+
+class Partial:
+    """1つのシャードの記録と計算結果"""
+
+    def __init__(self, manifest_path: str, manifest: dict):
+        self.manifest_path = manifest_path
+        self.manifest = manifest
+        self.rows_path = os.path.join(
+            os.path.dirname(manifest_path), manifest["rows_file"]
+        )
+
+    def read_rows(self) -> List[dict]:
+        with open(self.rows_path, "rb") as fd:
+            raw = fd.read()
+        if hashlib.sha256(raw).hexdigest() != self.manifest["rows_sha256"]:
+            raise ShardError([f"{self.rows_path}: 計算結果が記録と一致しない"])
+        return [json.loads(line) for line in raw.decode("utf-8").splitlines()]
+
+
+def collect(shard_dir: str = SHARD_DIR) -> List[Partial]:
+    """まだまとめていないシャードを読み、すべてそろっているか調べる
+
+    次の場合は ShardError を送出する
+    - シャードがない、シャードの数・分け方・プログラムのバージョンが一致しない
+    - 欠けているシャード、同じ番号のシャードが2つ以上ある
+    - 同じファイルを2つ以上のシャードが処理している
+
+    Returns:
+        シャード番号の順に並べた Partial
+    """
+    partials = []
+    if os.path.isdir(shard_dir):
+        for name in sorted(os.listdir(shard_dir)):
+            if name.endswith(_MANIFEST_SUFFIX):
+                path = os.path.join(shard_dir, name)
+                with open(path, "r", encoding="utf-8") as fd:
+                    partials.append(Partial(path, json.load(fd)))
+    if not partials:
+        raise ShardError([f"{shard_dir}: シャードがない"])
+
+    errors = []
+    for field in ("count", "key", "version"):
+        values = sorted({str(p.manifest[field]) for p in partials})
+        if len(values) > 1:
+            errors.append(f"シャードの{field}が一致しない: {', '.join(values)}")
+    if errors:
+        raise ShardError(errors)
+
+    count = partials[0].manifest["count"]
+    by_index: Dict[int, List[Partial]] = {}
+    for partial in partials:
+        by_index.setdefault(partial.manifest["shard"], []).append(partial)
+    for index in range(1, count + 1):
+        found = by_index.get(index, [])
+        if not found:
+            errors.append(f"シャード {index}/{count} がない")
+        elif len(found) > 1:
+            names = ", ".join(os.path.basename(p.manifest_path) for p in found)
+            errors.append(f"シャード {index}/{count} が重複している: {names}")
+
+    owner: Dict[str, int] = {}
+    for partial in partials:
+        for name in partial.manifest["files"]:
+            if name in owner and owner[name] != partial.manifest["shard"]:
+                errors.append(
+                    f"{name} をシャード {owner[name]} と {partial.manifest['shard']} が処理している"
+                )
+            owner.setdefault(name, partial.manifest["shard"])
+    if errors:
+        raise ShardError(errors)
+
+    partials.sort(key=lambda p: p.manifest["shard"])
+    return partials
+
+
+def _create_merged_table(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {MERGED_TABLE} ("
+        "filename TEXT NOT NULL, sha256 TEXT, version TEXT NOT NULL, merged REAL, "
+        "PRIMARY KEY (filename, sha256, version))"
+    )
+
+
+def unmerged(
+    partials: Sequence[Partial], conn: sqlite3.Connection
+) -> Tuple[List[dict], List[Tuple[str, str, str]]]:
+    """partials の計算結果のうち、まだマスターデータにまとめていない行
+
+    内容もプログラムのバージョンも同じファイルの行は、前の merge でまとめていれば除く
+
+    Args:
+        partials: collect で読んだシャード
+        conn: マスターデータのデータベースの接続
+
+    Returns:
+        (行, 各行のファイルの (台帳のファイルパス, 内容のハッシュ, プログラムのバージョン))
+    """
+    with conn:
+        _create_merged_table(conn)
+    rows = []
+    jobs = []
+    for partial in partials:
+        version = partial.manifest["version"]
+        # 行の filename はファイル名だけなので、台帳のファイルパスとはファイル名で対応させる
+        by_name = {
+            os.path.basename(filename): (filename, sha256)
+            for filename, sha256 in partial.manifest.get("jobs", [])
+        }
+        for row in partial.read_rows():
+            found = by_name.get(row.get("filename"))
+            if found is None:
+                raise ShardError(
+                    [f"{partial.manifest_path}: {row.get('filename')} の記録がない"]
+                )
+            job = (found[0], found[1], version)
+            merged = conn.execute(
+                f"SELECT 1 FROM {MERGED_TABLE} "
+                "WHERE filename = ? AND sha256 IS ? AND version = ?",
+                job,
+            ).fetchone()
+            if merged is None:
+                rows.append(row)
+                jobs.append(job)
+    return rows, jobs
+
+
+def record_merged(
+    jobs: Sequence[Tuple[str, str, str]], conn: sqlite3.Connection
+) -> None:
+    """まとめた行のファイルを記録する
+
+    マスターデータへの保存と同じトランザクションの中で呼ぶ
+    (masterdata.MasterData.upsert の after に渡す)
+    """
+    _create_merged_table(conn)
+    now = time.time()
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {MERGED_TABLE} (filename, sha256, version, merged) "
+        "VALUES (?, ?, ?, ?)",
+        [job + (now,) for job in jobs],
+    )
+
+
+def merged_jobs(shard_dir: str, spec: ShardSpec, run_id: str) -> List[Tuple[str, str]]:
+    """spec.name(run_id) の計算結果のうち、まとめ終わった(merged に移した)行のファイル
+
+    Returns:
+        (台帳のファイルパス, 内容のハッシュ) のリスト
+    """
+    name = spec.name(run_id) + _MANIFEST_SUFFIX
+    merged_dir = os.path.join(shard_dir, MERGED_DIR)
+    jobs = []
+    if os.path.isdir(merged_dir):
+        for stamp in sorted(os.listdir(merged_dir)):
+            path = os.path.join(merged_dir, stamp, name)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as fd:
+                    jobs.extend(tuple(job) for job in json.load(fd).get("jobs", []))
+    return jobs
+
+
+def archive(partials: Sequence[Partial]) -> None:
+    """まとめたシャードのファイルを merged ディレクトリに移す(2回まとめないように)
+
+    同じ名前のシャードを後でまたまとめることがあるので、まとめた時刻ごとに分ける
+    """
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    for partial in partials:
+        merged_dir = os.path.join(
+            os.path.dirname(partial.manifest_path), MERGED_DIR, stamp
+        )
+        os.makedirs(merged_dir, exist_ok=True)
+        # 記録を先に移す(途中で止まっても、記録のない計算結果は読まれない)
+        for path in (partial.manifest_path, partial.rows_path):
+            os.replace(path, os.path.join(merged_dir, os.path.basename(path)))
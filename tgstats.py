@@ -0,0 +1,79 @@
+"""Tierのラベルごとの集計
+
+calc_1 / calc_2 / calc_3 で使う「ラベルごとのintervalの数と長さの合計」を、
+Tierを1回走査するだけで求める。ラベルはコード(tgreader.TierArrays)のまま数える。
+長さの合計は np.bincount の重みとして先頭から順に足すので、
+intervalを順にループして += した場合と同じ値になる。
+"""
+
+from typing import Dict, Mapping, Tuple
+
+import numpy as np
+
+import tgreader
+
+
+class LabelStats:
+    """ラベルごとのintervalの数と長さの合計"""
+
+    def __init__(self, counts: Dict[str, int], totals: Dict[str, float]):
+        self.counts = counts
+        self.totals = totals
+
+    def count(self, label: str) -> int:
+        """label のintervalの数"""
+        return self.counts.get(label, 0)
+
+    def total(self, label: str) -> float:
+        """label のintervalの長さの合計(なければ 0.0)"""
+        return self.totals.get(label, 0.0)
+
+
+def label_stats(tier: tgreader.TierArrays) -> LabelStats:
+    if len(tier) == 0:
+        return LabelStats({}, {})
+
+    counts = np.bincount(tier.codes, minlength=len(tier.labels))
+    totals = np.bincount(
+        tier.codes, weights=tier.end - tier.start, minlength=len(tier.labels)
+    )
+    return LabelStats(
+        dict(zip(tier.labels, counts.tolist())),
+        dict(zip(tier.labels, totals.tolist())),
+    )
+
+
+def segment_ranges(
+    segments: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """セグメントごとの (要素数, 最大値 - 最小値)
+
+    同じセグメント番号の要素は連続して並んでいること。結果はセグメント番号の順。
+    最大値・最小値は NaN を除いて求める(すべて NaN なら NaN)
+    """
+    if len(segments) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    _, first, counts = np.unique(segments, return_index=True, return_counts=True)
+    values = np.asarray(values, dtype=float)
+    return counts, np.fmax.reduceat(values, first) - np.fmin.reduceat(values, first)
+
+
+class LabelStatsCache:
+    """Tierごとの LabelStats を、Tierが置き換えられるまで使い回す
+
+    tgdata では Tier を変更するときは tgedit で新しいTierを作って置き換えるので、
+    Tierのオブジェクトが同じであれば集計結果も同じである
+    """
+
+    def __init__(self):
+        self._cache: Dict[str, Tuple[tgreader.TierArrays, LabelStats]] = {}
+
+    def get(
+        self, tiers: Mapping[str, tgreader.TierArrays], tier_name: str
+    ) -> LabelStats:
+        tier = tiers[tier_name]
+        cached = self._cache.get(tier_name)
+        if cached is None or cached[0] is not tier:
+            cached = (tier, label_stats(tier))
+            self._cache[tier_name] = cached
+        return cached[1]